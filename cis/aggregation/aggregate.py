@@ -15,7 +15,8 @@ from cis.aggregation.aggregation_kernels import aggregation_kernels
 
 
 class Aggregate(object):
-    def __init__(self, grid, output_file, data_reader=DataReader(), data_writer=DataWriter()):
+    def __init__(self, grid, output_file, data_reader=DataReader(), data_writer=DataWriter(), streaming=False,
+                 partial=False):
         """
         Constructor
 
@@ -23,11 +24,18 @@ class Aggregate(object):
         :param output_file: The filename to output the result to
         :param data_reader: Optional :class:`DataReader` configuration object
         :param data_writer: Optional :class:`DataWriter` configuration object
+        :param bool streaming: If True, ungridded data is read and aggregated one file at a time, so that only the
+         data from one file is held in memory at once (optional)
+        :param bool partial: If True, the running totals for each cell of the grid are output rather than the final
+         statistics, so that they can be merged with other partial aggregates using :class:`MergeAggregates`. Only
+         ungridded data can be partially aggregated (optional)
         """
         self._data_writer = data_writer
         self._data_reader = data_reader
         self._grid = grid
         self._output_file = output_file
+        self._streaming = streaming
+        self._partial = partial
 
     def _create_aggregator(self, data, grid):
         return Aggregator(data, grid)
@@ -46,21 +54,37 @@ class Aggregate(object):
         # Set the default kernel here rather than in the signature as the input_group dict passes None by default
         kernel_name = kernel or 'moments'
         # Read the input data - the parser limits the number of data groups to one for this command.
-        try:
+        logging.info("Reading data for variables: %s", variables)
+        if self._streaming:
+            # Read the first file, which is used to generate the grid, then the rest as they are aggregated.
+            data_by_file = self._read_data_by_file(variables, filenames, product)
+            data = next(data_by_file)
+            if isinstance(data, iris.cube.CubeList):
+                logging.warning("Gridded data can not be aggregated one file at a time; reading all of the files")
+                data_by_file = None
+                data = _read_data(self._data_reader.read_data_list, filenames, variables, product)
+        else:
             # Read the data into a data object (either UngriddedData or Iris Cube), concatenating data from
             # the specified files.
-            logging.info("Reading data for variables: %s", variables)
-            data = self._data_reader.read_data_list(filenames, variables, product)
-        except (IrisError, InvalidVariableError) as e:
-            raise CISError("There was an error reading in data: \n" + str(e))
-        except IOError as e:
-            raise CISError("There was an error reading one of the files: \n" + str(e))
+            data_by_file = None
+            data = _read_data(self._data_reader.read_data_list, filenames, variables, product)
 
         aggregator = self._create_aggregator(data, self._grid)
 
-        if isinstance(data, iris.cube.CubeList):
+        if self._partial:
+            if isinstance(data, iris.cube.CubeList):
+                raise CISError("Gridded data can not be partially aggregated")
+            data = aggregator.aggregate_ungridded_to_partial(data_by_file or [])
+            kernel_name = 'partial'
+        elif isinstance(data, iris.cube.CubeList):
             kernel_inst = aggregation_kernels[kernel_name]
             data = aggregator.aggregate_gridded(kernel_inst)
+        elif data_by_file is not None:
+            kernel_inst = get_kernel(kernel_name)()
+            if not hasattr(kernel_inst, 'get_values_from_accumulators'):
+                raise CISError("The {} kernel can not be used to aggregate data one file at a time".format(
+                    kernel_name))
+            data = aggregator.aggregate_ungridded_in_chunks(kernel_inst, data_by_file)
         else:
             kernel_class = get_kernel(kernel_name)
             kernel_inst = kernel_class()
@@ -75,3 +99,33 @@ class Aggregate(object):
         data.add_history(history)
 
         self._data_writer.write_data(data, self._output_file)
+
+    def _read_data_by_file(self, variables, filenames, product):
+        """
+        Reads the data from one file at a time.
+
+        :return: generator of the data read from each file in turn
+        """
+        data_by_file = self._data_reader.read_data_list_by_file(filenames, variables, product)
+        while True:
+            try:
+                data = _read_data(next, data_by_file)
+            except StopIteration:
+                return
+            yield data
+
+
+def _read_data(read_func, *args):
+    """
+    Reads data, converting any errors in reading it into CISErrors.
+
+    :param read_func: function which reads the data
+    :param args: arguments to pass to read_func
+    :return: the data read
+    """
+    try:
+        return read_func(*args)
+    except (IrisError, InvalidVariableError) as e:
+        raise CISError("There was an error reading in data: \n" + str(e))
+    except IOError as e:
+        raise CISError("There was an error reading one of the files: \n" + str(e))
@@ -13,6 +13,7 @@ from cis.utils import isnan, guess_coord_axis
 from cis.exceptions import ClassNotFoundError, CoordinateNotFoundError
 from cis.aggregation.aggregation_kernels import MultiKernel
 from cis.data_io.gridded_data import GriddedDataList
+from cis.aggregation.partial_aggregate import PartialAggregateKernel, set_partial_aggregate_attributes
 
 
 class Aggregator(object):
@@ -70,6 +71,80 @@ class Aggregator(object):
         Performs aggregation for ungridded data by first generating a new grid, converting it into a cube, then
         collocating using the appropriate kernel and a cube cell constraint
         """
+        aggregation_cube = self._make_aggregation_cube()
+
+        collocator = GeneralGriddedCollocator()
+        constraint = BinnedCubeCellOnlyConstraint()
+        aggregated_cube = collocator.collocate(aggregation_cube, self.data, constraint, kernel)
+        self._add_max_min_bounds_for_collapsed_coords(aggregated_cube, self._get_coord_ranges(self.data))
+        self._rename_variables_clashing_with_coords(aggregated_cube, aggregation_cube)
+        return aggregated_cube
+
+    def aggregate_ungridded_in_chunks(self, kernel, more_data):
+        """
+        Performs aggregation for ungridded data which is read in a number of chunks, e.g. one file at a time. The grid
+        is generated from the first chunk, which is the data given to the constructor. Each chunk is binned onto the
+        grid and added to running totals for each cell, so that only one chunk needs to be held in memory at once.
+
+        :param kernel: kernel with a get_values_from_accumulators method
+        :param more_data: iterable of the remaining chunks of data
+        :return: GriddedDataList of aggregated data
+        """
+        collocator = GeneralGriddedCollocator()
+        aggregation_cube, accumulators, coord_ranges = self._accumulate_ungridded_in_chunks(collocator, more_data)
+
+        aggregated_cube = collocator.create_output_from_accumulators(aggregation_cube, self.data, accumulators, kernel)
+        self._add_max_min_bounds_for_collapsed_coords(aggregated_cube, coord_ranges)
+        self._rename_variables_clashing_with_coords(aggregated_cube, aggregation_cube)
+        return aggregated_cube
+
+    def aggregate_ungridded_to_partial(self, more_data):
+        """
+        Performs the first part of aggregation for ungridded data which is read in a number of chunks, but instead of
+        the final statistics outputs the running totals for each cell (see aggregate_ungridded_in_chunks). The output of
+        several such partial aggregations onto the same grid can be merged using
+        :func:`cis.aggregation.partial_aggregate.merge_partial_aggregates`.
+
+        :param more_data: iterable of the remaining chunks of data
+        :return: GriddedDataList of the running totals
+        """
+        collocator = GeneralGriddedCollocator()
+        aggregation_cube, accumulators, coord_ranges = self._accumulate_ungridded_in_chunks(collocator, more_data)
+
+        partial_cube = collocator.create_output_from_accumulators(aggregation_cube, self.data, accumulators,
+                                                                  PartialAggregateKernel())
+        set_partial_aggregate_attributes(partial_cube, self.data)
+        self._add_max_min_bounds_for_collapsed_coords(partial_cube, coord_ranges)
+        return partial_cube
+
+    def _accumulate_ungridded_in_chunks(self, collocator, more_data):
+        """
+        Bins each chunk of ungridded data onto the grid and adds it to running totals for each cell.
+
+        :param collocator: GeneralGriddedCollocator to bin the data with
+        :param more_data: iterable of the remaining chunks of data
+        :return: tuple of (cube with the coordinates of the grid, running totals for each variable, dictionary of
+         coordinate name:(start, end) over all of the chunks)
+        """
+        aggregation_cube = self._make_aggregation_cube()
+
+        accumulators = collocator.accumulate(aggregation_cube, self.data)
+        coord_ranges = self._get_coord_ranges(self.data)
+        for data in more_data:
+            collocator.accumulate(aggregation_cube, data, accumulators)
+            for name, (start, end) in self._get_coord_ranges(data).items():
+                if name in coord_ranges:
+                    start = numpy.minimum(start, coord_ranges[name][0])
+                    end = numpy.maximum(end, coord_ranges[name][1])
+                coord_ranges[name] = (start, end)
+        return aggregation_cube, accumulators, coord_ranges
+
+    def _make_aggregation_cube(self):
+        """
+        Generates the new grid from the aggregation grid specification and the coordinates of the data.
+
+        :return: cube with the coordinates of the new grid
+        """
         new_cube_coords = []
         new_cube_shape = []
 
@@ -96,13 +171,9 @@ class Aggregator(object):
                                           'name.'.format(self._grid.keys()))
 
         dummy_data = numpy.reshape(numpy.arange(int(numpy.prod(new_cube_shape))) + 1.0, tuple(new_cube_shape))
-        aggregation_cube = iris.cube.Cube(dummy_data, dim_coords_and_dims=new_cube_coords)
-
-        collocator = GeneralGriddedCollocator()
-        constraint = BinnedCubeCellOnlyConstraint()
-        aggregated_cube = collocator.collocate(aggregation_cube, self.data, constraint, kernel)
-        self._add_max_min_bounds_for_collapsed_coords(aggregated_cube, self.data)
+        return iris.cube.Cube(dummy_data, dim_coords_and_dims=new_cube_coords)
 
+    def _rename_variables_clashing_with_coords(self, aggregated_cube, aggregation_cube):
         # We need to rename any variables which clash with coordinate names otherwise they will not output correctly, we
         # prepend it with 'aggregated_' to make it clear which variable has been aggregated (the original coordinate
         # value will not have been.)
@@ -114,8 +185,6 @@ class Aggregator(object):
                 logging.warning("Variable {} clashes with a coordinate variable name and has been renamed to: {}"
                                 .format(d.var_name, new_name))
 
-        return aggregated_cube
-
     def _make_fully_collapsed_coord(self, coord):
         """
         Make a new DimCoord which represents a fully collapsed coordinate.
@@ -162,21 +231,34 @@ class Aggregator(object):
             new_coord.guess_bounds()
         return new_coord
 
-    def _add_max_min_bounds_for_collapsed_coords(self, aggregated_cube, source_cube):
+    def _add_max_min_bounds_for_collapsed_coords(self, aggregated_cube, coord_ranges):
         """
         Add bounds onto all coordinates which have been full collapsed, and for which no explicit bounds have been
         supplied (iris will have guessed these to be +/- inf). The new bounds will be the maximum and minimum values of
-        those coordinates
+        those coordinates, and the point the midpoint between them
         :param aggregated_cube: The aggregated cube to give new bounds
-        :param source_cube: The source cube which the aggregation was made from.
+        :param coord_ranges: Dictionary of coordinate name:(start, end) giving the range of each coordinate of the data
+         which the aggregation was made from
         """
         from numpy import isinf, all
         for coord in aggregated_cube.coords():
             if len(coord.points) == 1 and all(isinf(coord.bounds)):
-                source_coord = source_cube.coord(coord.name())
-                coord_start, coord_end, coord_centre = self._get_coord_start_end_centre(source_coord)
+                coord_start, coord_end = coord_ranges[coord.name()]
+                coord.points = numpy.array([coord_start + (coord_end - coord_start) / 2.0])
                 coord.bounds = numpy.array([[coord_start, coord_end]])
 
+    def _get_coord_ranges(self, data):
+        """
+        Get the range of each coordinate of some data
+        :param data: Ungridded data or list of data
+        :return: Dictionary of coordinate name:(start, end)
+        """
+        coord_ranges = {}
+        for coord in data.coords():
+            coord_start, coord_end, coord_centre = self._get_coord_start_end_centre(coord)
+            coord_ranges[coord.name()] = (coord_start, coord_end)
+        return coord_ranges
+
     def _get_coord_start_end_centre(self, coord):
         """
         Get the coordinates start, end and midpoint values
@@ -0,0 +1,242 @@
+"""
+Partial aggregates hold the running totals for each cell of an aggregation grid rather than the final statistics, so
+that an aggregation can be split into a number of independent jobs over subsets of the files and the partial
+aggregates merged at the end.
+"""
+import logging
+from collections import OrderedDict
+
+import iris
+import iris.cube
+import iris.exceptions
+import numpy as np
+
+import cis.utils
+from cis.collocation.cell_accumulators import CellAccumulators
+from cis.collocation.col_framework import get_kernel
+from cis.data_io.data_writer import DataWriter
+from cis.data_io.gridded_data import GriddedDataList, make_from_cube
+from cis.exceptions import CISError
+from cis import __version__
+
+#: Attribute giving which running total a variable in a partial aggregate file holds
+PARTIAL_AGGREGATE_ATTRIBUTE = 'cis_partial_aggregate'
+#: Attribute giving the position of the aggregated variable in the list of variables aggregated
+AGGREGATED_VARIABLE_POSITION_ATTRIBUTE = 'cis_aggregated_var_position'
+#: Attributes recording the metadata of the variable which was aggregated
+AGGREGATED_VARIABLE_ATTRIBUTES = ('cis_aggregated_var_name', 'cis_aggregated_long_name',
+                                  'cis_aggregated_standard_name', 'cis_aggregated_units')
+
+#: The running totals kept for each cell, in order, and the value of each in a cell with no values
+ACCUMULATORS = OrderedDict([('count', 0), ('sum', 0.0), ('sum_of_squared_deviations', 0.0),
+                            ('minimum', np.inf), ('maximum', -np.inf)])
+
+
+class PartialAggregateKernel(object):
+    """
+    Outputs the running totals for each cell in place of the values of an aggregation kernel.
+    """
+    return_size = len(ACCUMULATORS)
+
+    def get_variable_details(self, var_name, var_long_name, var_standard_name, var_units):
+        """
+        Sets the name and units for the variable holding each running total.
+
+        :return: tuple of tuples each containing (variable name, variable long name, variable standard name,
+         variable units)
+        """
+        return ((var_name + '_count', 'Number of points of %s' % var_long_name, None, None),
+                (var_name + '_sum', 'Sum of %s' % var_long_name, None, var_units),
+                (var_name + '_sum_of_squared_deviations', 'Sum of squared deviations from the mean of %s'
+                 % var_long_name, None, None),
+                (var_name + '_minimum', 'Minimum of %s' % var_long_name, None, var_units),
+                (var_name + '_maximum', 'Maximum of %s' % var_long_name, None, var_units))
+
+    def get_values_from_accumulators(self, accumulators):
+        """
+        Returns the running totals for each cell
+        """
+        return np.array([getattr(accumulators, name) for name in ACCUMULATORS])
+
+
+def set_partial_aggregate_attributes(partial_cubes, data):
+    """
+    Records which running total each cube of a partial aggregate holds, and the metadata of the variable aggregated.
+
+    :param partial_cubes: GriddedDataList output using a PartialAggregateKernel
+    :param data: the data (or list of data) which was aggregated
+    """
+    data_list = data if isinstance(data, list) else [data]
+    for idx, cube in enumerate(partial_cubes):
+        variable = data_list[idx // len(ACCUMULATORS)]
+        attributes = {PARTIAL_AGGREGATE_ATTRIBUTE: list(ACCUMULATORS.keys())[idx % len(ACCUMULATORS)],
+                      AGGREGATED_VARIABLE_POSITION_ATTRIBUTE: idx // len(ACCUMULATORS)}
+        for attribute, value in zip(AGGREGATED_VARIABLE_ATTRIBUTES, (variable.var_name, variable.long_name,
+                                                                     variable.standard_name, variable.units)):
+            # NetCDF attributes can not be None.
+            if value is not None:
+                attributes[attribute] = str(value)
+        cube.add_attributes(attributes)
+
+
+def read_partial_aggregates(filename):
+    """
+    Reads the running totals for each variable from a partial aggregate file.
+
+    :param str filename: name of the partial aggregate file
+    :return: OrderedDict of aggregated variable name:(cube giving the grid and metadata, CellAccumulators), in the
+     order the variables were aggregated in
+    """
+    cubes = [cube for cube in iris.load(filename) if PARTIAL_AGGREGATE_ATTRIBUTE in cube.attributes]
+    if not cubes:
+        raise CISError("{} is not a partial aggregate file".format(filename))
+
+    # The cubes are not necessarily loaded in the order they were written, so are put back into the order of the
+    # variables aggregated.
+    cubes_by_variable = OrderedDict()
+    for cube in sorted(cubes, key=lambda c: (int(c.attributes.get(AGGREGATED_VARIABLE_POSITION_ATTRIBUTE, 0)),
+                                             c.attributes[AGGREGATED_VARIABLE_ATTRIBUTES[0]])):
+        variable = cube.attributes[AGGREGATED_VARIABLE_ATTRIBUTES[0]]
+        cubes_by_variable.setdefault(variable, {})[cube.attributes[PARTIAL_AGGREGATE_ATTRIBUTE]] = cube
+
+    partial_aggregates = OrderedDict()
+    for variable, cubes in cubes_by_variable.items():
+        missing = [name for name in ACCUMULATORS if name not in cubes]
+        if missing:
+            raise CISError("The partial aggregate of {} in {} does not have the running totals: {}".format(
+                variable, filename, ', '.join(missing)))
+        template = cubes['count']
+        accumulators = CellAccumulators(template.shape)
+        for name, empty_value in ACCUMULATORS.items():
+            # Cells with no values are masked in the file.
+            getattr(accumulators, name)[...] = np.ma.filled(cubes[name].data, empty_value)
+        partial_aggregates[variable] = (template, accumulators)
+    return partial_aggregates
+
+
+def merge_partial_aggregates(filenames, kernel):
+    """
+    Merges the running totals in a number of partial aggregate files onto the same grid and calculates the final
+    statistics. Only one file is held in memory at a time.
+
+    :param filenames: names of the partial aggregate files
+    :param kernel: instance of a Kernel subclass with a get_values_from_accumulators method
+    :return: GriddedDataList of aggregated data
+    """
+    merged = None
+    for filename in filenames:
+        logging.info("Reading partial aggregates from %s", filename)
+        partial_aggregates = read_partial_aggregates(filename)
+        if merged is None:
+            merged = partial_aggregates
+            continue
+        # The variables are matched by name, and output in the order of the first file.
+        if sorted(partial_aggregates.keys()) != sorted(merged.keys()):
+            raise CISError("The partial aggregates in {} are of the variables {} rather than {}".format(
+                filename, list(partial_aggregates.keys()), list(merged.keys())))
+        for variable, (template, accumulators) in partial_aggregates.items():
+            merged_template, merged_accumulators = merged[variable]
+            _merge_coords(merged_template, template, filename)
+            merged_accumulators.add(accumulators)
+
+    output = GriddedDataList()
+    for variable, (template, accumulators) in merged.items():
+        output.extend(_create_output(template, accumulators, kernel))
+    return output
+
+
+def _merge_coords(merged_template, template, filename):
+    """
+    Checks that a partial aggregate is on the same grid as those already merged. The bounds of coordinates which have
+    been fully collapsed are extended to cover both.
+
+    :param merged_template: cube giving the grid of the partial aggregates already merged
+    :param template: cube giving the grid of the partial aggregate to merge
+    :param str filename: name of the file the partial aggregate was read from, for error messages
+    """
+    for coord in merged_template.coords():
+        try:
+            other_coord = template.coord(coord.name())
+        except iris.exceptions.CoordinateNotFoundError:
+            raise CISError("The partial aggregate in {} does not have the coordinate {}".format(filename, coord.name()))
+        if coord.shape == other_coord.shape and np.allclose(coord.points, other_coord.points) and \
+                (coord.bounds is None) == (other_coord.bounds is None) and \
+                (coord.bounds is None or np.allclose(coord.bounds, other_coord.bounds)):
+            continue
+        if len(coord.points) == 1 and len(other_coord.points) == 1 and coord.has_bounds() and \
+                other_coord.has_bounds():
+            start = np.minimum(coord.bounds.min(), other_coord.bounds.min())
+            end = np.maximum(coord.bounds.max(), other_coord.bounds.max())
+            coord.points = np.array([start + (end - start) / 2.0])
+            coord.bounds = np.array([[start, end]])
+        else:
+            raise CISError("The partial aggregate in {} is not on the same grid as the others (coordinate {})".format(
+                filename, coord.name()))
+
+
+def _create_output(template, accumulators, kernel):
+    """
+    Creates the output of a kernel from the merged running totals for each cell.
+
+    :param template: cube giving the grid and the metadata of the aggregated variable
+    :param accumulators: CellAccumulators for the cells
+    :param kernel: instance of a Kernel subclass with a get_values_from_accumulators method
+    :return: GriddedDataList of aggregated data
+    """
+    var_name, long_name, standard_name, units = [template.attributes.get(attribute) for attribute in
+                                                 AGGREGATED_VARIABLE_ATTRIBUTES]
+    kernel_var_details = kernel.get_variable_details(var_name, long_name, standard_name, units)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kernel_values = kernel.get_values_from_accumulators(accumulators)
+
+    output = GriddedDataList()
+    for idx, kernel_val in enumerate(kernel_values):
+        # Cells with no values are left masked.
+        val = np.ma.masked_invalid(np.ma.masked_where(accumulators.count == 0, kernel_val))
+        cube = make_from_cube(template.copy(data=val))
+        for attribute in (PARTIAL_AGGREGATE_ATTRIBUTE,) + AGGREGATED_VARIABLE_ATTRIBUTES:
+            cube.attributes.pop(attribute, None)
+        cube.var_name = kernel_var_details[idx][0]
+        cube.long_name = kernel_var_details[idx][1]
+        cis.utils.set_cube_standard_name_if_valid(cube, kernel_var_details[idx][2])
+        try:
+            cube.units = kernel_var_details[idx][3]
+        except ValueError:
+            logging.warn("Units are not cf compliant, not setting them. Units {}".format(kernel_var_details[idx][3]))
+        output.append(cube)
+    return output
+
+
+class MergeAggregates(object):
+    def __init__(self, output_file, data_writer=DataWriter()):
+        """
+        Constructor
+
+        :param output_file: The filename to output the result to
+        :param data_writer: Optional :class:`DataWriter` configuration object
+        """
+        self._data_writer = data_writer
+        self._output_file = output_file
+
+    def merge(self, filenames, kernel=None):
+        """
+        Merge partial aggregate files, output by ``cis aggregate --partial``, into the final aggregation
+
+        :param filenames: One or more filenames of the partial aggregate files
+        :type filenames: string or list
+        :param str kernel: Name of kernel to use (the default is 'moments')
+        """
+        kernel_name = kernel or 'moments'
+        kernel_inst = get_kernel(kernel_name)()
+        if not hasattr(kernel_inst, 'get_values_from_accumulators'):
+            raise CISError("The {} kernel can not be used to merge partial aggregates".format(kernel_name))
+
+        filenames = cis.utils.listify(filenames)
+        data = merge_partial_aggregates(filenames, kernel_inst)
+
+        history = "Partial aggregates merged using CIS version " + __version__ + \
+                  "\n from files: " + str(filenames) + \
+                  "\n with kernel: " + kernel_name + "."
+        data.add_history(history)
+
+        self._data_writer.write_data(data, self._output_file)
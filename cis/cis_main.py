@@ -8,6 +8,7 @@ import logging
 
 from cis.data_io.data_reader import DataReader
 from cis.data_io.data_writer import DataWriter
+from cis.collocation import metrics
 from cis.exceptions import CISError, NoDataInSubsetError
 from cis import __version__, __status__
 
@@ -52,6 +53,33 @@ def __check_variable_is_valid(main_arguments, data, axis):
     return user_specified_variable
 
 
+def __set_index_cache(main_arguments):
+    """
+    Keeps the indexes created for collocation in a cache directory, if one was given.
+
+    :param main_arguments: The command line arguments
+    """
+    if main_arguments.index_cache is not None:
+        from cis.collocation import data_index
+        from cis.collocation.index_cache import IndexCache
+        size_limit = int(main_arguments.index_cache_size * 1024 * 1024)
+        data_index.set_index_cache(IndexCache(main_arguments.index_cache, size_limit))
+
+
+def __set_metrics(main_arguments):
+    """
+    Records metrics of the collocation, if a file to write them to was given.
+
+    :param main_arguments: The command line arguments
+    :return: the CollocationMetrics, or None if metrics are not being recorded
+    """
+    collocation_metrics = None
+    if main_arguments.metrics is not None:
+        collocation_metrics = metrics.CollocationMetrics()
+    metrics.set_metrics(collocation_metrics)
+    return collocation_metrics
+
+
 def plot_cmd(main_arguments):
     """
     Main routine for handling calls to the 'plot' command.
@@ -120,16 +148,23 @@ def col_cmd(main_arguments):
 
     output_file = main_arguments.output
     data_reader = DataReader()
+    __set_index_cache(main_arguments)
+    collocation_metrics = __set_metrics(main_arguments)
     missing_data_for_missing_samples = False
-    if main_arguments.samplevariable is not None:
-        sample_data = data_reader.read_data_list(main_arguments.samplefiles, main_arguments.samplevariable,
-                                                 main_arguments.sampleproduct)[0]
-    else:
-        sample_data = data_reader.read_coordinates(main_arguments.samplefiles, main_arguments.sampleproduct)
-        missing_data_for_missing_samples = True
+    with metrics.timed('read'):
+        if main_arguments.samplevariable is not None:
+            sample_data = data_reader.read_data_list(main_arguments.samplefiles, main_arguments.samplevariable,
+                                                     main_arguments.sampleproduct)[0]
+        else:
+            sample_data = data_reader.read_coordinates(main_arguments.samplefiles, main_arguments.sampleproduct)
+            missing_data_for_missing_samples = True
 
     try:
-        col = Collocate(sample_data, missing_data_for_missing_samples)
+        memory_limit = None
+        if main_arguments.memory_limit is not None:
+            memory_limit = int(main_arguments.memory_limit * 1024 * 1024)
+        col = Collocate(sample_data, missing_data_for_missing_samples, processes=main_arguments.processes,
+                        memory_limit=memory_limit)
     except IOError as e:
         __error_occurred("There was an error reading one of the files: \n" + str(e))
 
@@ -145,16 +180,21 @@ def col_cmd(main_arguments):
         filenames = input_group['filenames']
         product = input_group["product"] if input_group["product"] is not None else None
 
-        data = data_reader.read_data_list(filenames, variables, product)
+        with metrics.timed('read'):
+            data = data_reader.read_data_list(filenames, variables, product)
         data_writer = DataWriter()
         try:
             output = col.collocate(data, col_name, col_options, kern_name, kern_options)
-            data_writer.write_data(output, output_file)
+            with metrics.timed('write'):
+                data_writer.write_data(output, output_file)
         except ClassNotFoundError as e:
             __error_occurred(str(e) + "\nInvalid collocation option.")
         except (CISError, IOError) as e:
             __error_occurred(e)
 
+    if collocation_metrics is not None:
+        collocation_metrics.write_json(main_arguments.metrics)
+
 
 def subset_cmd(main_arguments):
     """
@@ -194,10 +234,27 @@ def aggregate_cmd(main_arguments):
     variables = input_group['variables']
     filenames = input_group['filenames']
 
-    aggregate = Aggregate(main_arguments.grid, main_arguments.output)
+    __set_index_cache(main_arguments)
+    aggregate = Aggregate(main_arguments.grid, main_arguments.output, streaming=main_arguments.streaming,
+                          partial=main_arguments.partial)
     aggregate.aggregate(variables, filenames, input_group["product"], input_group["kernel"])
 
 
+def merge_aggregates_cmd(main_arguments):
+    """
+    Main routine for handling calls to the merge-aggregates command.
+
+    :param main_arguments: The command line arguments (minus the merge-aggregates command)
+    """
+    from cis.aggregation.partial_aggregate import MergeAggregates
+
+    merge_aggregates = MergeAggregates(main_arguments.output)
+    try:
+        merge_aggregates.merge(main_arguments.filenames, main_arguments.kernel)
+    except CISError as exc:
+        __error_occurred(exc)
+
+
 def evaluate_cmd(main_arguments):
     """
     Main routine for handling calls to the evaluation command
@@ -257,6 +314,7 @@ commands = {'plot': plot_cmd,
             'info': info_cmd,
             'col': col_cmd,
             'aggregate': aggregate_cmd,
+            'merge-aggregates': merge_aggregates_cmd,
             'subset': subset_cmd,
             'eval': evaluate_cmd,
             'stats': stats_cmd,
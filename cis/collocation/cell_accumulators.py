@@ -0,0 +1,72 @@
+"""
+Running totals for each cell of an aggregation grid, so that data can be aggregated one chunk at a time.
+"""
+import numpy as np
+
+
+class CellAccumulators(object):
+    """
+    The number, sum, sum of squared deviations from the mean, minimum and maximum of the values in each cell of a grid.
+    Chunks of values are added using the parallel algorithm of Chan et al., which combines the sums of squared
+    deviations without the loss of precision of a running sum of squares.
+    """
+
+    def __init__(self, shape):
+        """
+        :param shape: shape of the grid
+        """
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.sum = np.zeros(shape)
+        self.sum_of_squared_deviations = np.zeros(shape)
+        self.minimum = np.full(shape, np.inf)
+        self.maximum = np.full(shape, -np.inf)
+
+    @property
+    def shape(self):
+        return self.count.shape
+
+    def add_slices(self, out_indices, values, slice_starts):
+        """
+        Adds values in some of the cells, given as consecutive slices of a single array.
+
+        :param out_indices: tuple of arrays of the grid indices of the cell of each slice
+        :param values: array of the values in all of the slices
+        :param slice_starts: array of the indices in values at which each slice starts; the last slice ends at the end
+         of the values
+        """
+        if len(slice_starts) == 0:
+            return
+        values = np.asarray(np.ma.getdata(values), dtype=np.float64)
+        counts = np.diff(np.append(slice_starts, len(values)))
+        sums = np.add.reduceat(values, slice_starts)
+        deviations = values - np.repeat(sums / counts, counts)
+        self._combine(out_indices, counts, sums, np.add.reduceat(deviations ** 2, slice_starts),
+                      np.minimum.reduceat(values, slice_starts), np.maximum.reduceat(values, slice_starts))
+
+    def add(self, other):
+        """
+        Adds the values accumulated for the same grid in another instance.
+
+        :param other: CellAccumulators of the same shape
+        """
+        if other.shape != self.shape:
+            raise ValueError("Can not add accumulators of shape {} to accumulators of shape {}".format(other.shape,
+                                                                                                       self.shape))
+        self._combine(Ellipsis, other.count, other.sum, other.sum_of_squared_deviations, other.minimum,
+                      other.maximum)
+
+    def _combine(self, index, count, total, sum_of_squared_deviations, minimum, maximum):
+        old_count = self.count[index]
+        old_sum = self.sum[index]
+        new_count = old_count + count
+        # The correction to the sum of squared deviations for the difference between the two means is zero when either
+        # part has no values
+        both = (old_count > 0) & (count > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correction = np.where(both, (old_sum * count - total * old_count) ** 2 /
+                                  (old_count * count * new_count).astype(np.float64), 0.0)
+        self.sum_of_squared_deviations[index] += sum_of_squared_deviations + correction
+        self.count[index] = new_count
+        self.sum[index] = old_sum + total
+        self.minimum[index] = np.minimum(self.minimum[index], minimum)
+        self.maximum[index] = np.maximum(self.maximum[index], maximum)
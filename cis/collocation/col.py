@@ -38,6 +38,10 @@ class CollocatorFactory(object):
         collocator_params, constraint_params = self._get_collocator_params(collocator_params)
         col = self._instantiate_with_params(col_cls, collocator_params)
         del constraint_params['missing_data_for_missing_sample']
+        if constraint_cls is ci.SepConstraintKdtree and constraint_params.get('index_type') == 'grid':
+            # The hash grid is a separate constraint rather than a type of k-D tree
+            constraint_cls = ci.SepConstraintGrid
+            del constraint_params['index_type']
         con = self._instantiate_with_params(constraint_cls, constraint_params)
         kernel = self._instantiate_with_params(kernel_cls, kernel_params)
         return col, con, kernel
@@ -144,7 +148,8 @@ class Collocate(object):
     Perform a general collocation
     """
 
-    def __init__(self, sample_points, missing_data_for_missing_sample=False, collocator_factory=CollocatorFactory()):
+    def __init__(self, sample_points, missing_data_for_missing_sample=False, collocator_factory=CollocatorFactory(),
+                 processes=1, memory_limit=None, metrics=None):
         """
         Constructor
 
@@ -152,11 +157,20 @@ class Collocate(object):
         :param output_filename: Filename to output to
         :param missing_data_for_missing_sample: Write missing values out when sample data is missing
         :param CollocatorFactory collocator_factory: An optional configuration object
+        :param int processes: The number of processes to share the sample points between, for collocators which
+            support it
+        :param int memory_limit: An approximate limit in bytes on the memory used at once, for collocators which
+            support it
+        :param CollocationMetrics metrics: Optional metrics to record the time spent in each phase of the collocation
+            and the work done by the indexes, constraints and kernels into
         """
         self.sample_points = sample_points
         self.missing_data_for_missing_sample = missing_data_for_missing_sample
         self.coords_to_be_written = True
         self.collocator_factory = collocator_factory
+        self.processes = processes
+        self.memory_limit = memory_limit
+        self.metrics = metrics
 
     def collocate(self, data, col_name=None, col_params=None, kern=None, kern_params=None):
         """
@@ -171,6 +185,7 @@ class Collocate(object):
         :raises CoordinateNotFoundError: If the collocator was unable to compare the sample and data points
         """
         from cis.exceptions import CoordinateNotFoundError
+        from cis.collocation import metrics
         from time import time
         from cis import __version__
 
@@ -184,6 +199,17 @@ class Collocate(object):
         col_name = self.collocator_factory.get_default_collocator_name(col_name, self.sample_points.is_gridded,
                                                                        data.is_gridded)
         logging.info("Collocator: " + str(col_name))
+        if self.processes > 1:
+            if hasattr(col, 'processes'):
+                col.processes = self.processes
+            else:
+                logging.warning("Collocator {} does not support multiple processes, so only one will be used".format(
+                    col_name))
+        if self.memory_limit is not None:
+            if hasattr(col, 'memory_limit'):
+                col.memory_limit = self.memory_limit
+            else:
+                logging.warning("Collocator {} does not support a memory limit, so it will be ignored".format(col_name))
         if kern is None:
             kernel_name = kernel.__class__.__name__
         else:
@@ -193,11 +219,16 @@ class Collocate(object):
 
         logging.info("Collocating, this could take a while...")
         t1 = time()
+        previous_metrics = metrics.get_metrics()
+        if self.metrics is not None:
+            metrics.set_metrics(self.metrics)
         try:
             new_data = col.collocate(self.sample_points, data, con, kernel)
         except TypeError as e:
             raise CoordinateNotFoundError('Collocator was unable to compare data points, check the dimensions of each '
                                           'data set and the collocation methods chosen. \n' + str(e))
+        finally:
+            metrics.set_metrics(previous_metrics)
 
         logging.info("Completed. Total time taken: " + str(time() - t1))
 
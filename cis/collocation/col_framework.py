@@ -1,4 +1,8 @@
 from abc import ABCMeta, abstractmethod
+
+import numpy as np
+import scipy.sparse
+
 from cis.utils import index_iterator_for_non_masked_data, index_iterator_nditer
 
 
@@ -22,7 +26,6 @@ class Collocator(object):
          data points with a missing value - regardless of the collocation result. The default is False.
         :return:
         """
-        import numpy as np
         self.fill_value = float(fill_value) if fill_value is not None else np.inf
         self.var_name = var_name
         self.var_long_name = var_long_name
@@ -49,6 +52,12 @@ class Kernel(object):
     """
     Class which provides a method for taking a number of points and returning one value. For example a nearest
     neighbour algorithm or sort algorithm or mean. This just defines the interface which the subclasses must implement.
+
+    Kernels may optionally also provide a ``get_values(points, data, neighbours)`` method which calculates the values
+    for all of the sample points at once. This takes the sample points and data points as HyperPointViews and the
+    neighbour relation returned by :meth:`.Constraint.get_neighbours` (or None if the data is unconstrained) and
+    returns a masked array of shape (:attr:`.Kernel.return_size`, number of sample points), masked wherever no value
+    could be calculated. Collocators use it in preference to :meth:`.Kernel.get_value` when the constraint supports it.
     """
     __metaclass__ = ABCMeta
 
@@ -110,6 +119,69 @@ class AbstractDataOnlyKernel(Kernel):
             raise ValueError
         return self.get_value_for_data_only(values)
 
+    def get_values(self, points, data, neighbours):
+        """
+        Calculates the kernel values for all of the sample points at once, using
+        :meth:`.AbstractDataOnlyKernel.get_values_for_data_only_in_slices` on the data values of the neighbours of the
+        sample points rather than building HyperPoints.
+
+        :param points: HyperPointView of the sample points
+        :param data: HyperPointView of the data points
+        :param neighbours: sparse matrix of shape (number of sample points, number of data points) whose rows give the
+         indices of the data points constrained for each sample point, or None if every data point is to be used
+        :return: masked array of shape (:attr:`.Kernel.return_size`, number of sample points)
+        """
+        values = np.ma.masked_all((self.return_size, len(points)))
+        data_values = data.data_flattened
+        if neighbours is None:
+            # Every sample point sees the same data, so there is only one value to calculate.
+            if data_values.size > 0:
+                self._set_values_for_data_only(values, slice(None), data_values)
+        else:
+            # The neighbours of each sample point are consecutive in the indices, so they form one slice per sample
+            # point with any neighbours.
+            occupied = np.flatnonzero(np.diff(neighbours.indptr) > 0)
+            if occupied.size > 0:
+                values[:, occupied] = self.get_values_for_data_only_in_slices(data_values[neighbours.indices],
+                                                                               neighbours.indptr[occupied])
+        return values
+
+    def get_values_for_data_only_in_slices(self, values, slice_starts):
+        """
+        Calculates the kernel values for a number of sets of data values at once, for example the data points in each
+        of the occupied cells of a grid. The sets are consecutive, non-empty slices of a single array of values. This
+        implementation calls :meth:`.AbstractDataOnlyKernel.get_value_for_data_only` on each slice in turn; kernels
+        may override it with a calculation over the whole array.
+
+        :param values: A numpy array of the values in all of the slices
+        :param slice_starts: A numpy array of the indices in values at which each slice starts, in increasing order;
+         each slice ends where the next one starts and the last one at the end of the values
+        :return: masked array of shape (:attr:`.Kernel.return_size`, number of slices), masked where a value could not
+         be calculated
+        """
+        kernel_values = np.ma.masked_all((self.return_size, len(slice_starts)))
+        slice_ends = np.append(slice_starts[1:], len(values))
+        for i, (start, end) in enumerate(zip(slice_starts, slice_ends)):
+            self._set_values_for_data_only(kernel_values, i, values[start:end])
+        return kernel_values
+
+    def _set_values_for_data_only(self, values, indices, data_values):
+        """
+        Calculates the kernel value(s) for some data values and sets them at the given sample point indices. Values
+        that cannot be calculated are left masked, in the same way that collocators treat the results of
+        :meth:`.Kernel.get_value`.
+        """
+        try:
+            kernel_val = self.get_value_for_data_only(data_values)
+        except ValueError:
+            return
+        if isinstance(kernel_val, tuple):
+            for idx, val in enumerate(kernel_val):
+                if not np.isnan(val):
+                    values[idx, indices] = val
+        else:
+            values[0, indices] = kernel_val
+
     @abstractmethod
     def get_value_for_data_only(self, values):
         """
@@ -148,6 +220,11 @@ class Constraint(object):
         :return: A reduced set of data points
         """
 
+    # Constraints may optionally provide a get_neighbours(points, data) method which constrains the data for all of
+    # the sample points at once. It should return a scipy.sparse.csr_matrix of shape (number of sample points, number
+    # of data points) whose rows hold the indices (into the flattened data) of the constrained data points for each
+    # sample point, or None if the data is not constrained at all. See :func:`make_neighbours`.
+
     def get_iterator(self, missing_data_for_missing_sample, coord_map, coords, data_points, shape, points, output_data):
         """
         Iterator to iterate through the points needed to be calculated.
@@ -240,6 +317,40 @@ class IndexedConstraint(Constraint):
             yield indices, hp, constrained_points
 
 
+def make_neighbours(index_lists, num_data_points):
+    """
+    Creates the neighbour relation returned by a constraint's get_neighbours method from the constrained data indices of
+    each sample point.
+
+    :param index_lists: sequence containing a sequence of data point indices for each sample point
+    :param num_data_points: the total number of data points (including masked ones)
+    :return: scipy.sparse.csr_matrix of shape (number of sample points, number of data points)
+    """
+    counts = np.fromiter((len(indices) for indices in index_lists), dtype=np.intp, count=len(index_lists))
+    indptr = np.zeros(len(index_lists) + 1, dtype=np.intp)
+    np.cumsum(counts, out=indptr[1:])
+    if indptr[-1] > 0:
+        indices = np.concatenate([np.asarray(indices, dtype=np.intp) for indices in index_lists])
+    else:
+        indices = np.zeros(0, dtype=np.intp)
+    return make_neighbours_from_offsets(indptr, indices, num_data_points)
+
+
+def make_neighbours_from_offsets(indptr, indices, num_data_points):
+    """
+    Creates the neighbour relation returned by a constraint's get_neighbours method from CSR style arrays.
+
+    :param indptr: array of length (number of sample points + 1); the data indices for sample point i are
+     indices[indptr[i]:indptr[i + 1]]
+    :param indices: array of the data point indices for all sample points
+    :param num_data_points: the total number of data points (including masked ones)
+    :return: scipy.sparse.csr_matrix of shape (number of sample points, number of data points)
+    """
+    # The order of the indices within each row is preserved, since kernels may depend on it.
+    return scipy.sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr),
+                                   shape=(len(indptr) - 1, num_data_points))
+
+
 def __get_class(parent_class, name=None):
     """
     Identify the subclass of parent_class to a given name, if specified.
@@ -1,3 +1,4 @@
+import itertools
 import logging
 
 import iris
@@ -9,13 +10,48 @@ import numpy as np
 from numpy import mean as np_mean, std as np_std, min as np_min, max as np_max
 
 from cis.collocation.col_framework import (Collocator, Constraint, PointConstraint, CellConstraint,
-                                           IndexedConstraint, Kernel, AbstractDataOnlyKernel)
+                                           IndexedConstraint, Kernel, AbstractDataOnlyKernel, make_neighbours,
+                                           make_neighbours_from_offsets)
 import cis.exceptions
 from cis.data_io.gridded_data import GriddedData, make_from_cube, GriddedDataList
 from cis.data_io.hyperpoint import HyperPoint, HyperPointList
+from cis.data_io.hyperpoint_view import HyperPointView, UngriddedHyperPointView
 from cis.data_io.ungridded_data import Metadata, UngriddedDataList, UngriddedData
 import cis.collocation.data_index as data_index
-from cis.utils import log_memory_profile
+from cis.collocation.cell_accumulators import CellAccumulators
+from cis.collocation import metrics
+from cis.collocation.kdtree import haversine_distance, RADIUS_EARTH
+from cis.utils import log_memory_profile, index_iterator_for_non_masked_data, index_iterator_nditer
+
+# Number of shards of the sample points to create for each worker process, so that the work is balanced if some parts
+# of the sample are slower to collocate than others.
+SHARDS_PER_PROCESS = 4
+
+# Largest departure of the cell boundaries of a coordinate from being evenly spaced, relative to the spacing, for the
+# nearest grid points to be found by arithmetic rather than by searching.
+REGULAR_GRID_TOLERANCE = 1.0e-6
+
+# Amount by which the separations are widened, relative to their size, when cropping the data points to the envelope of
+# the sample points, so that rounding does not remove points on the edge of the envelope.
+ENVELOPE_TOLERANCE = 1.0e-6
+
+# The collocator, points, constraint and kernel for the collocation being run in worker processes. Workers are forked
+# after this is set, so share it with the parent process rather than having it pickled.
+_shared_collocation = None
+
+
+def _collocate_shard(shard):
+    """
+    Collocates a contiguous range of the sample points in a worker process.
+
+    :param shard: tuple of (start, end) indices of the sample points to collocate
+    :return: array of the values for the sample points in the shard
+    """
+    collocator, sample_points, data_points, constraint, kernel, values = _shared_collocation
+    start, end = shard
+    shard_values = values[:, start:end].copy()
+    collocator._collocate_values(sample_points[start:end], data_points, constraint, kernel, shard_values)
+    return shard_values
 
 
 class GeneralUngriddedCollocator(Collocator):
@@ -26,6 +62,11 @@ class GeneralUngriddedCollocator(Collocator):
     def __init__(self, fill_value=None, var_name='', var_long_name='', var_units='',
                  missing_data_for_missing_sample=False):
         super(GeneralUngriddedCollocator, self).__init__()
+        # The number of processes to share the sample points between
+        self.processes = 1
+        # List of (data coordinates, neighbours) of the sample points for each set of data coordinates, when
+        # collocating a list of data in which several variables may share the same coordinates
+        self._shared_neighbours = None
         if fill_value is not None:
             try:
                 self.fill_value = float(fill_value)
@@ -57,11 +98,16 @@ class GeneralUngriddedCollocator(Collocator):
         log_memory_profile("GeneralUngriddedCollocator Initial")
 
         if isinstance(data, list):
-            # Indexing and constraints (for SepConstraintKdTree) will only take place on the first iteration,
-            # so we really can just call this method recursively if we've got a list of data.
+            # Call this method recursively for each variable. The neighbours of the sample points are only found once
+            # for each set of data coordinates and shared between the variables using them.
             output = UngriddedDataList()
-            for var in data:
-                output.extend(self.collocate(points, var, constraint, kernel))
+            if self.processes == 1:
+                self._shared_neighbours = []
+            try:
+                for var in data:
+                    output.extend(self.collocate(points, var, constraint, kernel))
+            finally:
+                self._shared_neighbours = None
             return output
 
         metadata = data.metadata
@@ -84,12 +130,28 @@ class GeneralUngriddedCollocator(Collocator):
         # Then fix the data points so that they fall onto the same 360 degree longitude range as the sample points
         _fix_longitude_range(points.coords(), data_points)
 
+        # Remove the data points which are too far from all of the sample points to satisfy the constraint, so that they
+        # are not indexed. When indexes are cached all of the data points are indexed instead, so that the cached
+        # indexes can be reused with different sample points.
+        if isinstance(data_points, HyperPointView) and data_index.get_index_cache() is None:
+            with metrics.timed('prefilter'):
+                data_points = _crop_to_sample_envelope(sample_points, data_points, constraint)
+
         log_memory_profile("GeneralUngriddedCollocator after data retrieval")
 
-        # Create index if constraint and/or kernel require one.
+        # Create index if constraint and/or kernel require one. Shared neighbours are found using an index of all the
+        # data points, created when they are first needed.
         coord_map = None
-        data_index.create_indexes(constraint, points, data_points, coord_map)
-        data_index.create_indexes(kernel, points, data_points, coord_map)
+        # The nearest points depend on which data points are masked, so are not shared.
+        share_neighbours = self._shared_neighbours is not None and hasattr(constraint, 'get_neighbours') and \
+            isinstance(data_points, HyperPointView) and not self._can_collocate_nearest(constraint, kernel)
+        # The indexes hold positions in the data points, which are masked and cropped differently for each variable of
+        # a list, so any built for a previous variable are discarded.
+        if not share_neighbours:
+            data_index.reset_indexes(constraint)
+            data_index.create_indexes(constraint, points, data_points, coord_map, data)
+        data_index.reset_indexes(kernel)
+        data_index.create_indexes(kernel, points, data_points, coord_map, data)
         log_memory_profile("GeneralUngriddedCollocator after indexing")
 
         logging.info("--> Collocating...")
@@ -106,34 +168,16 @@ class GeneralUngriddedCollocator(Collocator):
         log_memory_profile("GeneralUngriddedCollocator after output array creation")
 
         logging.info("    {} sample points".format(sample_points_count))
-        # Apply constraint and/or kernel to each sample point.
-        cell_count = 0
-        total_count = 0
-        for i, point in sample_points.enumerate_non_masked_points():
-            # Log progress periodically.
-            cell_count += 1
-            if cell_count == 1000:
-                total_count += cell_count
-                cell_count = 0
-                logging.info("    Processed {} points of {}".format(total_count, sample_points_count))
-
-            if constraint is None:
-                con_points = data_points
-            else:
-                con_points = constraint.constrain_points(point, data_points)
-            try:
-                value_obj = kernel.get_value(point, con_points)
-                # Kernel returns either a single value or a tuple of values to insert into each output variable.
-                if isinstance(value_obj, tuple):
-                    for idx, val in enumerate(value_obj):
-                        if not np.isnan(val):
-                            values[idx, i] = val
-                else:
-                    values[0, i] = value_obj
-            except CoordinateMultiDimError as e:
-                raise NotImplementedError(e)
-            except ValueError as e:
-                pass
+        metrics.add_points_processed(sample_points_count)
+        neighbours = None
+        if share_neighbours:
+            neighbours = self._get_shared_neighbours(points, data, sample_points, data_points, constraint)
+        if neighbours is not None:
+            self._collocate_with_neighbours(sample_points, data_points, kernel, values, neighbours)
+        elif self.processes > 1 and sample_points_count > 1:
+            self._collocate_in_processes(sample_points, data_points, constraint, kernel, values)
+        else:
+            self._collocate_values(sample_points, data_points, constraint, kernel, values)
         log_memory_profile("GeneralUngriddedCollocator after running kernel on sample points")
 
         return_data = UngriddedDataList()
@@ -155,6 +199,205 @@ class GeneralUngriddedCollocator(Collocator):
 
         return return_data
 
+    def _collocate_values(self, sample_points, data_points, constraint, kernel, values):
+        """
+        Calculates the values for the sample points, filling in those which can be calculated.
+        """
+        if self._can_collocate_nearest(constraint, kernel) and \
+                self._collocate_nearest(sample_points, data_points, constraint, kernel, values):
+            return
+        if self._can_collocate_vectorised(constraint, kernel):
+            self._collocate_vectorised(sample_points, data_points, constraint, kernel, values)
+        else:
+            self._collocate_point_by_point(sample_points, data_points, constraint, kernel, values)
+
+    def _collocate_in_processes(self, sample_points, data_points, constraint, kernel, values):
+        """
+        Splits the sample points into contiguous shards and collocates them in worker processes, then copies the values
+        back in order. The workers are forked after the indexes have been created, so the data, constraint and kernel
+        are shared with them rather than copied. Each sample point is collocated exactly as it would be in a single
+        process, so the values are identical.
+        """
+        import multiprocessing
+        import os
+        global _shared_collocation
+
+        if not hasattr(os, 'fork'):
+            logging.warning("Collocation in multiple processes requires fork; using a single process")
+            self._collocate_values(sample_points, data_points, constraint, kernel, values)
+            return
+
+        sample_points_count = values.shape[1]
+        num_shards = int(np.minimum(sample_points_count, self.processes * SHARDS_PER_PROCESS))
+        bounds = np.linspace(0, sample_points_count, num_shards + 1).astype(int)
+        shards = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+        logging.info("    Collocating in {} shards using {} processes".format(len(shards), self.processes))
+
+        _shared_collocation = (self, sample_points, data_points, constraint, kernel, values)
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            # The query and kernel can not be timed separately in the workers.
+            with metrics.timed(metrics.QUERY_AND_KERNEL_PHASE):
+                results = pool.map(_collocate_shard, shards)
+        finally:
+            pool.terminate()
+            pool.join()
+            _shared_collocation = None
+        for (start, end), shard_values in zip(shards, results):
+            values[:, start:end] = shard_values
+
+    def _get_shared_neighbours(self, points, data, sample_points, data_points, constraint):
+        """
+        Gets the neighbours of the sample points among the non-masked data points. The neighbours among all of the data
+        points are found only once for each set of data coordinates, then the masked points of each variable are
+        removed from them.
+
+        :return: sparse matrix of the constrained data indices for each sample point, or None if the data is not
+         constrained
+        """
+        data_coords = data_points.coords_flattened
+        for shared_coords, all_neighbours in self._shared_neighbours:
+            if _have_same_coordinates(data_coords, shared_coords):
+                break
+        else:
+            all_points = UngriddedHyperPointView(data_coords, None)
+            data_index.reset_indexes(constraint)
+            data_index.create_indexes(constraint, points, all_points, None, data)
+            with metrics.timed('query'):
+                all_neighbours = constraint.get_neighbours(sample_points, all_points)
+            self._shared_neighbours.append((data_coords, all_neighbours))
+
+        if all_neighbours is None or data_points.data_flattened is None:
+            return all_neighbours
+        masked = np.ma.getmaskarray(data_points.data_flattened)
+        if not masked.any():
+            return all_neighbours
+        with metrics.timed('query'):
+            keep = ~masked[all_neighbours.indices]
+            kept_before = np.concatenate(([0], np.cumsum(keep)))
+            return make_neighbours_from_offsets(kept_before[all_neighbours.indptr], all_neighbours.indices[keep],
+                                                len(data_points))
+
+    def _collocate_with_neighbours(self, sample_points, data_points, kernel, values, neighbours):
+        """
+        Applies the kernel to neighbours of the sample points which have already been found.
+        """
+        metrics.add_candidate_counts(np.diff(neighbours.indptr))
+        if hasattr(kernel, 'get_values'):
+            self._apply_kernel(sample_points, data_points, kernel, values, neighbours)
+        else:
+            self._collocate_point_by_point(sample_points, data_points, None, kernel, values, neighbours)
+
+    @staticmethod
+    def _can_collocate_nearest(constraint, kernel):
+        """
+        Determines whether the kernel only needs the nearest data point satisfying the constraint, and the constraint
+        can find it directly.
+        """
+        return hasattr(kernel, 'get_values_from_nearest') and hasattr(constraint, 'get_nearest_neighbours')
+
+    def _collocate_nearest(self, sample_points, data_points, constraint, kernel, values):
+        """
+        Finds the nearest data point satisfying the constraint for all of the sample points with a single call to the
+        constraint, then gets their values with a single call to the kernel.
+
+        :return: False if the constraint can not find the nearest points, in which case no values are set
+        """
+        with metrics.timed('query'):
+            nearest = constraint.get_nearest_neighbours(sample_points, data_points)
+        if nearest is None:
+            return False
+        metrics.add_candidate_counts(nearest >= 0)
+        with metrics.timed('kernel'):
+            kernel_values = kernel.get_values_from_nearest(sample_points, data_points, nearest)
+        self._set_kernel_values(sample_points, kernel_values, values)
+        return True
+
+    @staticmethod
+    def _can_collocate_vectorised(constraint, kernel):
+        """
+        Determines whether the constraint and kernel can be applied to all of the sample points at once, rather than
+        one sample point at a time.
+        """
+        return hasattr(kernel, 'get_values') and (constraint is None or hasattr(constraint, 'get_neighbours'))
+
+    def _collocate_vectorised(self, sample_points, data_points, constraint, kernel, values):
+        """
+        Finds the neighbours of all of the sample points with a single call to the constraint, then reduces them with a
+        single call to the kernel.
+        """
+        neighbours = None
+        if constraint is not None:
+            with metrics.timed('query'):
+                neighbours = constraint.get_neighbours(sample_points, data_points)
+            if neighbours is not None:
+                metrics.add_candidate_counts(np.diff(neighbours.indptr))
+        self._apply_kernel(sample_points, data_points, kernel, values, neighbours)
+
+    def _apply_kernel(self, sample_points, data_points, kernel, values, neighbours):
+        """
+        Reduces the neighbours of all of the sample points with a single call to the kernel.
+        """
+        with metrics.timed('kernel'):
+            kernel_values = kernel.get_values(sample_points, data_points, neighbours)
+        self._set_kernel_values(sample_points, kernel_values, values)
+
+    @staticmethod
+    def _set_kernel_values(sample_points, kernel_values, values):
+        """
+        Copies the values found by the kernel for all of the sample points into the output values.
+        """
+        if sample_points.data_flattened is not None:
+            # Masked sample points keep the fill value, as for point by point collocation.
+            kernel_values[:, np.ma.getmaskarray(sample_points.data_flattened)] = np.ma.masked
+        valid = ~np.ma.getmaskarray(kernel_values)
+        values[valid] = kernel_values.data[valid]
+
+    def _collocate_point_by_point(self, sample_points, data_points, constraint, kernel, values, neighbours=None):
+        """
+        Applies the constraint and kernel to each sample point in turn. If the neighbours of the sample points have
+        already been found they are used instead of the constraint.
+        """
+        sample_points_count = len(sample_points)
+        cell_count = 0
+        total_count = 0
+        # Numbers of candidate points are only collected when metrics are being recorded.
+        candidate_counts = [] if metrics.get_metrics() is not None and constraint is not None else None
+        # Constraining each point is interleaved with the kernel, so they are timed together once for the whole loop.
+        with metrics.timed(metrics.QUERY_AND_KERNEL_PHASE):
+            for i, point in sample_points.enumerate_non_masked_points():
+                # Log progress periodically.
+                cell_count += 1
+                if cell_count == 1000:
+                    total_count += cell_count
+                    cell_count = 0
+                    logging.info("    Processed {} points of {}".format(total_count, sample_points_count))
+
+                if neighbours is not None:
+                    con_points = _get_points_by_indices(
+                        data_points, neighbours.indices[neighbours.indptr[i]:neighbours.indptr[i + 1]])
+                elif constraint is None:
+                    con_points = data_points
+                else:
+                    con_points = constraint.constrain_points(point, data_points)
+                    if candidate_counts is not None:
+                        candidate_counts.append(len(con_points))
+                try:
+                    value_obj = kernel.get_value(point, con_points)
+                    # Kernel returns either a single value or a tuple of values to insert into each output variable.
+                    if isinstance(value_obj, tuple):
+                        for idx, val in enumerate(value_obj):
+                            if not np.isnan(val):
+                                values[idx, i] = val
+                    else:
+                        values[0, i] = value_obj
+                except CoordinateMultiDimError as e:
+                    raise NotImplementedError(e)
+                except ValueError as e:
+                    pass
+        if candidate_counts is not None:
+            metrics.add_candidate_counts(candidate_counts)
+
 
 class DummyCollocator(Collocator):
     def collocate(self, points, data, constraint, kernel):
@@ -181,6 +424,10 @@ class DummyConstraint(Constraint):
         # This is a null constraint - all of the points just get passed back
         return data
 
+    def get_neighbours(self, points, data):
+        # None indicates that every data point is a neighbour of every sample point
+        return None
+
 
 class SepConstraint(PointConstraint):
     def __init__(self, h_sep=None, a_sep=None, p_sep=None, t_sep=None):
@@ -189,19 +436,24 @@ class SepConstraint(PointConstraint):
         super(SepConstraint, self).__init__()
 
         self.checks = []
+        # The same checks applied to the coordinate arrays of all of the points at once
+        self.mask_checks = []
 
         if h_sep is not None:
             self.h_sep = cis.utils.parse_distance_with_units_to_float_km(h_sep)
             self.checks.append(self.horizontal_constraint)
+            self.mask_checks.append(self.horizontal_constraint_mask)
         if a_sep is not None:
             self.a_sep = cis.utils.parse_distance_with_units_to_float_m(a_sep)
             self.checks.append(self.alt_constraint)
+            self.mask_checks.append(self.alt_constraint_mask)
         if p_sep is not None:
             try:
                 self.p_sep = float(p_sep)
             except:
                 raise InvalidCommandLineOptionError('Separation Constraint p_sep must be a valid float')
             self.checks.append(self.pressure_constraint)
+            self.mask_checks.append(self.pressure_constraint_mask)
         if t_sep is not None:
             from cis.parse_datetime import parse_datetimestr_delta_to_float_days
             try:
@@ -209,6 +461,7 @@ class SepConstraint(PointConstraint):
             except ValueError as e:
                 raise InvalidCommandLineOptionError(e)
             self.checks.append(self.time_constraint)
+            self.mask_checks.append(self.time_constraint_mask)
 
     def time_constraint(self, point, ref_point):
         return point.time_sep(ref_point) < self.t_sep
@@ -222,42 +475,106 @@ class SepConstraint(PointConstraint):
     def horizontal_constraint(self, point, ref_point):
         return point.haversine_dist(ref_point) < self.h_sep
 
+    def time_constraint_mask(self, coords, ref_point):
+        return _absolute_separation(coords[HyperPoint.TIME], ref_point.time) < self.t_sep
+
+    def alt_constraint_mask(self, coords, ref_point):
+        return _absolute_separation(coords[HyperPoint.ALTITUDE], ref_point.altitude) < self.a_sep
+
+    def pressure_constraint_mask(self, coords, ref_point):
+        return _ratio_separation(coords[HyperPoint.AIR_PRESSURE], ref_point.air_pressure) < self.p_sep
+
+    def horizontal_constraint_mask(self, coords, ref_point):
+        data_lat_lons = np.column_stack((coords[HyperPoint.LATITUDE], coords[HyperPoint.LONGITUDE]))
+        return haversine_distance(data_lat_lons, [ref_point.latitude, ref_point.longitude]) < self.h_sep
+
     def constrain_points(self, ref_point, data):
-        con_points = HyperPointList()
-        for point in data:
-            if all(check(point, ref_point) for check in self.checks):
-                con_points.append(point)
-        return con_points
+        if not isinstance(data, HyperPointView):
+            con_points = HyperPointList()
+            for point in data:
+                if all(check(point, ref_point) for check in self.checks):
+                    con_points.append(point)
+            return con_points
+
+        # Check the coordinate arrays of all of the candidate points at once, rather than making a HyperPoint for each
+        if data.non_masked_iteration:
+            candidates = data.non_masked_indices()
+        else:
+            candidates = np.arange(len(data))
+        candidate_points = data[candidates].as_batch()
+        keep = np.ones(len(candidates), dtype=bool)
+        for mask_check in self.mask_checks:
+            keep &= mask_check(candidate_points.coords, ref_point)
+        return candidate_points.filter(keep)
+
+
+def _get_spatial_index_attribute(index_type):
+    """
+    Gets the name of the attribute holding the k-D tree index of the given type. Setting this attribute to None
+    requests that the index is created before collocation.
+
+    :param index_type: 'haversine' to use a k-D tree of latitudes and longitudes with haversine distances, or
+     'unit_sphere' to use a k-D tree of 3-D unit vectors with chord distances
+    :return: attribute name
+    """
+    from cis.exceptions import InvalidCommandLineOptionError
+    index_attributes = {'haversine': 'haversine_distance_kd_tree_index',
+                        'unit_sphere': 'unit_sphere_kd_tree_index'}
+    try:
+        return index_attributes[index_type]
+    except KeyError:
+        raise InvalidCommandLineOptionError("The index_type must be one of: {}".format(
+            ', '.join(sorted(index_attributes.keys()))))
 
 
 class SepConstraintKdtree(PointConstraint):
     """A separation constraint that uses a k-D tree to optimise spatial constraining.
     If no horizontal separation parameter is supplied, this reduces to an exhaustive
     search using the other parameter(s).
+
+    The altitude, pressure and time separations are applied as boolean masks over arrays of candidate data
+    indices, so no HyperPoints are created for the data points being checked.
+
+    If a time separation is given the data are also indexed by time, and whichever of the time and horizontal
+    separations is expected to give fewer candidate points is used to find them.
+
+    The index_type parameter selects the k-D tree used for the horizontal separation: 'haversine' (the default)
+    indexes latitude and longitude, 'unit_sphere' indexes 3-D unit vectors using chord distances.
     """
 
-    def __init__(self, h_sep=None, a_sep=None, p_sep=None, t_sep=None):
+    def __init__(self, h_sep=None, a_sep=None, p_sep=None, t_sep=None, index_type='haversine'):
         from cis.exceptions import InvalidCommandLineOptionError
 
         self.haversine_distance_kd_tree_index = False
+        self.unit_sphere_kd_tree_index = False
+        index_attribute = _get_spatial_index_attribute(index_type)
 
         super(SepConstraintKdtree, self).__init__()
 
         self._index_cache = {}
+        # The spatial index the cached indices were found with
+        self._index_cache_source = None
+        self._data_coords_cache = None
+        self._horizontal_fraction_cache = None
+        self.sorted_time_index = False
         self.checks = []
+        # Pairs of (HyperPoint coordinate index, mask function) used to check arrays of candidate points
+        self.mask_checks = []
         if h_sep is not None:
             self.h_sep = cis.utils.parse_distance_with_units_to_float_km(h_sep)
-            self.haversine_distance_kd_tree_index = None
+            setattr(self, index_attribute, None)
 
         if a_sep is not None:
             self.a_sep = cis.utils.parse_distance_with_units_to_float_m(a_sep)
             self.checks.append(self.alt_constraint)
+            self.mask_checks.append((HyperPoint.ALTITUDE, self.alt_constraint_mask))
         if p_sep is not None:
             try:
                 self.p_sep = float(p_sep)
             except:
                 raise InvalidCommandLineOptionError('Separation Constraint p_sep must be a valid float')
             self.checks.append(self.pressure_constraint)
+            self.mask_checks.append((HyperPoint.AIR_PRESSURE, self.pressure_constraint_mask))
         if t_sep is not None:
             from cis.parse_datetime import parse_datetimestr_delta_to_float_days
             try:
@@ -265,6 +582,8 @@ class SepConstraintKdtree(PointConstraint):
             except ValueError as e:
                 raise InvalidCommandLineOptionError(e)
             self.checks.append(self.time_constraint)
+            self.mask_checks.append((HyperPoint.TIME, self.time_constraint_mask))
+            self.sorted_time_index = None
 
     def time_constraint(self, point, ref_point):
         return point.time_sep(ref_point) < self.t_sep
@@ -278,25 +597,199 @@ class SepConstraintKdtree(PointConstraint):
     def horizontal_constraint(self, point, ref_point):
         return point.haversine_dist(ref_point) < self.h_sep
 
+    @property
+    def spatial_index(self):
+        """The k-D tree index used for the horizontal separation, or a false value if there is none"""
+        return self.haversine_distance_kd_tree_index or self.unit_sphere_kd_tree_index
+
+    def time_constraint_mask(self, values, ref_values):
+        return np.abs(values - ref_values) < self.t_sep
+
+    def alt_constraint_mask(self, values, ref_values):
+        return np.abs(values - ref_values) < self.a_sep
+
+    def pressure_constraint_mask(self, values, ref_values):
+        return np.maximum(values, ref_values) / np.minimum(values, ref_values) < self.p_sep
+
     def constrain_points(self, ref_point, data):
-        con_points = HyperPointList()
-        if self.haversine_distance_kd_tree_index:
-            point_indices = self._get_cached_indices(ref_point)
-            if point_indices is None:
-                point_indices = self.haversine_distance_kd_tree_index.find_points_within_distance(ref_point, self.h_sep)
-                self._add_cached_indices(ref_point, point_indices)
-            for idx in point_indices:
-                point = data[idx]
-                if all(check(point, ref_point) for check in self.checks):
-                    con_points.append(point)
+        return _get_points_by_indices(data, self._constrain_point_indices(ref_point, data))
+
+    def get_neighbours(self, points, data):
+        """
+        Constrains the data for all of the sample points.
+
+        :param points: HyperPointView of the sample points
+        :param data: HyperPointView of the data points
+        :return: sparse matrix of the constrained data indices for each sample point
+        """
+        sample_coords = points.coords_flattened
+        data_coords = self._get_data_coords(data)
+        if self.spatial_index and not self._is_time_window_more_selective(sample_coords[HyperPoint.TIME], data_coords):
+            # Find the pairs for all of the sample points in one traversal, then check all of the candidates together
+            offsets, indices = self.spatial_index.find_pairs_within_distance(
+                sample_coords[HyperPoint.LATITUDE], sample_coords[HyperPoint.LONGITUDE], self.h_sep)
+            check_horizontal = False
+        elif self.sorted_time_index:
+            offsets, indices = self.sorted_time_index.find_points_within_windows(
+                self._get_sample_times(sample_coords[HyperPoint.TIME]), self.t_sep)
+            check_horizontal = bool(self.spatial_index)
         else:
-            for point in data:
-                if all(check(point, ref_point) for check in self.checks):
-                    con_points.append(point)
-        return con_points
+            candidates = data.non_masked_indices()
+            index_lists = []
+            for i in xrange(len(points)):
+                ref_coords = [None if coord is None else coord[i] for coord in sample_coords]
+                index_lists.append(candidates[self._check_candidates(ref_coords, data_coords, candidates)])
+            return make_neighbours(index_lists, len(data))
+
+        rows = np.repeat(np.arange(len(points)), np.diff(offsets))
+        if self.mask_checks or check_horizontal:
+            ref_coords = [None if coord is None else coord[rows] for coord in sample_coords]
+            keep = self._check_candidates(ref_coords, data_coords, indices, check_horizontal)
+            indices = indices[keep]
+            rows = rows[keep]
+            offsets = np.zeros(len(points) + 1, dtype=np.intp)
+            np.cumsum(np.bincount(rows, minlength=len(points)), out=offsets[1:])
+        if not check_horizontal and self.spatial_index:
+            return make_neighbours_from_offsets(offsets, indices, len(data))
+        # The time window gives the points in time order, so sort them to match the ordering from the spatial index
+        return make_neighbours_from_offsets(offsets, indices[np.lexsort((indices, rows))], len(data))
+
+    def get_nearest_neighbours(self, points, data):
+        """
+        Finds the nearest data point to each sample point which satisfies the constraint. The k-D tree is traversed
+        once for all of the sample points, bounded by the horizontal separation, with the other separations checked at
+        the leaves, so the data points within the horizontal separation are never all found.
+
+        :param points: HyperPointView of the sample points
+        :param data: HyperPointView of the data points
+        :return: array of the index into the flattened data of the nearest data point to each sample point, or -1
+         where there is none, or None if the horizontal separation is not indexed by haversine distance
+        """
+        if not self.haversine_distance_kd_tree_index:
+            return None
+        sample_coords = points.coords_flattened
+        data_coords = self._get_data_coords(data)
+        check = None
+        if self.mask_checks:
+            def check(rows, candidates):
+                ref_coords = [None if coord is None else coord[rows] for coord in sample_coords]
+                return self._check_candidates(ref_coords, data_coords, candidates)
+        indices, distances = self.haversine_distance_kd_tree_index.find_nearest_points_within_distance(
+            sample_coords[HyperPoint.LATITUDE], sample_coords[HyperPoint.LONGITUDE], self.h_sep, check)
+        indices[np.isinf(distances)] = -1
+        return indices
+
+    def _constrain_point_indices(self, ref_point, data):
+        """
+        Finds the indices of the data points satisfying the constraint for a single sample point.
+
+        :param ref_point: the sample HyperPoint
+        :param data: HyperPointView of the data points
+        :return: array of indices into the flattened data
+        """
+        data_coords = self._get_data_coords(data)
+        check_horizontal = False
+        if self.spatial_index and not self._is_time_window_more_selective([ref_point.time], data_coords):
+            candidates = self._get_cached_indices(ref_point)
+            if candidates is None:
+                candidates = np.array(self.spatial_index.find_points_within_distance(ref_point, self.h_sep),
+                                      dtype=np.intp)
+                self._add_cached_indices(ref_point, candidates)
+        elif self.sorted_time_index:
+            offsets, candidates = self.sorted_time_index.find_points_within_windows(
+                self._get_sample_times([ref_point.time]), self.t_sep)
+            candidates = np.sort(candidates)
+            check_horizontal = bool(self.spatial_index)
+        else:
+            candidates = data.non_masked_indices()
+        if not (self.mask_checks or check_horizontal):
+            return candidates
+        return candidates[self._check_candidates(ref_point, data_coords, candidates, check_horizontal)]
+
+    def _is_time_window_more_selective(self, sample_times, data_coords):
+        """
+        Determines whether finding the data points within the time separation of the sample points would give fewer
+        candidates to check than finding those within the horizontal separation.
+
+        :param sample_times: array of the sample point times
+        :param data_coords: list of flattened data coordinate arrays in HyperPoint order
+        :return: True if the time index should be used in preference to the spatial index
+        """
+        if not self.sorted_time_index:
+            return False
+        starts, counts = self.sorted_time_index.count_points_within_windows(self._get_sample_times(sample_times),
+                                                                            self.t_sep)
+        horizontal_fraction = self._get_horizontal_fraction(data_coords)
+        return counts.sum() < horizontal_fraction * len(self.sorted_time_index.indices) * len(counts)
+
+    def _get_horizontal_fraction(self, data_coords):
+        """
+        Estimates the fraction of the data points within the horizontal separation of a sample point, assuming the
+        data are spread evenly over their latitude-longitude bounding box.
+
+        :param data_coords: list of flattened data coordinate arrays in HyperPoint order
+        :return: estimated fraction
+        """
+        if self._horizontal_fraction_cache is None or self._horizontal_fraction_cache[0] is not data_coords:
+            lats = np.radians(data_coords[HyperPoint.LATITUDE])
+            lons = np.radians(data_coords[HyperPoint.LONGITUDE])
+            box_area = (np.nanmax(lons) - np.nanmin(lons)) * (np.sin(np.nanmax(lats)) - np.sin(np.nanmin(lats)))
+            cap_area = 2 * np.pi * (1 - np.cos(np.minimum(self.h_sep / RADIUS_EARTH, np.pi)))
+            fraction = np.minimum(1.0, cap_area / box_area) if box_area > 0 else 1.0
+            self._horizontal_fraction_cache = (data_coords, fraction)
+        return self._horizontal_fraction_cache[1]
+
+    @staticmethod
+    def _get_sample_times(sample_times):
+        """
+        Gets the sample point times as an array, checking that all of the points have a time.
+        """
+        if sample_times is None or (isinstance(sample_times, list) and None in sample_times):
+            raise cis.exceptions.CoordinateNotFoundError(
+                "The separation constraint requires the time coordinate on both the sample and the data")
+        return np.asarray(sample_times, dtype=np.float64)
+
+    def _check_candidates(self, ref_coords, data_coords, candidates, check_horizontal=False):
+        """
+        Applies the altitude, pressure and time separation checks to an array of candidate data points.
+
+        :param ref_coords: sequence of sample coordinate values in HyperPoint order, either scalars or arrays with a
+         value for each candidate
+        :param data_coords: list of flattened data coordinate arrays in HyperPoint order
+        :param candidates: array of candidate indices into the flattened data
+        :param check_horizontal: if True also check the horizontal separation, for candidates not found using the
+         spatial index
+        :return: boolean array which is True for the candidates satisfying all of the checks
+        """
+        keep = np.ones(len(candidates), dtype=bool)
+        for coord_index, mask_check in self.mask_checks:
+            if ref_coords[coord_index] is None or data_coords[coord_index] is None:
+                raise cis.exceptions.CoordinateNotFoundError(
+                    "The separation constraint requires the {} coordinate on both the sample and the data".format(
+                        HyperPoint.standard_names[coord_index]))
+            keep &= mask_check(data_coords[coord_index][candidates], ref_coords[coord_index])
+        if check_horizontal:
+            data_lat_lons = np.column_stack((data_coords[HyperPoint.LATITUDE][candidates],
+                                             data_coords[HyperPoint.LONGITUDE][candidates]))
+            ref_lat_lons = np.column_stack(np.broadcast_arrays(ref_coords[HyperPoint.LATITUDE],
+                                                               ref_coords[HyperPoint.LONGITUDE]))
+            keep &= haversine_distance(data_lat_lons, ref_lat_lons) <= self.h_sep
+        return keep
+
+    def _get_data_coords(self, data):
+        """
+        Gets the flattened data coordinates, reusing them across the sample points for the same data.
+        """
+        if self._data_coords_cache is None or self._data_coords_cache[0] is not data:
+            self._data_coords_cache = (data, data.coords_flattened)
+        return self._data_coords_cache[1]
 
     def _get_cached_indices(self, ref_point):
         key = ref_point[0:5]  # Don't use the value as a key (it's both irrelevant and un-hashable)
+        if self._index_cache_source is not self.spatial_index:
+            # The indices found using an index of other data points are no longer valid
+            self._index_cache = {}
+            self._index_cache_source = self.spatial_index
         try:
             return self._index_cache[key]
         except KeyError:
@@ -307,6 +800,25 @@ class SepConstraintKdtree(PointConstraint):
         self._index_cache[key] = indices
 
 
+class SepConstraintGrid(SepConstraintKdtree):
+    """A separation constraint that uses a hash grid of latitudes and longitudes, with cells sized by the horizontal
+    separation, to optimise spatial constraining. The candidate points for a sample point are those in its cell and the
+    neighbouring cells, so they are found without searching a tree. Otherwise the same as SepConstraintKdtree.
+    """
+
+    def __init__(self, h_sep=None, a_sep=None, p_sep=None, t_sep=None):
+        self.horizontal_grid_index = False
+        super(SepConstraintGrid, self).__init__(a_sep=a_sep, p_sep=p_sep, t_sep=t_sep)
+        if h_sep is not None:
+            self.h_sep = cis.utils.parse_distance_with_units_to_float_km(h_sep)
+            self.horizontal_grid_index = None
+
+    @property
+    def spatial_index(self):
+        """The grid index used for the horizontal separation, or a false value if there is none"""
+        return self.horizontal_grid_index
+
+
 # noinspection PyPep8Naming
 class mean(AbstractDataOnlyKernel):
     """
@@ -319,6 +831,19 @@ class mean(AbstractDataOnlyKernel):
         """
         return np_mean(values)
 
+    def get_values_for_data_only_in_slices(self, values, slice_starts):
+        """
+        Return the mean of each slice
+        """
+        counts = _get_slice_counts(values, slice_starts)
+        return np.ma.array([_get_slice_means(values, slice_starts, counts)])
+
+    def get_values_from_accumulators(self, accumulators):
+        """
+        Return the mean in each cell from the running totals
+        """
+        return np.array([accumulators.sum / accumulators.count])
+
 
 # noinspection PyPep8Naming
 class stddev(AbstractDataOnlyKernel):
@@ -332,6 +857,20 @@ class stddev(AbstractDataOnlyKernel):
         """
         return np_std(values, ddof=1)
 
+    def get_values_for_data_only_in_slices(self, values, slice_starts):
+        """
+        Return the standard deviation of each slice
+        """
+        counts = _get_slice_counts(values, slice_starts)
+        means = _get_slice_means(values, slice_starts, counts)
+        return np.ma.array([_get_slice_stddevs(values, slice_starts, counts, means)])
+
+    def get_values_from_accumulators(self, accumulators):
+        """
+        Return the standard deviation in each cell from the running totals
+        """
+        return np.array([_get_stddevs_from_accumulators(accumulators)])
+
 
 # noinspection PyPep8Naming,PyShadowingBuiltins
 class min(AbstractDataOnlyKernel):
@@ -345,6 +884,20 @@ class min(AbstractDataOnlyKernel):
         """
         return np_min(values)
 
+    def get_values_for_data_only_in_slices(self, values, slice_starts):
+        """
+        Return the minimum value of each slice
+        """
+        if len(slice_starts) == 0:
+            return np.ma.masked_all((1, 0))
+        return np.ma.array([np.minimum.reduceat(np.ma.getdata(values), slice_starts)])
+
+    def get_values_from_accumulators(self, accumulators):
+        """
+        Return the minimum value in each cell from the running totals
+        """
+        return np.array([accumulators.minimum])
+
 
 # noinspection PyPep8Naming,PyShadowingBuiltins
 class max(AbstractDataOnlyKernel):
@@ -358,6 +911,20 @@ class max(AbstractDataOnlyKernel):
         """
         return np_max(values)
 
+    def get_values_for_data_only_in_slices(self, values, slice_starts):
+        """
+        Return the maximum value of each slice
+        """
+        if len(slice_starts) == 0:
+            return np.ma.masked_all((1, 0))
+        return np.ma.array([np.maximum.reduceat(np.ma.getdata(values), slice_starts)])
+
+    def get_values_from_accumulators(self, accumulators):
+        """
+        Return the maximum value in each cell from the running totals
+        """
+        return np.array([accumulators.maximum])
+
 
 # noinspection PyPep8Naming
 class moments(AbstractDataOnlyKernel):
@@ -395,6 +962,78 @@ class moments(AbstractDataOnlyKernel):
 
         return np_mean(values), np_std(values, ddof=1), np.size(values)
 
+    def get_values_for_data_only_in_slices(self, values, slice_starts):
+        """
+        Returns the mean, standard deviation and number of values of each slice
+        """
+        counts = _get_slice_counts(values, slice_starts)
+        means = _get_slice_means(values, slice_starts, counts)
+        kernel_values = np.array([means, _get_slice_stddevs(values, slice_starts, counts, means), counts])
+        # As for a single slice, values which are not a number are left masked.
+        return np.ma.masked_where(np.isnan(kernel_values), kernel_values)
+
+    def get_values_from_accumulators(self, accumulators):
+        """
+        Returns the mean, standard deviation and number of values in each cell from the running totals
+        """
+        return np.array([accumulators.sum / accumulators.count, _get_stddevs_from_accumulators(accumulators),
+                         accumulators.count])
+
+
+def _get_slice_counts(values, slice_starts):
+    """
+    Counts the values in each of a number of consecutive slices of an array.
+
+    :param values: array of the values in all of the slices
+    :param slice_starts: array of the indices at which each slice starts; the last slice ends at the end of the values
+    :return: array of the number of values in each slice
+    """
+    return np.diff(np.append(slice_starts, len(values)))
+
+
+def _get_slice_means(values, slice_starts, counts):
+    """
+    Calculates the mean of each of a number of consecutive slices of an array, in double precision.
+
+    :param values: array of the values in all of the slices
+    :param slice_starts: array of the indices at which each slice starts
+    :param counts: array of the number of values in each slice
+    :return: array of the means
+    """
+    if len(slice_starts) == 0:
+        return np.zeros(0)
+    return np.add.reduceat(np.asarray(np.ma.getdata(values), dtype=np.float64), slice_starts) / counts
+
+
+def _get_slice_stddevs(values, slice_starts, counts, means):
+    """
+    Calculates the corrected sample standard deviation of each of a number of consecutive slices of an array, from
+    the deviations from the mean of each slice. This is not a number for slices with a single value.
+
+    :param values: array of the values in all of the slices
+    :param slice_starts: array of the indices at which each slice starts
+    :param counts: array of the number of values in each slice
+    :param means: array of the means of the slices
+    :return: array of the standard deviations
+    """
+    if len(slice_starts) == 0:
+        return np.zeros(0)
+    deviations = np.asarray(np.ma.getdata(values), dtype=np.float64) - np.repeat(means, counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(np.add.reduceat(deviations ** 2, slice_starts) / (counts - 1))
+
+
+def _get_stddevs_from_accumulators(accumulators):
+    """
+    Calculates the corrected sample standard deviation in each cell from running totals. This is not a number for cells
+    with fewer than two values.
+
+    :param accumulators: CellAccumulators for the cells
+    :return: array of the standard deviations
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(accumulators.sum_of_squared_deviations / (accumulators.count - 1))
+
 
 class nn_horizontal(Kernel):
     def get_value(self, point, data):
@@ -402,6 +1041,10 @@ class nn_horizontal(Kernel):
             Collocation using nearest neighbours along the face of the earth where both points and
               data are a list of HyperPoints. The default point is the first point.
         """
+        if isinstance(data, HyperPointView):
+            return _get_nearest_point_value(data, lambda coords: haversine_distance(
+                np.column_stack((coords[HyperPoint.LATITUDE], coords[HyperPoint.LONGITUDE])),
+                [point.latitude, point.longitude]))
         iterator = data.__iter__()
         try:
             nearest_point = iterator.next()
@@ -413,16 +1056,30 @@ class nn_horizontal(Kernel):
                 nearest_point = data_point
         return nearest_point.val[0]
 
+    def get_values_from_nearest(self, points, data, nearest):
+        """
+        Collocation using the nearest data points to the sample points which satisfy the constraint, found by the
+        constraint's get_nearest_neighbours.
+        """
+        return _get_values_of_nearest_points(data, nearest)
+
 
 class nn_horizontal_kdtree(Kernel):
-    def __init__(self):
-        self.haversine_distance_kd_tree_index = None
+    def __init__(self, index_type='haversine'):
+        self.haversine_distance_kd_tree_index = False
+        self.unit_sphere_kd_tree_index = False
+        setattr(self, _get_spatial_index_attribute(index_type), None)
+
+    @property
+    def spatial_index(self):
+        """The k-D tree index used to find the nearest points"""
+        return self.haversine_distance_kd_tree_index or self.unit_sphere_kd_tree_index
 
     def get_value(self, point, data):
         """
         Collocation using nearest neighbours along the face of the earth using a k-D tree index.
         """
-        nearest_index = self.haversine_distance_kd_tree_index.find_nearest_point(point)
+        nearest_index = self.spatial_index.find_nearest_point(point)
         if nearest_index is None:
             raise ValueError
         if nearest_index > len(data):
@@ -430,6 +1087,124 @@ class nn_horizontal_kdtree(Kernel):
         nearest_point = data[nearest_index]
         return nearest_point.val[0]
 
+    def get_values(self, points, data, neighbours):
+        """
+        Collocation using nearest neighbours along the face of the earth, looking up all of the sample points in the
+        k-D tree index at once. The neighbours found by any constraint are not used.
+        """
+        coords = points.coords_flattened
+        indices, distances = self.spatial_index.find_nearest_points(coords[HyperPoint.LATITUDE],
+                                                                   coords[HyperPoint.LONGITUDE])
+        found = ~np.isinf(distances)
+        values = np.ma.masked_all((1, len(points)))
+        values[0, found] = data.data_flattened[indices[found]]
+        return values
+
+    def get_values_from_nearest(self, points, data, nearest):
+        """
+        Collocation using the nearest data points to the sample points which satisfy the constraint, found by the
+        constraint's get_nearest_neighbours rather than in this kernel's index.
+        """
+        return _get_values_of_nearest_points(data, nearest)
+
+
+def _absolute_separation(values, ref_values):
+    return np.abs(values - ref_values)
+
+
+def _ratio_separation(values, ref_values):
+    return np.maximum(values, ref_values) / np.minimum(values, ref_values)
+
+
+def _get_nearest_point_value(data, get_separations):
+    """
+    Finds the value of the data point nearest to a single sample point by comparing the coordinate arrays of the data
+    points, rather than a HyperPoint for each of them. The first of several equally near points is used, as when
+    comparing HyperPoints.
+
+    :param data: HyperPointView of the data points
+    :param get_separations: function returning the separation of each of the data points from the sample point, given
+     a list of their coordinate arrays in HyperPoint order
+    :return: the data value of the nearest point
+    :raises ValueError: if there are no data points
+    """
+    if data.non_masked_iteration:
+        data = data[data.non_masked_indices()]
+    batch = data.as_batch()
+    if len(batch) == 0 or batch.data is None:
+        raise ValueError
+    separations = np.asarray(get_separations(batch.coords), dtype=np.float64)
+    separations[np.isnan(separations)] = np.inf
+    return batch.data[np.argmin(separations)]
+
+
+def _get_values_of_nearest_points(data, nearest):
+    """
+    Gets the values of the nearest data point to each sample point.
+
+    :param data: HyperPointView of the data points
+    :param nearest: array of the index into the flattened data of the nearest point to each sample point, or -1 where
+     there is none
+    :return: masked array of shape (1, number of sample points)
+    """
+    values = np.ma.masked_all((1, len(nearest)))
+    found = nearest >= 0
+    values[0, found] = data.data_flattened[nearest[found]]
+    return values
+
+
+def _get_nearest_neighbour_values(points, data, neighbours, coord_index, separation):
+    """
+    Finds the value of the nearest data point to each sample point in a single coordinate, taking the first of the
+    candidates for a sample point if several are equally near (as the point by point kernels do).
+
+    :param points: HyperPointView of the sample points
+    :param data: HyperPointView of the data points
+    :param neighbours: sparse matrix of the constrained data indices for each sample point, or None to use all of the
+     data points
+    :param coord_index: HyperPoint index of the coordinate to compare
+    :param separation: function returning the separations between arrays of data and sample coordinate values
+    :return: masked array of shape (1, number of sample points)
+    """
+    sample_values = points.coords_flattened[coord_index]
+    data_values = data.coords_flattened[coord_index]
+    if sample_values is None or data_values is None:
+        # Raise the same error as comparing HyperPoints with a missing coordinate would
+        raise TypeError(
+            "Nearest neighbour collocation requires the {} coordinate on both the sample and the data".format(
+                HyperPoint.standard_names[coord_index]))
+    values = np.ma.masked_all((1, len(points)))
+    data_flattened = data.data_flattened
+
+    if neighbours is None:
+        candidates = data.non_masked_indices()
+        if len(candidates) == 0:
+            return values
+        candidate_values = data_values[candidates]
+        # Compare each block of sample points with all of the candidates at once, limiting the memory used.
+        block_size = 1000000 // len(candidates) or 1
+        for start in xrange(0, len(points), block_size):
+            end = start + block_size
+            separations = separation(candidate_values[np.newaxis, :], sample_values[start:end, np.newaxis])
+            separations[np.isnan(separations)] = np.inf
+            values[0, start:end] = data_flattened[candidates[np.argmin(separations, axis=1)]]
+        return values
+
+    counts = np.diff(neighbours.indptr)
+    rows = np.repeat(np.arange(len(points)), counts)
+    separations = separation(data_values[neighbours.indices], sample_values[rows])
+    separations[np.isnan(separations)] = np.inf
+    found = np.flatnonzero(counts > 0)
+    if len(found) == 0:
+        return values
+    # The nearest candidate for each sample point is the first one whose separation equals the row minimum.
+    row_minimums = np.minimum.reduceat(separations, neighbours.indptr[found])
+    is_nearest = separations == np.repeat(row_minimums, counts[found])
+    nearest_positions = np.flatnonzero(is_nearest)
+    nearest_rows, first = np.unique(rows[nearest_positions], return_index=True)
+    values[0, nearest_rows] = data_flattened[neighbours.indices[nearest_positions[first]]]
+    return values
+
 
 class nn_altitude(Kernel):
     def get_value(self, point, data):
@@ -437,6 +1212,9 @@ class nn_altitude(Kernel):
             Collocation using nearest neighbours in altitude, where both points and
               data are a list of HyperPoints. The default point is the first point.
         """
+        if isinstance(data, HyperPointView):
+            return _get_nearest_point_value(
+                data, lambda coords: _absolute_separation(coords[HyperPoint.ALTITUDE], point.altitude))
         iterator = data.__iter__()
         try:
             nearest_point = iterator.next()
@@ -448,6 +1226,13 @@ class nn_altitude(Kernel):
                 nearest_point = data_point
         return nearest_point.val[0]
 
+    def get_values(self, points, data, neighbours):
+        """
+            Collocation using nearest neighbours in altitude for all of the sample points at once, comparing the
+              coordinate arrays of the constrained data points rather than HyperPoints.
+        """
+        return _get_nearest_neighbour_values(points, data, neighbours, HyperPoint.ALTITUDE, _absolute_separation)
+
 
 class nn_pressure(Kernel):
     def get_value(self, point, data):
@@ -455,6 +1240,9 @@ class nn_pressure(Kernel):
             Collocation using nearest neighbours in pressure, where both points and
               data are a list of HyperPoints. The default point is the first point.
         """
+        if isinstance(data, HyperPointView):
+            return _get_nearest_point_value(
+                data, lambda coords: _ratio_separation(coords[HyperPoint.AIR_PRESSURE], point.air_pressure))
         iterator = data.__iter__()
         try:
             nearest_point = iterator.next()
@@ -466,6 +1254,13 @@ class nn_pressure(Kernel):
                 nearest_point = data_point
         return nearest_point.val[0]
 
+    def get_values(self, points, data, neighbours):
+        """
+            Collocation using nearest neighbours in pressure for all of the sample points at once, comparing the
+              coordinate arrays of the constrained data points rather than HyperPoints.
+        """
+        return _get_nearest_neighbour_values(points, data, neighbours, HyperPoint.AIR_PRESSURE, _ratio_separation)
+
 
 class nn_time(Kernel):
     def get_value(self, point, data):
@@ -473,6 +1268,9 @@ class nn_time(Kernel):
             Collocation using nearest neighbours in time, where both points and
               data are a list of HyperPoints. The default point is the first point.
         """
+        if isinstance(data, HyperPointView):
+            return _get_nearest_point_value(
+                data, lambda coords: _absolute_separation(coords[HyperPoint.TIME], point.time))
         iterator = data.__iter__()
         try:
             nearest_point = iterator.next()
@@ -484,6 +1282,13 @@ class nn_time(Kernel):
                 nearest_point = data_point
         return nearest_point.val[0]
 
+    def get_values(self, points, data, neighbours):
+        """
+            Collocation using nearest neighbours in time for all of the sample points at once, comparing the
+              coordinate arrays of the constrained data points rather than HyperPoints.
+        """
+        return _get_nearest_neighbour_values(points, data, neighbours, HyperPoint.TIME, _absolute_separation)
+
 
 # These classes act as abbreviations for kernel classes above:
 class nn_h(nn_horizontal):
@@ -542,6 +1347,45 @@ class nn_gridded(Kernel):
 
         return val
 
+    def get_values(self, points, data, neighbours):
+        """
+        Finds the nearest grid point to all of the sample points at once. For each dimension the cell containing every
+        sample point is found, using arithmetic on the coordinate values for evenly spaced coordinates and a binary
+        search otherwise, then the data values are gathered in one go. This gives the same grid points as iris' nearest
+        neighbour lookup. On a hybrid vertical coordinate the columns of the coordinate above the nearest horizontal
+        and time grid points are gathered and the nearest level in each is found. Cubes with other dimensions of more
+        than one point which are not sampled are handled one sample point at a time.
+
+        :param points: HyperPointView of the sample points
+        :param data: cube of the data to collocate
+        :param neighbours: not used, as all of the data is used
+        :return: masked array of shape (1, number of sample points)
+        """
+        coords_and_values, hybrid_coord_and_values = _get_dim_coords_and_sample_values(points, data)
+        if hybrid_coord_and_values is not None:
+            column_dim = _get_hybrid_column_dim(data, hybrid_coord_and_values[0], coords_and_values)
+            if column_dim is None:
+                return _get_values_point_by_point(self, points, data)
+        elif all(coord_and_values is not None or length == 1
+                 for coord_and_values, length in zip(coords_and_values, data.shape)):
+            column_dim = None
+        else:
+            return _get_values_point_by_point(self, points, data)
+
+        indices = [np.zeros(len(points), dtype=np.intp) if coord_and_values is None
+                   else _get_nearest_neighbour_indices(*coord_and_values)
+                   for coord_and_values in coords_and_values]
+        if column_dim is not None:
+            hybrid_coord, sample_values = hybrid_coord_and_values
+            corners = [(indices, np.ones(len(points)))]
+            coord_dims = data.coord_dims(hybrid_coord)
+            column_points = _gather_weighted(hybrid_coord.points, coord_dims, corners, column_dim)
+            column_bounds = _gather_weighted(hybrid_coord.bounds, coord_dims, corners, column_dim) \
+                if hybrid_coord.has_bounds() else None
+            indices[column_dim] = _get_column_nearest_neighbour_indices(column_points, column_bounds, sample_values)
+        data_values = np.ma.asarray(data.data)
+        return data_values[tuple(indices)].reshape((1, len(points)))
+
 
 # noinspection PyPep8Naming
 class li(Kernel):
@@ -554,6 +1398,7 @@ class li(Kernel):
         self.hybrid_coord = ''
         self.interpolator = None
         self.extrapolation_mode = 'linear' if extrapolate else 'error'
+        self.nn_vertical = nn_vertical
         if nn_vertical:
             logging.warn("The extrapolate option is incompatible with nearest neighbour interpolation and will be "
                          "ignored for the vertical collocation")
@@ -586,14 +1431,330 @@ class li(Kernel):
             val = slice.data
         return val
 
+    def get_values(self, points, data, neighbours):
+        """
+        Interpolates the data onto all of the sample points at once. For each dimension the grid points either side of
+        every sample point and the interpolation weights are found with a binary search, then the data values at the
+        corners of the surrounding cells are gathered and weighted. On a hybrid vertical coordinate whole columns of the
+        data and of the coordinate are interpolated in this way, then the levels either side of each sample point are
+        found in its column and interpolated between. This gives the same values as iris' linear interpolation. Cubes
+        with other dimensions which are not interpolated over are interpolated one sample point at a time.
+
+        :param points: HyperPointView of the sample points
+        :param data: cube of the data to interpolate
+        :param neighbours: not used, as all of the data is used
+        :return: masked array of shape (1, number of sample points)
+        """
+        coords_and_values, hybrid_coord_and_values = _get_dim_coords_and_sample_values(points, data)
+        column_dim = None
+        if hybrid_coord_and_values is not None:
+            column_dim = _get_hybrid_column_dim(data, hybrid_coord_and_values[0], coords_and_values)
+        dims_supported = all((coord_and_values is None and (length == 1 or dim == column_dim)) or
+                             (coord_and_values is not None and length > 1)
+                             for dim, (coord_and_values, length) in enumerate(zip(coords_and_values, data.shape)))
+        if (hybrid_coord_and_values is not None and column_dim is None) or not dims_supported:
+            return _get_values_point_by_point(self, points, data)
+
+        # Find the grid indices and weights for each dimension; dimensions of length one are not interpolated over.
+        indices_and_weights = []
+        out_of_bounds = np.zeros(len(points), dtype=bool)
+        for coord_and_values in coords_and_values:
+            if coord_and_values is None:
+                indices_and_weights.append(None)
+            else:
+                lower, upper, weights, outside = _get_linear_interpolation_weights(*coord_and_values)
+                indices_and_weights.append((lower, upper, weights))
+                out_of_bounds |= outside
+
+        # Each corner of the cells is weighted by the product of the weights in each dimension.
+        corners = []
+        interpolated_dims = [dim for dim, iw in enumerate(indices_and_weights) if iw is not None]
+        for corner in itertools.product([False, True], repeat=len(interpolated_dims)):
+            corner_indices = [np.zeros(len(points), dtype=np.intp)] * data.ndim
+            corner_weights = np.ones(len(points))
+            for dim, upper_corner in zip(interpolated_dims, corner):
+                lower, upper, weights = indices_and_weights[dim]
+                corner_indices[dim] = upper if upper_corner else lower
+                corner_weights = corner_weights * (weights if upper_corner else 1 - weights)
+            corners.append((corner_indices, corner_weights))
+        # Any masked data value which contributes to a value masks it, so the absolute weights are summed.
+        mask_corners = [(corner_indices, np.abs(corner_weights)) for corner_indices, corner_weights in corners]
+
+        data_dims = range(data.ndim)
+        values = _gather_weighted(np.ma.getdata(data.data), data_dims, corners, column_dim)
+        mask_fraction = _gather_weighted(np.ma.getmaskarray(data.data), data_dims, mask_corners, column_dim)
+
+        if column_dim is not None:
+            hybrid_coord, sample_values = hybrid_coord_and_values
+            column_points = _gather_weighted(hybrid_coord.points, data.coord_dims(hybrid_coord), corners, column_dim)
+            lower, upper, weights, outside = _get_column_linear_interpolation_weights(column_points, sample_values)
+            rows = np.arange(len(points))
+            if self.nn_vertical:
+                # The nearest level, taking the lower one if the sample point is half way between them.
+                levels = np.where(weights <= 0.5, lower, upper)
+                values = values[rows, levels]
+                mask_fraction = mask_fraction[rows, levels]
+            else:
+                values = values[rows, lower] * (1 - weights) + values[rows, upper] * weights
+                mask_fraction = mask_fraction[rows, lower] * np.abs(1 - weights) + \
+                    mask_fraction[rows, upper] * np.abs(weights)
+                if self.extrapolation_mode == 'error':
+                    out_of_bounds |= outside
+
+        result = np.ma.array(values, mask=(mask_fraction > 0))
+        if self.extrapolation_mode == 'error':
+            result[out_of_bounds] = np.ma.masked
+        return result.reshape((1, len(points)))
+
+
+def _get_dim_coords_and_sample_values(points, data):
+    """
+    Matches the coordinates of the sample points to the dimension coordinates of a cube.
+
+    :param points: HyperPointView of the sample points
+    :param data: cube
+    :return: tuple of (list with an entry for each dimension of the cube, which is either a tuple of the dimension
+     coordinate and the array of sample point values for it or None if the sample points have no such coordinate,
+     tuple of the hybrid vertical coordinate of the cube and the array of sample point values for it or None if the
+     sample points are not to be collocated on a hybrid coordinate)
+    """
+    sample_coords = points.coords_flattened
+    coords_and_values = [None] * data.ndim
+    for coord_name, sample_values in zip(HyperPoint.standard_names, sample_coords):
+        if sample_values is not None:
+            dim_coords = data.coords(coord_name, dim_coords=True)
+            if len(dim_coords) > 0:
+                coords_and_values[data.coord_dims(dim_coords[0])[0]] = (dim_coords[0], sample_values)
+
+    hybrid_coord_and_values = None
+    for coord_name in ['altitude', 'air_pressure']:
+        sample_values = sample_coords[HyperPoint.standard_names.index(coord_name)]
+        hybrid_coords = data.coords(coord_name, dim_coords=False)
+        if sample_values is not None and len(hybrid_coords) > 0:
+            hybrid_coord_and_values = (hybrid_coords[0], np.asarray(sample_values, dtype=np.float64))
+            break
+    return coords_and_values, hybrid_coord_and_values
+
+
+def _get_hybrid_column_dim(data, hybrid_coord, coords_and_values):
+    """
+    Finds the dimension of a cube along which the columns of a hybrid vertical coordinate lie.
+
+    :param data: cube
+    :param hybrid_coord: the hybrid vertical coordinate
+    :param coords_and_values: list of the dimension coordinates matched to the sample points for each dimension, from
+     _get_dim_coords_and_sample_values
+    :return: the dimension, or None if there is not exactly one dimension of more than one point which is not sampled,
+     or the hybrid coordinate does not vary along it
+    """
+    unsampled_dims = [dim for dim, (coord_and_values, length) in enumerate(zip(coords_and_values, data.shape))
+                      if coord_and_values is None and length > 1]
+    if len(unsampled_dims) == 1 and unsampled_dims[0] in data.coord_dims(hybrid_coord):
+        return unsampled_dims[0]
+    return None
+
+
+def _gather_weighted(array, array_dims, corners, column_dim=None):
+    """
+    Sums the values of an array at a number of grid points (corners) for each sample point, weighted by the weight of
+    each corner.
+
+    :param array: array over some of the dimensions of a cube, with any extra dimensions (e.g. for bounds) at the end
+    :param array_dims: the dimensions of the cube which the array spans
+    :param corners: list of tuples of (list of arrays of the indices in each dimension of the cube, array of weights)
+    :param column_dim: dimension along which to take whole columns, or None
+    :return: array of shape (number of sample points, [column length,] extra dimensions of the array)
+    """
+    result = 0
+    for indices, weights in corners:
+        if column_dim is None:
+            index = tuple(indices[dim] for dim in array_dims)
+        else:
+            index = tuple(np.arange(array.shape[i])[np.newaxis, :] if dim == column_dim else indices[dim][:, np.newaxis]
+                          for i, dim in enumerate(array_dims))
+        values = np.asarray(array[index], dtype=np.float64)
+        result = result + values * weights.reshape(weights.shape + (1,) * (values.ndim - 1))
+    return result
+
+
+def _get_column_nearest_neighbour_indices(column_points, column_bounds, sample_values):
+    """
+    Finds the index of the nearest level to each sample point in its own column of a coordinate, in the same way as
+    _get_nearest_neighbour_indices but for all of the columns at once.
+
+    :param column_points: array of the coordinate values, of shape (number of sample points, column length)
+    :param column_bounds: array of the coordinate bounds, of shape (number of sample points, column length, 2), or None
+    :param sample_values: array of the sample point values of the coordinate
+    :return: array of indices into the columns
+    """
+    rows = np.arange(len(sample_values))[:, np.newaxis]
+    if column_bounds is not None:
+        bounds = np.sort(column_bounds, axis=2)
+        order = np.argsort(bounds.mean(axis=2), axis=1, kind='mergesort')
+        bounds = bounds[rows, order]
+        edges = 0.5 * (bounds[:, :-1, 1] + bounds[:, 1:, 0])
+        ties_to_upper = np.zeros(len(sample_values), dtype=bool)
+    else:
+        order = np.argsort(column_points, axis=1, kind='mergesort')
+        sorted_points = column_points[rows, order]
+        edges = 0.5 * (sorted_points[:, :-1] + sorted_points[:, 1:])
+        ties_to_upper = order[:, 0] > order[:, -1]
+
+    # Count the cell edges below each sample point, which is a search along each column.
+    sample_values = sample_values[:, np.newaxis]
+    cells = np.where(ties_to_upper, (edges <= sample_values).sum(axis=1), (edges < sample_values).sum(axis=1))
+    return order[rows[:, 0], cells]
+
+
+def _get_column_linear_interpolation_weights(column_points, sample_values):
+    """
+    Finds the levels either side of each sample point in its own column of a coordinate and the linear interpolation
+    weights, in the same way as _get_linear_interpolation_weights but for all of the columns at once.
+
+    :param column_points: array of the coordinate values, of shape (number of sample points, column length), with a
+     column length of at least two
+    :param sample_values: array of the sample point values of the coordinate
+    :return: tuple of (indices of the lower levels, indices of the upper levels, weights of the upper levels, boolean
+     array which is True for sample points outside of their column)
+    """
+    rows = np.arange(len(sample_values))
+    order = np.argsort(column_points, axis=1, kind='mergesort')
+    grid = column_points[rows[:, np.newaxis], order]
+
+    # Count the levels below each sample point, which is a search along each column.
+    lower = np.clip((grid < sample_values[:, np.newaxis]).sum(axis=1) - 1, 0, grid.shape[1] - 2)
+    lower_values = grid[rows, lower]
+    upper_values = grid[rows, lower + 1]
+    weights = (sample_values - lower_values) / (upper_values - lower_values)
+    outside = (sample_values < grid[:, 0]) | (sample_values > grid[:, -1])
+    return order[rows, lower], order[rows, lower + 1], weights, outside
+
+
+def _get_values_point_by_point(kernel, points, data):
+    """
+    Applies a gridded kernel to each of the sample points in turn.
+
+    :param kernel: kernel with a get_value method taking a single point and the cube
+    :param points: HyperPointView of the sample points
+    :param data: cube of the data to collocate
+    :return: masked array of shape (1, number of sample points)
+    """
+    values = np.ma.masked_all((1, len(points)))
+    for i, point in points.enumerate_non_masked_points():
+        try:
+            values[0, i] = kernel.get_value(point, data)
+        except CoordinateMultiDimError as e:
+            raise NotImplementedError(e)
+        except ValueError:
+            # Raised when the point is outside of the grid and extrapolation is off
+            pass
+    return values
+
+
+def _get_nearest_neighbour_indices(coord, sample_values):
+    """
+    Finds the index of the nearest grid point to each sample point along a dimension coordinate, in the same way as
+    iris' nearest neighbour lookup. If the coordinate has bounds the cells are made contiguous by moving adjacent bounds
+    to their mean, otherwise the cell boundaries are half way between the points. Points which are equally close to two
+    grid points take the one with the lower value if there are bounds, or the lower index if not. Sample points beyond
+    the ends of the coordinate take the first or last point, unless the coordinate is circular in which case they are
+    wrapped.
+
+    :param coord: 1D dimension coordinate
+    :param sample_values: array of the sample point values of the coordinate
+    :return: array of indices into the coordinate
+    """
+    sample_values = np.asarray(sample_values, dtype=np.float64)
+    if len(coord.points) == 1:
+        return np.zeros(len(sample_values), dtype=np.intp)
+
+    points = np.asarray(coord.points, dtype=np.float64)
+    if coord.has_bounds():
+        bounds = np.sort(np.asarray(coord.bounds, dtype=np.float64), axis=1)
+        order = np.argsort(bounds.mean(axis=1), kind='mergesort')
+        bounds = bounds[order]
+        edges = 0.5 * (bounds[:-1, 1] + bounds[1:, 0])
+        first, last = bounds[0, 0], bounds[-1, 1]
+        ties_to_upper = False
+    else:
+        order = np.argsort(points, kind='mergesort')
+        sorted_points = points[order]
+        edges = 0.5 * (sorted_points[:-1] + sorted_points[1:])
+        first, last = sorted_points[0], sorted_points[-1]
+        # The lowest index is the upper of two equally close points when the coordinate is decreasing.
+        ties_to_upper = order[0] > order[-1]
+
+    modulus = getattr(coord.units, 'modulus', None) or 0
+    if coord.circular and modulus:
+        # Wrap the sample values into the range covered by the cells, which extend round to meet each other.
+        start = 0.5 * (first + last - modulus)
+        sample_values = ((sample_values - start) % modulus) + start
+
+    # Cell i of the sorted points lies between cell_edges[i] and cell_edges[i + 1].
+    cell_edges = np.concatenate(([-np.inf], edges, [np.inf]))
+    spacing = (edges[-1] - edges[0]) / (len(edges) - 1) if len(edges) > 1 else 0
+    regular = spacing > 0 and np.all(np.abs(edges - (edges[0] + spacing * np.arange(len(edges)))) <=
+                                     REGULAR_GRID_TOLERANCE * spacing)
+    if regular:
+        # Find the cells directly from the distance to the first edge, then correct any that are out by one due to
+        # rounding so that points exactly on an edge give the same cell as a search would.
+        cells = (sample_values - edges[0]) / spacing
+        cells = np.floor(cells) + 1 if ties_to_upper else np.ceil(cells)
+        cells = np.clip(np.nan_to_num(cells), 0, len(edges)).astype(np.intp)
+        if ties_to_upper:
+            cells -= cell_edges[cells] > sample_values
+            cells += cell_edges[cells + 1] <= sample_values
+        else:
+            cells -= cell_edges[cells] >= sample_values
+            cells += cell_edges[cells + 1] < sample_values
+    else:
+        cells = np.searchsorted(edges, sample_values, side='right' if ties_to_upper else 'left')
+    return order[cells]
+
+
+def _get_linear_interpolation_weights(coord, sample_values):
+    """
+    Finds the grid points either side of each sample point along a dimension coordinate and the linear interpolation
+    weights, in the same way as iris' linear interpolation. Circular coordinates and those with a modulus (such as
+    longitudes) are wrapped, and decreasing coordinates are handled.
+
+    :param coord: 1D dimension coordinate with at least two points
+    :param sample_values: array of the sample point values of the coordinate
+    :return: tuple of (indices of the lower grid points, indices of the upper grid points, weights of the upper grid
+     points, boolean array which is True for sample points outside of the grid)
+    """
+    grid = np.asarray(coord.points, dtype=np.float64)
+    positions = np.arange(len(grid))
+    sample_values = np.asarray(sample_values, dtype=np.float64)
+    modulus = getattr(coord.units, 'modulus', None) or 0
+    if coord.circular:
+        # Extend the grid by one point, which refers back to the first point.
+        grid = np.append(grid, grid[0] + modulus)
+        positions = np.append(positions, 0)
+    if coord.circular or modulus:
+        # Map the sample values into a range centred on the centre of the grid.
+        offset = 0.5 * (grid.max() + grid.min() - modulus)
+        sample_values = ((sample_values - offset + modulus * 2) % modulus) + offset
+    if grid[1] < grid[0]:
+        grid = grid[::-1]
+        positions = positions[::-1]
+
+    lower = np.clip(np.searchsorted(grid, sample_values) - 1, 0, len(grid) - 2)
+    weights = (sample_values - grid[lower]) / (grid[lower + 1] - grid[lower])
+    outside = (sample_values < grid[0]) | (sample_values > grid[-1])
+    return positions[lower], positions[lower + 1], weights, outside
+
 
 class GriddedCollocator(Collocator):
-    def __init__(self, var_name='', var_long_name='', var_units='', missing_data_for_missing_sample=False):
+    def __init__(self, var_name='', var_long_name='', var_units='', missing_data_for_missing_sample=False,
+                 memory_limit=None):
         super(Collocator, self).__init__()
         self.var_name = var_name
         self.var_long_name = var_long_name
         self.var_units = var_units
         self.missing_data_for_missing_sample = missing_data_for_missing_sample
+        # Approximate limit in bytes on the memory used to interpolate the data at once, or None for no limit
+        self.memory_limit = memory_limit
 
     @staticmethod
     def _check_for_valid_kernel(kernel):
@@ -662,9 +1823,7 @@ class GriddedCollocator(Collocator):
         coord_names_and_sizes_for_output_grid = coord_names_and_sizes_for_sample_grid + \
                                                 coord_names_and_sizes_for_output_grid
 
-        # An array for the collocated data, with the correct shape
         output_shape = tuple(i[1] for i in coord_names_and_sizes_for_output_grid)
-        new_data = np.zeros(output_shape)
 
         if self.missing_data_for_missing_sample:
             output_mask = self._make_output_mask(coord_names_and_sizes_for_sample_grid, output_shape,
@@ -688,9 +1847,11 @@ class GriddedCollocator(Collocator):
         # Use the new_data array to recreate points, without the DimCoords not in the data cube
         points = iris.cube.Cube(new_points_array, dim_coords_and_dims=new_dim_coord_list)
 
-        output_cube = self._iris_interpolate(coord_names_and_sizes_for_output_grid,
-                                             coord_names_and_sizes_for_sample_grid, data,
-                                             kernel, output_mask, points)
+        with metrics.timed('kernel'):
+            output_cube = self._iris_interpolate(coord_names_and_sizes_for_output_grid,
+                                                 coord_names_and_sizes_for_sample_grid, data,
+                                                 kernel, output_mask, points)
+        metrics.add_points_processed(np.prod(output_shape))
 
         if not isinstance(output_cube, list):
             return GriddedDataList([output_cube])
@@ -721,9 +1882,8 @@ class GriddedCollocator(Collocator):
                 output_mask = np.reshape(np.repeat(points.data.mask, repeat_size), output_shape)
         return output_mask
 
-    @staticmethod
-    def _iris_interpolate(coord_names_and_sizes_for_output_grid, coord_names_and_sizes_for_sample_grid, data, kernel,
-                          output_mask, points):
+    def _iris_interpolate(self, coord_names_and_sizes_for_output_grid, coord_names_and_sizes_for_sample_grid, data,
+                          kernel, output_mask, points):
         """ Collocates using iris.analysis.interpolate
         """
         coordinate_point_pairs = []
@@ -733,6 +1893,29 @@ class GriddedCollocator(Collocator):
             coordinate_point_pairs.append((coord_names_and_sizes_for_sample_grid[j][0],
                                            points.dim_coords[j].points))
 
+        slab_dim_and_length = self._get_slab_dim_and_length(coord_names_and_sizes_for_output_grid,
+                                                             coord_names_and_sizes_for_sample_grid, data)
+        if slab_dim_and_length is None:
+            output_cube = self._interpolate_onto_sample_grid(coord_names_and_sizes_for_output_grid,
+                                                             coordinate_point_pairs, data, kernel)
+        else:
+            output_cube = self._interpolate_in_slabs(coord_names_and_sizes_for_output_grid, coordinate_point_pairs,
+                                                     data, kernel, *slab_dim_and_length)
+
+        if isinstance(output_cube, list):
+            for idx, data in enumerate(output_cube):
+                output_cube[idx].data = cis.utils.apply_mask_to_numpy_array(data.data, output_mask)
+        else:
+            output_cube.data = cis.utils.apply_mask_to_numpy_array(output_cube.data, output_mask)
+        return output_cube
+
+    @staticmethod
+    def _interpolate_onto_sample_grid(coord_names_and_sizes_for_output_grid, coordinate_point_pairs, data, kernel):
+        """
+        Interpolates a data cube onto the sample grid in one go.
+
+        :return: the interpolated cube, with its dimensions in the order of the output grid
+        """
         # The result here will be a cube with the correct dimensions for the output, so interpolated over all points
         # in coord_names_and_sizes_for_output_grid.
         output_cube = make_from_cube(data.interpolate(coordinate_point_pairs, kernel.interpolater()))
@@ -744,14 +1927,100 @@ class GriddedCollocator(Collocator):
             output_coord_lookup[coord.name()] = idx
         transpose_map = [output_coord_lookup[coord[0]] for coord in coord_names_and_sizes_for_output_grid]
         output_cube.transpose(transpose_map)
-
-        if isinstance(output_cube, list):
-            for idx, data in enumerate(output_cube):
-                output_cube[idx].data = cis.utils.apply_mask_to_numpy_array(data.data, output_mask)
-        else:
-            output_cube.data = cis.utils.apply_mask_to_numpy_array(output_cube.data, output_mask)
         return output_cube
 
+    def _get_slab_dim_and_length(self, coord_names_and_sizes_for_output_grid, coord_names_and_sizes_for_sample_grid,
+                                 data):
+        """
+        Decides whether the data need to be interpolated in slabs to keep within the memory limit, and if so how to
+        split them. The data are split along the outermost of their dimensions which are not in the sample grid, so
+        that each slab is contiguous, and which has no coordinates spanning other dimensions.
+
+        :return: tuple of (dimension of the data cube to split, number of points along it in each slab), or None if
+         the data can be interpolated in one go
+        """
+        if self.memory_limit is None:
+            return None
+
+        candidate_dims = []
+        for name, _ in coord_names_and_sizes_for_output_grid[len(coord_names_and_sizes_for_sample_grid):]:
+            dims = data.coord_dims(data.coord(name))
+            if data.shape[dims[0]] > 1 and \
+                    all(data.coord_dims(coord) == dims for coord in data.coords(contains_dimension=dims[0])):
+                candidate_dims.append(dims[0])
+        if not candidate_dims:
+            return None
+
+        dim = min(candidate_dims)
+        # The slab of data and the interpolated values, assuming both are held as double precision.
+        output_size = np.prod([size for _, size in coord_names_and_sizes_for_output_grid])
+        bytes_per_index = (output_size + np.prod(data.shape)) * np.dtype(np.float64).itemsize / float(data.shape[dim])
+        slab_length = int(np.maximum(self.memory_limit // bytes_per_index, 1))
+        if slab_length >= data.shape[dim]:
+            return None
+        return dim, slab_length
+
+    def _interpolate_in_slabs(self, coord_names_and_sizes_for_output_grid, coordinate_point_pairs, data, kernel,
+                              slab_dim, slab_length):
+        """
+        Interpolates a data cube onto the sample grid a slab at a time along one of the dimensions which are not in the
+        sample grid, copying each interpolated slab into the output array as it is completed.
+
+        :param slab_dim: the dimension of the data cube to split into slabs
+        :param slab_length: the number of points along that dimension in each slab
+        :return: the interpolated cube, with its dimensions in the order of the output grid
+        """
+        slab_coord_name = data.coord(dimensions=slab_dim, dim_coords=True).name()
+        length = data.shape[slab_dim]
+        logging.info("    Interpolating in {} slabs along {}".format(int(np.ceil(float(length) / slab_length)),
+                                                                     slab_coord_name))
+        template = None
+        output_data = None
+        for start in range(0, length, slab_length):
+            data_index = [slice(None)] * data.ndim
+            data_index[slab_dim] = slice(start, start + slab_length)
+            slab_cube = self._interpolate_onto_sample_grid(coord_names_and_sizes_for_output_grid,
+                                                           coordinate_point_pairs, data[tuple(data_index)], kernel)
+            output_dim = slab_cube.coord_dims(slab_cube.coord(slab_coord_name))[0]
+            if output_data is None:
+                template = slab_cube
+                output_shape = list(slab_cube.shape)
+                output_shape[output_dim] = length
+                output_data = np.ma.masked_all(output_shape, dtype=slab_cube.data.dtype)
+            output_index = [slice(None)] * output_data.ndim
+            output_index[output_dim] = slice(start, start + slab_length)
+            output_data[tuple(output_index)] = slab_cube.data
+            del slab_cube
+        output_data.shrink_mask()
+
+        return make_from_cube(_make_cube_like(template, output_data, data.coords(dimensions=slab_dim),
+                                              template.coord_dims(template.coord(slab_coord_name))[0]))
+
+
+def _make_cube_like(template, data, full_coords, dim):
+    """
+    Makes a cube with the same metadata and coordinates as a template cube, but which is longer along one dimension.
+
+    :param template: the cube to copy
+    :param data: the data of the new cube
+    :param full_coords: the coordinates spanning only the longer dimension, to use in place of those on the template
+    :param dim: the dimension of the template which is longer
+    :return: the new cube
+    """
+    full_coords = dict((coord.name(), coord) for coord in full_coords)
+    cube = iris.cube.Cube(data, **template.metadata._asdict())
+    for coord in template.dim_coords:
+        coord_dims = template.coord_dims(coord)
+        cube.add_dim_coord(full_coords[coord.name()].copy() if coord_dims == (dim,) else coord.copy(), coord_dims[0])
+    for coord in template.aux_coords:
+        coord_dims = template.coord_dims(coord)
+        cube.add_aux_coord(full_coords[coord.name()].copy() if coord_dims == (dim,) else coord.copy(), coord_dims)
+    for factory in template.aux_factories:
+        dependencies = dict((key, cube.coord(coord.name()) if coord is not None else None)
+                            for key, coord in factory.dependencies.items())
+        cube.add_aux_factory(factory.__class__(**dependencies))
+    return cube
+
 
 class gridded_gridded_nn(Kernel):
     def __init__(self):
@@ -782,6 +2051,9 @@ class GeneralGriddedCollocator(Collocator):
     def __init__(self, fill_value=None, var_name='', var_long_name='', var_units='',
                  missing_data_for_missing_sample=False):
         super(GeneralGriddedCollocator, self).__init__()
+        # List of (data coordinates, bin index) for each set of data coordinates, when collocating a list of data in
+        # which several variables may share the same coordinates
+        self._shared_bin_indexes = None
         if fill_value is not None:
             try:
                 self.fill_value = float(fill_value)
@@ -803,16 +2075,174 @@ class GeneralGriddedCollocator(Collocator):
         :return: GriddedDataList of collocated data
         """
         if isinstance(data, list):
-            # If data is a list then call this method recursively over each element
+            # If data is a list then call this method recursively over each element. The data points are only binned
+            # once for each set of data coordinates and the bins shared between the variables using them.
             output_list = []
-            for variable in data:
-                collocated = self.collocate(points, variable, constraint, kernel)
-                output_list.extend(collocated)
+            self._shared_bin_indexes = []
+            try:
+                for variable in data:
+                    collocated = self.collocate(points, variable, constraint, kernel)
+                    output_list.extend(collocated)
+            finally:
+                self._shared_bin_indexes = None
             return GriddedDataList(output_list)
 
         data_points = data.get_non_masked_points()
+        coord_map, coords, shape, output_coords = self._get_output_coords(points, data)
+        _fix_longitude_range(coords, data_points)
+
+        # Create index if constraint supports it.
+        if self._shared_bin_indexes is not None and hasattr(constraint, 'grid_cell_bin_index_slices') and \
+                isinstance(data_points, UngriddedHyperPointView):
+            constraint.grid_cell_bin_index_slices = self._get_shared_bin_index(coords, data, data_points, coord_map)
+        else:
+            data_index.create_indexes(constraint, coords, data_points, coord_map, data)
+        data_index.create_indexes(kernel, points, data_points, coord_map, data)
 
-        # Work out how to iterate over the cube and map HyperPoint coordinates to cube coordinates.
+        # Initialise output array as initially all masked, and set the appropriate fill value.
+        values = []
+        for i in range(kernel.return_size):
+            val = np.ma.zeros(shape)
+            val.mask = True
+            val.fill_value = self.fill_value
+            values.append(val)
+
+        if kernel.return_size == 1:
+            set_value_kernel = self._set_single_value_kernel
+        else:
+            set_value_kernel = self._set_multi_value_kernel
+
+        logging.info("--> Co-locating...")
+
+        # Numbers of candidate points are only collected when metrics are being recorded.
+        candidate_counts = [] if metrics.get_metrics() is not None else None
+        if hasattr(kernel, "get_values_for_data_only_in_slices") and hasattr(constraint, "get_slices_for_data_only"):
+            # Reduce the data in every occupied cell at once, then put the values into the grid
+            with metrics.timed('query'):
+                out_indices, data_values, slice_starts = constraint.get_slices_for_data_only(
+                    self.missing_data_for_missing_sample, data_points, points)
+            with metrics.timed('kernel'):
+                kernel_values = kernel.get_values_for_data_only_in_slices(data_values, slice_starts)
+                for val, kernel_val in zip(values, kernel_values):
+                    val[out_indices] = kernel_val
+            if candidate_counts is not None:
+                candidate_counts = np.diff(np.append(slice_starts, len(data_values)))
+        elif hasattr(kernel, "get_value_for_data_only") and hasattr(constraint, "get_iterator_for_data_only"):
+            # Iterate over constrained cells. Finding the values in each cell is interleaved with the kernel, so they
+            # are timed together.
+            with metrics.timed(metrics.QUERY_AND_KERNEL_PHASE):
+                iterator = constraint.get_iterator_for_data_only(
+                    self.missing_data_for_missing_sample, coord_map, coords, data_points, shape, points, values)
+                for out_indices, data_values in iterator:
+                    if candidate_counts is not None:
+                        candidate_counts.append(len(data_values))
+                    try:
+                        kernel_val = kernel.get_value_for_data_only(data_values)
+                        set_value_kernel(kernel_val, values, out_indices)
+                    except ValueError:
+                        # ValueErrors are raised by Kernel when there are no points to operate on.
+                        # We don't need to do anything.
+                        pass
+        else:
+            # Iterate over constrained cells
+            with metrics.timed(metrics.QUERY_AND_KERNEL_PHASE):
+                iterator = constraint.get_iterator(
+                    self.missing_data_for_missing_sample, coord_map, coords, data_points, shape, points, values)
+                for out_indices, hp, con_points in iterator:
+                    if candidate_counts is not None:
+                        candidate_counts.append(len(con_points))
+                    try:
+                        kernel_val = kernel.get_value(hp, con_points)
+                        set_value_kernel(kernel_val, values, out_indices)
+                    except ValueError:
+                        # ValueErrors are raised by Kernel when there are no points to operate on.
+                        # We don't need to do anything.
+                        pass
+
+        if candidate_counts is not None:
+            metrics.add_candidate_counts(candidate_counts)
+            metrics.add_points_processed(values[0].size)
+            metrics.add_cells(values[0].size, np.ma.count_masked(values[0]))
+
+        return self._create_output(points, data, values, coord_map, output_coords, kernel)
+
+    def accumulate(self, points, data, accumulators=None):
+        """
+        Bins data into the cells of a cube and adds them to running totals for each cell, so that data which is read in
+        a number of chunks can be aggregated without holding all of it in memory at once.
+
+        :param points: cube defining the grid cells
+        :param data: CommonData object providing the data to bin (or list of Data)
+        :param accumulators: CellAccumulators to add the data to (or list of them, one for each item in data); if None
+         new ones are created
+        :return: the CellAccumulators (or list of them)
+        """
+        if isinstance(data, list):
+            if accumulators is None:
+                accumulators = [None] * len(data)
+            self._shared_bin_indexes = []
+            try:
+                return [self.accumulate(points, variable, variable_accumulators)
+                        for variable, variable_accumulators in zip(data, accumulators)]
+            finally:
+                self._shared_bin_indexes = None
+
+        data_points = data.get_non_masked_points()
+        coord_map, coords, shape, output_coords = self._get_output_coords(points, data)
+        _fix_longitude_range(coords, data_points)
+        if accumulators is None:
+            accumulators = CellAccumulators(tuple(shape))
+
+        constraint = BinnedCubeCellOnlyConstraint()
+        if self._shared_bin_indexes is not None and isinstance(data_points, UngriddedHyperPointView):
+            constraint.grid_cell_bin_index_slices = self._get_shared_bin_index(coords, data, data_points, coord_map)
+        else:
+            data_index.create_indexes(constraint, coords, data_points, coord_map, data)
+        out_indices, data_values, slice_starts = constraint.get_slices_for_data_only(
+            self.missing_data_for_missing_sample, data_points, points)
+        accumulators.add_slices(out_indices, data_values, slice_starts)
+        return accumulators
+
+    def create_output_from_accumulators(self, points, data, accumulators, kernel):
+        """
+        Creates the output of a kernel from running totals for each cell made by accumulate. Only kernels with a
+        get_values_from_accumulators method can be used.
+
+        :param points: cube defining the grid cells
+        :param data: CommonData object (or list of Data) providing the metadata for the output, e.g. the first chunk of
+         the data which was accumulated
+        :param accumulators: CellAccumulators (or list of them, one for each item in data)
+        :param kernel: instance of a Kernel subclass with a get_values_from_accumulators method
+        :return: GriddedDataList of aggregated data
+        """
+        if isinstance(data, list):
+            output_list = []
+            for variable, variable_accumulators in zip(data, accumulators):
+                output_list.extend(self.create_output_from_accumulators(points, variable, variable_accumulators,
+                                                                        kernel))
+            return GriddedDataList(output_list)
+
+        coord_map, coords, shape, output_coords = self._get_output_coords(points, data)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            kernel_values = kernel.get_values_from_accumulators(accumulators)
+        values = []
+        for kernel_val in kernel_values:
+            # Cells with no values are left masked.
+            val = np.ma.masked_where(accumulators.count == 0, kernel_val)
+            val.fill_value = self.fill_value
+            values.append(val)
+        return self._create_output(points, data, values, coord_map, output_coords, kernel)
+
+    def _get_output_coords(self, points, data):
+        """
+        Works out how to iterate over the cube and map HyperPoint coordinates to cube coordinates, and ensures that the
+        cube coordinates have bounds.
+
+        :param points: cube defining the sample points
+        :param data: CommonData object providing data to be collocated
+        :return: tuple of (coordinate map, coordinates of the cube, shape of the coordinates to be iterated over, list
+         of those coordinates)
+        """
         coord_map = make_coord_map(points, data)
         if self.missing_data_for_missing_sample and len(coord_map) is not len(points.coords()):
             raise cis.exceptions.UserPrintableException(
@@ -836,54 +2266,21 @@ class GeneralGriddedCollocator(Collocator):
                 coord.guess_bounds()
             shape.append(coord.shape[0])
             output_coords.append(coord)
+        return coord_map, coords, shape, output_coords
 
-        _fix_longitude_range(coords, data_points)
-
-        # Create index if constraint supports it.
-        data_index.create_indexes(constraint, coords, data_points, coord_map)
-        data_index.create_indexes(kernel, points, data_points, coord_map)
-
-        # Initialise output array as initially all masked, and set the appropriate fill value.
-        values = []
-        for i in range(kernel.return_size):
-            val = np.ma.zeros(shape)
-            val.mask = True
-            val.fill_value = self.fill_value
-            values.append(val)
-
-        if kernel.return_size == 1:
-            set_value_kernel = self._set_single_value_kernel
-        else:
-            set_value_kernel = self._set_multi_value_kernel
-
-        logging.info("--> Co-locating...")
-
-        if hasattr(kernel, "get_value_for_data_only") and hasattr(constraint, "get_iterator_for_data_only"):
-            # Iterate over constrained cells
-            iterator = constraint.get_iterator_for_data_only(
-                self.missing_data_for_missing_sample, coord_map, coords, data_points, shape, points, values)
-            for out_indices, data_values in iterator:
-                try:
-                    kernel_val = kernel.get_value_for_data_only(data_values)
-                    set_value_kernel(kernel_val, values, out_indices)
-                except ValueError:
-                    # ValueErrors are raised by Kernel when there are no points to operate on.
-                    # We don't need to do anything.
-                    pass
-        else:
-            # Iterate over constrained cells
-            iterator = constraint.get_iterator(
-                self.missing_data_for_missing_sample, coord_map, coords, data_points, shape, points, values)
-            for out_indices, hp, con_points in iterator:
-                try:
-                    kernel_val = kernel.get_value(hp, con_points)
-                    set_value_kernel(kernel_val, values, out_indices)
-                except ValueError:
-                    # ValueErrors are raised by Kernel when there are no points to operate on.
-                    # We don't need to do anything.
-                    pass
+    def _create_output(self, points, data, values, coord_map, output_coords, kernel):
+        """
+        Constructs the output cubes containing the collocated data.
 
-        # Construct an output cube containing the collocated data.
+        :param points: cube defining the sample points
+        :param data: CommonData object that was collocated
+        :param values: list of masked arrays of the collocated values, one for each value returned by the kernel
+        :param coord_map: list of tuples relating index in HyperPoint to index in coords and in coords to be iterated
+         over
+        :param output_coords: list of the coordinates iterated over
+        :param kernel: the kernel used
+        :return: GriddedDataList of collocated data
+        """
         kernel_var_details = kernel.get_variable_details(data.var_name, data.long_name, data.standard_name, data.units)
         output = GriddedDataList([])
         for idx, val in enumerate(values):
@@ -909,6 +2306,30 @@ class GeneralGriddedCollocator(Collocator):
 
         return output
 
+    def _get_shared_bin_index(self, coords, data, data_points, coord_map):
+        """
+        Gets an index of the non-masked data points in the grid cells. All of the data points are binned only once for
+        each set of data coordinates, then the masked points of each variable are excluded from the bins.
+
+        :return: GridCellBinIndexInSlices
+        """
+        data_coords = data_points.coords_flattened
+        for shared_coords, all_points_index in self._shared_bin_indexes:
+            if _have_same_coordinates(data_coords, shared_coords):
+                break
+        else:
+            all_points_index = data_index.create_index(data_index.GridCellBinIndexInSlices, coords,
+                                                       UngriddedHyperPointView(data_points.coords, None), coord_map,
+                                                       data)
+            self._shared_bin_indexes.append((data_coords, all_points_index))
+
+        if data_points.data is None:
+            return all_points_index
+        masked = np.ma.getmaskarray(data_points.data)
+        if not masked.any():
+            return all_points_index
+        return all_points_index.excluding_points(masked)
+
     def _set_multi_value_kernel(self, kernel_val, values, indices):
         # This kernel returns multiple values:
         for idx, val in enumerate(kernel_val):
@@ -946,25 +2367,68 @@ class GeneralGriddedCollocator(Collocator):
 
 class CubeCellConstraint(CellConstraint):
     """Constraint for constraining HyperPoints to be within an iris.coords.Cell.
+
+    When used by a collocator which creates indexes the points are binned into the cells once, as for
+    BinningCubeCellConstraint, rather than every point being checked against every cell.
     """
 
+    def __init__(self):
+        super(CubeCellConstraint, self).__init__()
+        self.grid_cell_bin_index = None
+
     def constrain_points(self, sample_point, data):
         """Returns HyperPoints lying within a cell.
         :param sample_point: HyperPoint of cells defining sample region
         :param data: list of HyperPoints to check
         :return: HyperPointList of points found within cell
         """
-        con_points = HyperPointList()
-        for point in data:
-            include = True
-            for idx in xrange(HyperPoint.number_standard_names):
-                cell = sample_point[idx]
-                if cell is not None:
-                    if not (np.min(cell.bound) <= point[idx] < np.max(cell.bound)):
-                        include = False
-            if include:
-                con_points.append(point)
-        return con_points
+        if not isinstance(data, HyperPointView):
+            con_points = HyperPointList()
+            for point in data:
+                include = True
+                for idx in xrange(HyperPoint.number_standard_names):
+                    cell = sample_point[idx]
+                    if cell is not None:
+                        if not (np.min(cell.bound) <= point[idx] < np.max(cell.bound)):
+                            include = False
+                if include:
+                    con_points.append(point)
+            return con_points
+
+        # Check all of the points against the cell at once
+        data_coords = data.coords_flattened
+        include = np.ones(len(data), dtype=bool)
+        for idx in xrange(HyperPoint.number_standard_names):
+            cell = sample_point[idx]
+            if cell is not None:
+                include &= (np.min(cell.bound) <= data_coords[idx]) & (data_coords[idx] < np.max(cell.bound))
+        if data.non_masked_iteration:
+            include &= ~np.ma.getmaskarray(data.data_flattened)
+        return _get_points_by_indices(data, np.flatnonzero(include))
+
+    def get_iterator(self, missing_data_for_missing_sample, coord_map, coords, data_points, shape, points, output_data):
+        if self.grid_cell_bin_index is None:
+            return super(CubeCellConstraint, self).get_iterator(missing_data_for_missing_sample, coord_map, coords,
+                                                                data_points, shape, points, output_data)
+        return _get_binned_cell_iterator(self.grid_cell_bin_index, missing_data_for_missing_sample, coord_map,
+                                         coords, data_points, shape, points, output_data)
+
+    def get_iterator_for_data_only(self, missing_data_for_missing_sample, coord_map, coords, data_points, shape, points,
+                                   values):
+        """
+        Iterates over the output indices and data values of each occupied cell, see
+        :meth:`.BinnedCubeCellOnlyConstraint.get_iterator_for_data_only`.
+        """
+        return _get_iterator_for_data_only(self.grid_cell_bin_index, missing_data_for_missing_sample, data_points,
+                                           points)
+
+    def get_slices_for_data_only(self, missing_data_for_missing_sample, data_points, points):
+        """
+        Gets the data values in all of the occupied cells at once, see
+        :meth:`.BinnedCubeCellOnlyConstraint.get_slices_for_data_only`.
+        """
+        return _get_slices_for_data_only(self.grid_cell_bin_index, missing_data_for_missing_sample, data_points,
+                                         points)
 
 
 class BinningCubeCellConstraint(IndexedConstraint):
@@ -987,11 +2451,77 @@ class BinningCubeCellConstraint(IndexedConstraint):
         :return: HyperPointList of points found within cell
         """
         point_list = self.grid_cell_bin_index.get_points_by_indices(sample_point)
-        con_points = HyperPointList()
-        if point_list is not None:
-            for point in point_list:
-                con_points.append(data[point])
-        return con_points
+        if point_list is None:
+            return HyperPointList()
+        return _get_points_by_indices(data, point_list)
+
+    def get_iterator(self, missing_data_for_missing_sample, coord_map, coords, data_points, shape, points, output_data):
+        return _get_binned_cell_iterator(self.grid_cell_bin_index, missing_data_for_missing_sample, coord_map,
+                                         coords, data_points, shape, points, output_data)
+
+    def get_iterator_for_data_only(self, missing_data_for_missing_sample, coord_map, coords, data_points, shape, points,
+                                   values):
+        """
+        Iterates over the output indices and data values of each occupied cell, see
+        :meth:`.BinnedCubeCellOnlyConstraint.get_iterator_for_data_only`.
+        """
+        return _get_iterator_for_data_only(self.grid_cell_bin_index, missing_data_for_missing_sample, data_points,
+                                           points)
+
+    def get_slices_for_data_only(self, missing_data_for_missing_sample, data_points, points):
+        """
+        Gets the data values in all of the occupied cells at once, see
+        :meth:`.BinnedCubeCellOnlyConstraint.get_slices_for_data_only`.
+        """
+        return _get_slices_for_data_only(self.grid_cell_bin_index, missing_data_for_missing_sample, data_points,
+                                         points)
+
+
+def _get_points_by_indices(data, indices):
+    """
+    Gets some of the data points. For HyperPointViews this gives a HyperPointBatch of the points rather than making a
+    HyperPoint for each of them.
+
+    :param data: HyperPointView (or list of HyperPoints) of the data points
+    :param indices: array of the indices of the points to get
+    :return: HyperPointBatch or HyperPointList of the points
+    """
+    if isinstance(data, HyperPointView):
+        return data[np.asarray(indices, dtype=np.intp)]
+    return HyperPointList([data[idx] for idx in indices])
+
+
+def _get_binned_cell_iterator(index, missing_data_for_missing_sample, coord_map, coords, data_points, shape, points,
+                              output_data):
+    """
+    Iterates over every cell of the grid, as :meth:`.IndexedConstraint.get_iterator` does, looking up the data points
+    in each cell in a GridCellBinIndex.
+
+    :return: Iterator which iterates through (sample indices, hyper point and constrained points)
+    """
+    if missing_data_for_missing_sample:
+        iterator = index_iterator_for_non_masked_data(shape, points)
+    else:
+        iterator = index_iterator_nditer(shape, output_data[0])
+
+    # The points in each cell are consecutive in the sorted order
+    if isinstance(data_points, UngriddedHyperPointView):
+        sorted_points = data_points[index.sort_order]
+    else:
+        sorted_points = None
+
+    for indices in iterator:
+        hp_values = [None] * HyperPoint.number_standard_names
+        for (hpi, ci, shi) in coord_map:
+            hp_values[hpi] = coords[ci].points[indices[shi]]
+        hp = HyperPoint(*hp_values)
+
+        cell_slice = index.get_cell_slice(indices)
+        if sorted_points is not None:
+            constrained_points = sorted_points[cell_slice]
+        else:
+            constrained_points = HyperPointList([data_points[idx] for idx in index.sort_order[cell_slice]])
+        yield indices, hp, constrained_points
 
 
 class BinnedCubeCellOnlyConstraint(Constraint):
@@ -1012,13 +2542,10 @@ class BinnedCubeCellOnlyConstraint(Constraint):
 
         for out_indices, slice_start_end in self.grid_cell_bin_index_slices.get_iterator():
             if not missing_data_for_missing_sample or points.data[out_indices] is not np.ma.masked:
-                # iterate through the points which are within the same cell
-
-                con_points = HyperPointList()
+                # take the points which are within the same cell
                 slice_indicies = slice(*slice_start_end)
-
-                for x in self.grid_cell_bin_index_slices.sort_order[slice_indicies]:
-                    con_points.append(data_points[x])
+                con_points = _get_points_by_indices(data_points,
+                                                    self.grid_cell_bin_index_slices.sort_order[slice_indicies])
 
                 hp_values = [None] * HyperPoint.number_standard_names
                 for (hpi, ci, shi) in coord_map:
@@ -1043,16 +2570,64 @@ class BinnedCubeCellOnlyConstraint(Constraint):
         :param values: Not needed
         :return: Iterator which iterates through (sample indices and data slice) to be placed in these points
         """
-        data_points_sorted = data_points.data[self.grid_cell_bin_index_slices.sort_order]
-        if missing_data_for_missing_sample:
-            for out_indices, slice_start_end in self.grid_cell_bin_index_slices.get_iterator():
-                if points.data[out_indices] is not np.ma.masked:
-                    data_slice = data_points_sorted[slice(*slice_start_end)]
-                    yield out_indices, data_slice
-        else:
-            for out_indices, slice_start_end in self.grid_cell_bin_index_slices.get_iterator():
-                data_slice = data_points_sorted[slice(*slice_start_end)]
-                yield out_indices, data_slice
+        return _get_iterator_for_data_only(self.grid_cell_bin_index_slices, missing_data_for_missing_sample,
+                                           data_points, points)
+
+    def get_slices_for_data_only(self, missing_data_for_missing_sample, data_points, points):
+        """
+        Gets the data values in all of the occupied cells at once, as consecutive slices of a single array, for kernels
+        which can reduce them all together.
+
+        :param missing_data_for_missing_sample: If true, cells where the sample data is missing are left out
+        :param data_points: The (non-masked) data points
+        :param points: The original points object, these are the points to collocate
+        :return: tuple of (tuple of arrays of the output indices of each slice, array of data values sorted by cell,
+         array of the index in the data values at which each slice starts)
+        """
+        return _get_slices_for_data_only(self.grid_cell_bin_index_slices, missing_data_for_missing_sample,
+                                         data_points, points)
+
+
+def _get_iterator_for_data_only(index, missing_data_for_missing_sample, data_points, points):
+    """
+    Iterates over the output indices and data values of each occupied cell of a bin index.
+
+    :param index: GridCellBinIndexInSlices of the data points
+    :param missing_data_for_missing_sample: If true, cells where the sample data is missing are left out
+    :param data_points: The (non-masked) data points
+    :param points: The original points object, these are the points to collocate
+    :return: Iterator which iterates through (sample indices and data slice)
+    """
+    data_points_sorted = data_points.data_flattened[index.sort_order]
+    for out_indices, slice_start_end in index.get_iterator():
+        if not missing_data_for_missing_sample or points.data[out_indices] is not np.ma.masked:
+            yield out_indices, data_points_sorted[slice(*slice_start_end)]
+
+
+def _get_slices_for_data_only(index, missing_data_for_missing_sample, data_points, points):
+    """
+    Gets the data values in all of the occupied cells of a bin index at once, as consecutive slices of a single array.
+
+    :param index: GridCellBinIndexInSlices of the data points
+    :param missing_data_for_missing_sample: If true, cells where the sample data is missing are left out
+    :param data_points: The (non-masked) data points
+    :param points: The original points object, these are the points to collocate
+    :return: tuple of (tuple of arrays of the output indices of each slice, array of data values sorted by cell,
+     array of the index in the data values at which each slice starts)
+    """
+    out_indices, slice_starts = index.get_cell_slices()
+    counts = np.diff(np.append(slice_starts, len(index.sort_order)))
+    if missing_data_for_missing_sample:
+        keep = ~np.ma.getmaskarray(points.data)[out_indices]
+    else:
+        keep = np.ones(len(slice_starts), dtype=bool)
+
+    # Take the data in the cells which are kept, in order of cell
+    in_grid_start = slice_starts[0] if len(slice_starts) > 0 else len(index.sort_order)
+    order = index.sort_order[in_grid_start:][np.repeat(keep, counts)]
+    counts = counts[keep]
+    return tuple(indices[keep] for indices in out_indices), np.ma.getdata(data_points.data_flattened)[order], \
+        np.cumsum(counts) - counts
 
 
 def make_coord_map(points, data):
@@ -1118,11 +2693,89 @@ def _find_longitude_range(coords):
     return low
 
 
+def _have_same_coordinates(coords, other_coords):
+    """Determines whether two sets of flattened coordinates are the same.
+    :param coords: list of flattened coordinate arrays (or None) in HyperPoint order
+    :param other_coords: list of flattened coordinate arrays (or None) in HyperPoint order
+    :return: True if the coordinates are the same
+    """
+    for coord, other_coord in zip(coords, other_coords):
+        if coord is other_coord:
+            continue
+        if coord is None or other_coord is None or not np.array_equal(coord, other_coord):
+            return False
+    return True
+
+
 def _fix_longitude_range(coords, data_points):
     """Sets the longitude range of the data points to match that of the sample coordinates.
     :param coords: coordinates for grid on which to collocate
     :param data_points: HyperPointList or GriddedData of data to fix
     """
-    range_start = _find_longitude_range(coords)
-    if range_start is not None:
-        data_points.set_longitude_range(range_start)
+    with metrics.timed('fix_longitudes'):
+        range_start = _find_longitude_range(coords)
+        if range_start is not None:
+            data_points.set_longitude_range(range_start)
+
+
+def _crop_to_sample_envelope(sample_points, data_points, constraint):
+    """
+    Crops the data points to the envelope of the sample points (the range of each coordinate) widened by the
+    separations of the constraint. Data points outside the envelope can not satisfy the constraint for any sample point.
+    Longitudes are compared modulo 360 degrees, and are not cropped if the horizontal separation reaches a pole.
+
+    :param sample_points: HyperPointView of the sample points
+    :param data_points: HyperPointView of the data points
+    :param constraint: the constraint, whose h_sep, a_sep, p_sep and t_sep separations are used if it has them
+    :return: HyperPointView of the data points in the envelope, which is data_points itself if none are removed
+    """
+    sample_coords = sample_points.coords_flattened
+    data_coords = data_points.coords_flattened
+    keep = np.ones(len(data_points), dtype=bool)
+
+    def get_sample_range(coord_index):
+        if sample_coords[coord_index] is None or data_coords[coord_index] is None:
+            return None
+        values = np.ma.masked_invalid(np.ma.asarray(sample_coords[coord_index], dtype=np.float64)).compressed()
+        if len(values) == 0:
+            return None
+        return values.min(), values.max()
+
+    def keep_within(coord_index, lower, upper):
+        values = np.ma.asarray(data_coords[coord_index])
+        # Points with a masked coordinate are kept for the constraint to deal with.
+        keep[:] &= np.ma.filled((values >= lower) & (values <= upper), True)
+
+    h_sep = getattr(constraint, 'h_sep', None)
+    lat_range = get_sample_range(HyperPoint.LATITUDE) if h_sep is not None else None
+    lon_range = get_sample_range(HyperPoint.LONGITUDE) if h_sep is not None else None
+    if lat_range is not None and lon_range is not None:
+        angle = h_sep / RADIUS_EARTH * (1 + ENVELOPE_TOLERANCE)
+        keep_within(HyperPoint.LATITUDE, lat_range[0] - np.degrees(angle), lat_range[1] + np.degrees(angle))
+        # The longitudes within the separation of a point are furthest from its own at the highest latitude.
+        sin_lon_sep = np.sin(angle) / np.cos(np.radians(np.maximum(np.abs(lat_range[0]), np.abs(lat_range[1]))))
+        if angle < np.pi / 2 and sin_lon_sep < 1:
+            lon_sep = np.degrees(np.arcsin(sin_lon_sep))
+            width = lon_range[1] - lon_range[0] + 2 * lon_sep
+            if width < 360:
+                keep[:] &= np.ma.filled(np.mod(np.ma.asarray(data_coords[HyperPoint.LONGITUDE]) -
+                                               (lon_range[0] - lon_sep), 360) <= width, True)
+
+    for coord_index, separation_name in ((HyperPoint.ALTITUDE, 'a_sep'), (HyperPoint.TIME, 't_sep')):
+        separation = getattr(constraint, separation_name, None)
+        sample_range = get_sample_range(coord_index) if separation is not None else None
+        if sample_range is not None:
+            margin = separation * (1 + ENVELOPE_TOLERANCE)
+            keep_within(coord_index, sample_range[0] - margin, sample_range[1] + margin)
+
+    p_sep = getattr(constraint, 'p_sep', None)
+    pressure_range = get_sample_range(HyperPoint.AIR_PRESSURE) if p_sep is not None else None
+    if pressure_range is not None and pressure_range[0] > 0:
+        ratio = p_sep * (1 + ENVELOPE_TOLERANCE)
+        keep_within(HyperPoint.AIR_PRESSURE, pressure_range[0] / ratio, pressure_range[1] * ratio)
+
+    pruned = len(keep) - np.count_nonzero(keep)
+    if pruned == 0:
+        return data_points
+    logging.info("    Removed {} of {} data points outside the range of the sample points".format(pruned, len(keep)))
+    return data_points[np.flatnonzero(keep)]
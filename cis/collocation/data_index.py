@@ -2,14 +2,22 @@
 Indexes over data used for fast lookup when collocating.
 """
 import logging
-import math
-import datetime
+from time import time
 
 import numpy as np
 import numpy.ma as ma
+from scipy.sparse import coo_matrix
 
-from cis.collocation.haversinedistancekdtreeindex import HaversineDistanceKDTreeIndex
-from cis.time_util import convert_obj_to_standard_date_array
+from cis.collocation import metrics
+from cis.collocation.haversinedistancekdtreeindex import HaversineDistanceKDTreeIndex, expand_ranges
+from cis.collocation.horizontalgridindex import HorizontalGridIndex
+from cis.collocation.unitspherekdtreeindex import UnitSphereKDTreeIndex
+from cis.data_io.hyperpoint import HyperPoint
+from cis.exceptions import CoordinateNotFoundError
+
+# Points are sorted into grid cells using a counting sort, which takes time proportional to the number of points plus
+# the number of cells, unless the grid has more than this many cells per point, when they are sorted by comparison.
+MAX_CELLS_PER_POINT_FOR_COUNTING_SORT = 4
 
 
 class GridCellBinIndexInSlices(object):
@@ -27,9 +35,21 @@ class GridCellBinIndexInSlices(object):
         # e.g. cell_slices_index[0] = [0, 2] would be points 0, 1 and 2 are in the first cell
         self.cell_slices_indices = None
 
+        # index in the sorted data of the first point in each occupied cell, in order of cell number
+        self.slice_starts = None
+
         # hyper point cordinates list
         self.hp_coords = None
 
+        # shape of the grid
+        self.grid_shape = None
+
+        # multiplier of each grid index in the cell number
+        self._cell_strides = None
+
+        # cell number of each occupied cell, in order, for looking up single cells
+        self._occupied_cell_numbers = None
+
     def index_data(self, coords, hyper_points, coord_map):
         """
         Index the data that falls inside the grid cells
@@ -45,7 +65,8 @@ class GridCellBinIndexInSlices(object):
         coord_descreasing = [False] * len(coords)
         coord_lengths = [0] * len(coords)
         lower_bounds = [None] * len(coords)
-        max_bounds = [None] * len(coords)
+        upper_bounds = [None] * len(coords)
+        hp_coords_flattened = hyper_points.coords_flattened
         for (hpi, ci, shi) in coord_map:
             coord = coords[ci]
             # Coordinates must be monotonic; determine whether increasing or decreasing.
@@ -55,42 +76,29 @@ class GridCellBinIndexInSlices(object):
             coord_lengths[shi] = len(coord.points)
             if coord_descreasing[shi]:
                 lower_bounds[shi] = coord.bounds[::-1, 1]
-                max_bounds[shi] = coord.bounds[0, 1]
+                upper_bounds[shi] = coord.bounds[::-1, 0]
             else:
                 lower_bounds[shi] = coord.bounds[::, 0]
-                max_bounds[shi] = coord.bounds[-1, 1]
-
-            hp_coord = hyper_points.coords[hpi]
-            if isinstance(hp_coord[0], datetime.datetime):
-                hp_coord = convert_obj_to_standard_date_array(hp_coord)
+                upper_bounds[shi] = coord.bounds[::, 1]
 
-            hp_coords.append(hp_coord)
+            hp_coords.append(hp_coords_flattened[hpi])
 
-        bounds_coords_max = zip(lower_bounds, hp_coords, max_bounds)
+        bounds_coords = zip(lower_bounds, upper_bounds, hp_coords)
 
-        # stack for each coordinate
-        #    where the coordinate is larger than the maximum set to -1
-        #    otherwise search in the sorted coordinate to find all the index of the hyperpoints
-        # The choice of 'left' or 'right' and '<' and '<=' determines which
-        #  cell is chosen when the coordinate is equal to the boundary.
-        # -1 or M_i indicates the point is outside the grid.
+        # stack for each coordinate the index of the cell each hyperpoint lies in, or -1 if it is outside the grid
+        # (including in any gap between cells whose bounds are not contiguous).
         # Output is a list of coordinates which lists the indexes where the hyper points
         #    should be located in the grid
-        indices = np.vstack(
-            np.where(
-                ci < max_coordinate_value,
-                np.searchsorted(bi, ci, side='right') - 1,
-                -1)
-            for bi, ci, max_coordinate_value in bounds_coords_max)
+        indices = np.vstack(_find_cells(bi, ui, ci) for bi, ui, ci in bounds_coords)
 
         # D-tuple giving the shape of the output grid
-        grid_shape = tuple(len(bi_ci[0]) for bi_ci in bounds_coords_max)
+        grid_shape = tuple(len(bi_ui_ci[0]) for bi_ui_ci in bounds_coords)
 
         # shape (N,) telling which points actually fall within the grid,
         # i.e. have indexes that are not -1 and are not masked data points
         grid_mask = np.all(
             (indices >= 0) &
-            (ma.getmaskarray(hyper_points.data) == False),
+            (ma.getmaskarray(hyper_points.data_flattened) == False),
             axis=0)
 
         # if the coordinate was decreasing then correct the indices for this cell
@@ -106,18 +114,26 @@ class GridCellBinIndexInSlices(object):
         #
         # Possibly numpy.lexsort could be used to avoid the need for this,
         # although we'd have to be careful about points outside the grid.
+        self.grid_shape = grid_shape
+        self._cell_strides = np.cumproduct((1,) + grid_shape[:-1])
         self.cell_numbers = np.where(
             grid_mask,
             np.tensordot(
-                np.cumproduct((1,) + grid_shape[:-1]),
+                self._cell_strides,
                 indices,
                 axes=1
             ),
             -1)
 
         # Sort everything by cell number
-        self.sort_order = np.argsort(self.cell_numbers)
-        self.cell_numbers = self.cell_numbers[self.sort_order]
+        num_cells = int(np.prod(grid_shape))
+        if num_cells <= MAX_CELLS_PER_POINT_FOR_COUNTING_SORT * len(self.cell_numbers):
+            self.sort_order, self.slice_starts = _counting_sort_by_cell(self.cell_numbers, num_cells)
+            self.cell_numbers = self.cell_numbers[self.sort_order]
+        else:
+            self.sort_order = np.argsort(self.cell_numbers)
+            self.cell_numbers = self.cell_numbers[self.sort_order]
+            self.slice_starts = _get_slice_starts(self.cell_numbers)
         self._indices = indices[:, self.sort_order]
         self.hp_coords = [hp_coord[self.sort_order] for hp_coord in hp_coords]
 
@@ -131,142 +147,304 @@ class GridCellBinIndexInSlices(object):
         :return: an iterator out_indices, cell_slice_indices
         """
 
-        # find the index at which the cell number changes, +1 to make this the first point with the new
-        # cell number
-        indexes_of_first_element_in_slice = np.flatnonzero(np.diff(self.cell_numbers)) + 1
-
         # shape (L,2) giving the pairs (first, last+1) of indices such that
         # cell_numbers[first:last+1] is the slice of all the elements of each
-        # of the L unique values.
-
-        # if some of the points are not in the grid skip these
-        if self.cell_numbers[0] == -1:
-            # if there are no points in the grid (all -1s)
-            if indexes_of_first_element_in_slice.size == 0:
-                self.cell_slices_indices = []
-            else:
-                # for list of start stop indexes starting at first point in the grid
-                self.cell_slices_indices = np.concatenate((
-                    indexes_of_first_element_in_slice[:1],
-                    np.tile(indexes_of_first_element_in_slice[1:], 2),
-                    [len(self.cell_numbers)]
-                )).reshape(2, -1).T
-        else:
-            # create list of start stop indexes starting at 0
-            self.cell_slices_indices = np.concatenate((
-                [0],  # start at first element
-                np.tile(indexes_of_first_element_in_slice, 2),
-                [len(self.cell_numbers)]  # last at first element
-            )).reshape(2, -1).T  # reshape so that it is list of start-end indices
+        # of the L occupied cells.
+        self.cell_slices_indices = np.column_stack((self.slice_starts,
+                                                    np.append(self.slice_starts[1:], len(self.cell_numbers))))
 
         # iterate around slices
         for cell_slice_indices in self.cell_slices_indices:
             out_indices = tuple(self._indices[:, cell_slice_indices[0]])
             yield out_indices, cell_slice_indices
 
+    def get_cell_slices(self):
+        """
+        Gets the occupied cells and the slices through the sorted points which lie in each of them, as arrays rather
+        than an iterator. The points outside the grid come first in the sorted order, so the points in the grid run from
+        the start of the first slice to the end.
+
+        :return: tuple of (tuple of arrays of the grid indices of the occupied cells in each dimension, array of the
+         index in the sorted points at which the slice for each cell starts)
+        """
+        return tuple(self._indices[:, self.slice_starts]), self.slice_starts
+
+    def excluding_points(self, exclude):
+        """
+        Creates a copy of the index in which some of the points are treated as being outside the grid, e.g. those with
+        masked values in one of several variables sharing the same coordinates. This avoids binning the points again.
+
+        :param exclude: boolean array which is True for the points to exclude, in the order of the indexed points
+        :return: new GridCellBinIndexInSlices
+        """
+        keep = ~exclude[self.sort_order]
+        # The excluded points go to the start of the order with the points outside the grid; the order of the other
+        # points is unchanged so they stay sorted by cell number
+        order = np.concatenate((np.flatnonzero(~keep), np.flatnonzero(keep)))
+        index = self.__class__()
+        index.grid_shape = self.grid_shape
+        index._cell_strides = self._cell_strides
+        index.sort_order = self.sort_order[order]
+        index.cell_numbers = np.where(keep, self.cell_numbers, -1)[order]
+        index._indices = self._indices[:, order]
+        index.hp_coords = [hp_coord[order] for hp_coord in self.hp_coords]
+        index.slice_starts = _get_slice_starts(index.cell_numbers)
+        return index
+
+    def get_metrics(self):
+        """
+        :return: dictionary of the number of cells in the grid, the number of them with points in and the largest
+         number of points in a cell
+        """
+        slice_ends = np.append(self.slice_starts[1:], len(self.cell_numbers))
+        cell_sizes = slice_ends - self.slice_starts
+        return {'cells': int(np.prod(self.grid_shape)),
+                'occupied_cells': len(self.slice_starts),
+                'largest_cell': int(cell_sizes.max()) if len(cell_sizes) > 0 else 0}
+
+    def get_cell_slice(self, indices):
+        """
+        Gets the slice through the sorted points of those which lie in a single cell.
+
+        :param indices: grid indices of the cell
+        :return: slice through sort_order, which is empty if there are no points in the cell
+        """
+        if self._occupied_cell_numbers is None:
+            self._occupied_cell_numbers = self.cell_numbers[self.slice_starts]
+        cell_number = np.dot(self._cell_strides, indices)
+        position = np.searchsorted(self._occupied_cell_numbers, cell_number)
+        if position == len(self._occupied_cell_numbers) or self._occupied_cell_numbers[position] != cell_number:
+            return slice(0, 0)
+        end = self.slice_starts[position + 1] if position + 1 < len(self.slice_starts) else len(self.cell_numbers)
+        return slice(self.slice_starts[position], end)
+
+    def get_points_by_indices(self, indices):
+        """
+        Gets the points which lie in a single cell.
+
+        :param indices: grid indices of the cell
+        :return: array of the indices of the points in the cell, in their original order, or None if there are none
+        """
+        points = self.sort_order[self.get_cell_slice(indices)]
+        return points if len(points) > 0 else None
+
+
+def _find_cells(lower_bounds, upper_bounds, values):
+    """
+    Finds the cell of one coordinate of a grid in which each value lies. A value lies in a cell if it is at least the
+    lower bound and less than the upper bound.
+
+    :param lower_bounds: increasing array of the lower bound of each cell
+    :param upper_bounds: array of the upper bound of each cell
+    :param values: array of coordinate values
+    :return: array of the index of the cell containing each value, or -1 for values not in any cell
+    """
+    cells = np.searchsorted(lower_bounds, values, side='right') - 1
+    inside = (cells >= 0) & (values < upper_bounds[np.maximum(cells, 0)])
+    return np.where(inside, cells, -1)
+
+
+def _counting_sort_by_cell(cell_numbers, num_cells):
+    """
+    Sorts points by cell number by counting the points in each cell and placing them directly at their positions in
+    the sorted order. The sort is stable, so the points in each cell stay in their original order.
+
+    :param cell_numbers: array of the cell number of each point, from 0 to num_cells - 1, or -1 for points outside the
+     grid
+    :param num_cells: number of cells in the grid
+    :return: tuple of (array of the indices of the points in sorted order, array of the index in the sorted points at
+     which each occupied cell starts)
+    """
+    # Converting to compressed sparse rows does the counting sort, with one row per cell and the points outside the
+    # grid in the first row. The row pointers are then the offsets of the cells in the sorted order.
+    num_points = len(cell_numbers)
+    cells = coo_matrix((np.ones(num_points, dtype=np.int8), (cell_numbers + 1, np.arange(num_points))),
+                       shape=(num_cells + 1, num_points)).tocsr()
+    cell_offsets = cells.indptr[1:].astype(np.intp)
+    occupied = np.flatnonzero(cell_offsets[1:] > cell_offsets[:-1])
+    return cells.indices.astype(np.intp), cell_offsets[occupied]
+
+
+def _get_slice_starts(sorted_cell_numbers):
+    """
+    Finds where each occupied cell starts in a list of points sorted by cell number.
+
+    :param sorted_cell_numbers: sorted array of the cell number of each point, or -1 for points outside the grid
+    :return: array of the index in the sorted points at which each occupied cell starts
+    """
+    in_grid_start = np.searchsorted(sorted_cell_numbers, 0)
+    if in_grid_start == len(sorted_cell_numbers):
+        return np.zeros(0, dtype=np.intp)
+    return np.concatenate(([in_grid_start],
+                           np.flatnonzero(np.diff(sorted_cell_numbers[in_grid_start:])) + in_grid_start + 1))
+
+
+class GridCellBinIndex(GridCellBinIndexInSlices):
+    """
+    Index of the points in each grid cell, for constraints which look up the points in one cell at a time using
+    get_points_by_indices. The points are held sorted by cell, as in GridCellBinIndexInSlices; the array of a list of
+    points for each cell used by earlier versions is only built if the index attribute is used.
+    """
 
-class GridCellBinIndex(object):
     def __init__(self):
-        self.index = None
+        super(GridCellBinIndex, self).__init__()
+        self._index = None
+
+    @property
+    def index(self):
+        """
+        Array with the shape of the grid holding a list of the indices of the points in each cell, or None for cells
+        with no points. This is kept for plugins which use it; get_points_by_indices is much faster.
+        """
+        if self._index is None:
+            self._index = np.empty(self.grid_shape, dtype=object)
+            out_indices, slice_starts = self.get_cell_slices()
+            slice_ends = np.append(slice_starts[1:], len(self.sort_order))
+            for cell, start, end in zip(zip(*out_indices), slice_starts, slice_ends):
+                self._index[cell] = self.sort_order[start:end].tolist()
+        return self._index
+
+
+class SortedTimeIndex(object):
+    """
+    Index of the non-masked data points sorted by time, used to find the points within a time window without
+    checking every point.
+    """
+    def __init__(self):
+        # times of the data points in ascending order
+        self.times = None
+        # index in the data of each of the sorted times
+        self.indices = None
 
     def index_data(self, coords, data, coord_map):
         """
-        Creates an index of points that fall within grid cells.
+        Creates the index by sorting the data points by time.
 
-        :param coords: coordinates of grid
-        :param data: list of HyperPoints to index
-        :param coord_map: list of tuples relating index in HyperPoint to index in coords and in
+        :param coords: (not used) coordinates of grid
+        :param data: HyperPointView of the data to index
+        :param coord_map: (not used) list of tuples relating index in HyperPoint to index in coords and in
                           coords to be iterated over
         """
-        # Create an index array matching the shape of the coordinates to be iterated over.
-        shape = []
-        for (hpi, ci, shi) in coord_map:
-            shape.append(len(coords[ci].points))
-        num_cell_indices = len(shape)
-
-        # Set a logging interval.
-        num_bin_checks = sum([math.log(x) for x in shape])
-        log_every_points = 2000000 / num_bin_checks
-        log_every_points -= log_every_points % 100
-        log_every_points = max(log_every_points, 100)
+        times = data.coords_flattened[HyperPoint.TIME]
+        if times is None:
+            raise CoordinateNotFoundError("The data has no time coordinate to apply a time separation to")
+        indices = data.non_masked_indices()
+        times = np.asarray(times)[indices]
+        order = np.argsort(times, kind='mergesort')
+        self.times = times[order]
+        self.indices = indices[order]
+
+    def count_points_within_windows(self, times, window):
+        """
+        Counts the points within a time window around each of a set of times.
 
-        # Create the index, which will be an array containing of a lists of data points that are
-        # within each cell.
-        self.index = np.empty(tuple(shape), dtype=np.dtype(object))
-        self.index.fill(None)
+        :param times: array of the centres of the windows, in standard time units
+        :param window: half-width of the windows, in standard time units
+        :return: tuple of (index in the sorted times of the start of each window, number of points in each window)
+        """
+        times = np.asarray(times)
+        starts = np.searchsorted(self.times, times - window, side='left')
+        ends = np.searchsorted(self.times, times + window, side='right')
+        return starts, ends - starts
 
-        coord_decreasing = [False] * len(coords)
-        coord_lengths = [0] * len(coords)
-        lower_bounds = [None] * len(coords)
-        upper_bounds = [None] * len(coords)
-        for (hpi, ci, shi) in coord_map:
-            coord = coords[ci]
-            # Coordinates must be monotonic; determine whether increasing or decreasing.
-            if len(coord.points) > 1:
-                if coord.points[1] < coord.points[0]:
-                    coord_decreasing[ci] = True
-            coord_lengths[ci] = len(coord.points)
-            if coord_decreasing[ci]:
-                lower_bounds[ci] = coord.bounds[::-1, 1]
-                upper_bounds[ci] = coord.bounds[::-1, 0]
-            else:
-                lower_bounds[ci] = coord.bounds[::, 0]
-                upper_bounds[ci] = coord.bounds[::, 1]
-
-        # Populate the index by finding the cell containing each data point.
-        num_points = len(data)
-        pt_count = 0
-        pt_total = 0
-        for pt_idx, point in data.enumerate_non_masked_points():
-            point_cell_indices = [None] * num_cell_indices
-
-            # Find the interval that the point resides in for each relevant coordinate.
-            for (hpi, ci, shi) in coord_map:
-                search_index = np.searchsorted(lower_bounds[ci], point[hpi], side='right') - 1
-                if (search_index >= 0) and (point[hpi] < upper_bounds[ci][search_index]):
-                    if coord_decreasing[ci]:
-                        point_cell_indices[shi] = coord_lengths[ci] - search_index - 1
-                    else:
-                        point_cell_indices[shi] = search_index
-
-            # Add point to index if a containing interval was found for each coordinate.
-            if point_cell_indices.count(None) == 0:
-                index_entry = self.index[tuple(point_cell_indices)]
-                if index_entry is None:
-                    index_entry = []
-                index_entry.append(pt_idx)
-                self.index[tuple(point_cell_indices)] = index_entry
-
-            # Periodically log progress.
-            pt_count += 1
-            pt_total += 1
-            if pt_count == log_every_points:
-                logging.info("    Indexed %d points of %d (%d%%)",
-                             pt_total, num_points, int(pt_total * 100 / num_points))
-                pt_count = 0
+    def find_points_within_windows(self, times, window):
+        """
+        Finds the points with times t such that time - window <= t <= time + window, for each of a set of times.
 
-    def get_points_by_indices(self, indices):
-        return self.index[tuple(indices)]
+        :param times: array of the centres of the windows, in standard time units
+        :param window: half-width of the windows, in standard time units
+        :return: tuple of (offsets, indices) - the indices in the data of the points in window i are
+         indices[offsets[i]:offsets[i + 1]], in ascending time order
+        """
+        starts, counts = self.count_points_within_windows(times, window)
+        offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, self.indices[expand_ranges(starts, counts)]
 
 
 # Map of names of attributes of a constraint or kernel to the class used to
 # create an index to which the attribute should be set
 _index_attributes = {'grid_cell_bin_index': GridCellBinIndex,
                      'grid_cell_bin_index_slices': GridCellBinIndexInSlices,
-                     'haversine_distance_kd_tree_index': HaversineDistanceKDTreeIndex}
+                     'haversine_distance_kd_tree_index': HaversineDistanceKDTreeIndex,
+                     'unit_sphere_kd_tree_index': UnitSphereKDTreeIndex,
+                     'horizontal_grid_index': HorizontalGridIndex,
+                     'sorted_time_index': SortedTimeIndex}
+
 
+# Cache in which indexes are kept between runs (an IndexCache), or None if indexes are not cached
+_index_cache = None
 
-def create_indexes(operator, coords, data, coord_map):
+
+def set_index_cache(index_cache):
+    """
+    Sets the cache in which indexes are kept so that they can be reused for the same data.
+
+    :param index_cache: IndexCache instance, or None to stop caching indexes
+    """
+    global _index_cache
+    _index_cache = index_cache
+
+
+def get_index_cache():
+    """
+    :return: the cache in which indexes are kept between runs, or None if indexes are not cached
+    """
+    return _index_cache
+
+
+def create_index(cls, coords, data, coord_map, source=None):
+    """
+    Creates an index of the data, or loads it from the index cache if an index of the same data is held there.
+
+    :param cls: class of the index
+    :param coords: coordinates of grid
+    :param data: list of HyperPoints to index
+    :param coord_map: list of tuples relating index in HyperPoint to index in coords and in
+                      coords to be iterated over
+    :param source: the CommonData object the data points were taken from; indexes are only cached if this is given
+    :return: the index
+    """
+    with metrics.timed('index_build'):
+        start = time()
+        key = None
+        if _index_cache is not None and source is not None:
+            key = _index_cache.get_key(cls, coords, data, coord_map, source)
+            index = _index_cache.load(key)
+            if index is not None:
+                logging.info("--> Using cached %s", cls.__name__)
+                metrics.add_index(cls.__name__, time() - start, index, cached=True)
+                return index
+
+        index = cls()
+        index.index_data(coords, data, coord_map)
+        metrics.add_index(cls.__name__, time() - start, index)
+        if key is not None:
+            _index_cache.store(key, index)
+    return index
+
+
+def create_indexes(operator, coords, data, coord_map, source=None):
     """
     :param operator: constraint or kernel instance
     :param coords: coordinates of grid
     :param data: list of HyperPoints to index
     :param coord_map: list of tuples relating index in HyperPoint to index in coords and in
                       coords to be iterated over
+    :param source: the CommonData object the data points were taken from, used to identify the data in the index cache
     """
     for attr, cls in _index_attributes.iteritems():
         if hasattr(operator, attr) and (getattr(operator, attr) is None):
-            index = cls()
             logging.info("--> Creating index for %s", operator.__class__.__name__)
-            index.index_data(coords, data, coord_map)
-            setattr(operator, attr, index)
+            setattr(operator, attr, create_index(cls, coords, data, coord_map, source))
+
+
+def reset_indexes(operator):
+    """
+    Discards the indexes of a constraint or kernel, so that create_indexes will create new ones for different data.
+
+    :param operator: constraint or kernel instance
+    """
+    for attr, cls in _index_attributes.iteritems():
+        if isinstance(getattr(operator, attr, None), cls):
+            setattr(operator, attr, None)
@@ -1,6 +1,6 @@
 import numpy as np
 
-from cis.collocation.kdtree import HaversineDistanceKDTree
+from cis.collocation.kdtree import HaversineDistanceKDTree, haversine_distance
 from cis.data_io.hyperpoint import HyperPoint
 
 
@@ -19,7 +19,7 @@ class HaversineDistanceKDTreeIndex(object):
         :param coord_map: (not used) list of tuples relating index in HyperPoint
                           to index in sample point coords and in coords to be output
         """
-        if len(data.data.shape) > 1:
+        if data.data is not None and len(data.data.shape) > 1:
             # Flatten coordinates.
             lat_idx = [key for key, value in data.dims_to_std_coords_map.items()
                        if value == HyperPoint.LATITUDE][0]
@@ -37,6 +37,12 @@ class HaversineDistanceKDTreeIndex(object):
         mask = np.ma.getmask(data.data).ravel()
         self.index = HaversineDistanceKDTree(spatial_points, mask=mask, leafsize=leafsize)
 
+    def get_metrics(self):
+        """
+        :return: dictionary of the depth and leaf counts of the tree, for collocation metrics
+        """
+        return self.index.get_tree_stats()
+
     def find_nearest_point(self, point):
         """Finds the indexed point nearest to a specified point.
         :param point: point for which the nearest point is required
@@ -57,3 +63,109 @@ class HaversineDistanceKDTreeIndex(object):
         """
         query_pt = [[point.latitude, point.longitude]]
         return self.index.query_ball_point(query_pt, distance)[0]
+
+    def find_nearest_points(self, latitudes, longitudes):
+        """Finds the indexed points nearest to each of a set of points. Each distinct location is only looked up once.
+        :param latitudes: array of latitudes of the points for which the nearest points are required
+        :param longitudes: array of longitudes of the points for which the nearest points are required
+        :return: tuple of (indices in data of closest points, distances to them in kilometres) - where no point was
+         found the distance is inf and the index is not valid
+        """
+        unique_lats, unique_lons, inverse = _unique_locations(latitudes, longitudes)
+        unique_points = np.column_stack((unique_lats, unique_lons))
+        distances, indices = self.index.query(unique_points)
+        # The distances found by the tree query are not in kilometres, so recalculate those for the points found.
+        found = ~np.isinf(distances)
+        distances[found] = haversine_distance(unique_points[found], np.ma.getdata(self.index.data)[indices[found]])
+        return indices[inverse], distances[inverse]
+
+    def find_nearest_points_within_distance(self, latitudes, longitudes, distance, check=None):
+        """Finds the nearest indexed point within a specified distance of each of a set of points which passes a
+        check, with a single traversal of the tree for all of the points.
+        :param latitudes: array of latitudes of the reference points
+        :param longitudes: array of longitudes of the reference points
+        :param distance: distance in kilometres
+        :param check: optional function given an array of the numbers of reference points and an array of indices in
+         data of candidate points, returning a boolean array which is True for the pairs which may be returned
+        :return: tuple of (indices in data of the nearest points, distances to them in kilometres) - where no point was
+         found the distance is inf and the index is not valid
+        """
+        return self.index.query_nearest_within_points(np.column_stack((latitudes, longitudes)), distance, check)
+
+    def find_points_within_distance_of_points(self, latitudes, longitudes, distance):
+        """Finds the indexed points within a specified distance of each of a set of points. Each distinct location is
+        only looked up once.
+        :param latitudes: array of latitudes of the reference points
+        :param longitudes: array of longitudes of the reference points
+        :param distance: distance in kilometres
+        :return: tuple of (offsets, indices) - the indices in data of the points within the distance of reference
+         point i are indices[offsets[i]:offsets[i + 1]]
+        """
+        unique_lats, unique_lons, inverse = _unique_locations(latitudes, longitudes)
+        unique_offsets, unique_indices = self.index.query_ball_points(np.column_stack((unique_lats, unique_lons)),
+                                                                      distance)
+        return _expand_unique_offsets(unique_offsets, unique_indices, inverse)
+
+    def find_pairs_within_distance(self, latitudes, longitudes, distance):
+        """Finds the indexed points within a specified distance of each of a set of points. A k-D tree is built over
+        the distinct reference locations and traversed together with the index, so that all of the pairs are found
+        in a single traversal.
+        :param latitudes: array of latitudes of the reference points
+        :param longitudes: array of longitudes of the reference points
+        :param distance: distance in kilometres
+        :return: tuple of (offsets, indices) - the indices in data of the points within the distance of reference
+         point i are indices[offsets[i]:offsets[i + 1]], in ascending order
+        """
+        unique_lats, unique_lons, inverse = _unique_locations(latitudes, longitudes)
+        if len(unique_lats) == 0:
+            return np.zeros(1, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        reference_tree = HaversineDistanceKDTree(np.column_stack((unique_lats, unique_lons)),
+                                                 leafsize=self.index.leafsize)
+        unique_offsets, unique_indices = reference_tree.query_ball_tree_offsets(self.index, distance)
+        return _expand_unique_offsets(unique_offsets, unique_indices, inverse)
+
+
+def _unique_locations(latitudes, longitudes):
+    """Finds the distinct locations in a set of points.
+    :param latitudes: array of latitudes
+    :param longitudes: array of longitudes
+    :return: tuple of (unique latitudes, unique longitudes, inverse) where inverse gives the index in the unique arrays
+     of each of the original points
+    """
+    latitudes = np.asarray(latitudes)
+    longitudes = np.asarray(longitudes)
+    order = np.lexsort((longitudes, latitudes))
+    sorted_lats = latitudes[order]
+    sorted_lons = longitudes[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (sorted_lats[1:] != sorted_lats[:-1]) | (sorted_lons[1:] != sorted_lons[:-1])
+    inverse = np.empty(len(order), dtype=np.intp)
+    inverse[order] = np.cumsum(is_new) - 1
+    return sorted_lats[is_new], sorted_lons[is_new], inverse
+
+
+def _expand_unique_offsets(unique_offsets, unique_indices, inverse):
+    """Expands the neighbours found for a set of distinct locations out to every original point.
+    :param unique_offsets: offsets into unique_indices of the neighbours of each distinct location
+    :param unique_indices: indices of the neighbours of the distinct locations
+    :param inverse: index in the distinct locations of each of the original points
+    :return: tuple of (offsets, indices) for the original points
+    """
+    counts = np.diff(unique_offsets)[inverse]
+    offsets = np.zeros(len(inverse) + 1, dtype=np.intp)
+    np.cumsum(counts, out=offsets[1:])
+    indices = unique_indices[expand_ranges(unique_offsets[inverse], counts)]
+    return offsets, indices
+
+
+def expand_ranges(starts, counts):
+    """Concatenates the ranges [starts[i], starts[i] + counts[i]) into a single array without a Python loop.
+    :param starts: array of the start of each range
+    :param counts: array of the length of each range
+    :return: array of length sum(counts)
+    """
+    counts = np.asarray(counts, dtype=np.intp)
+    total = counts.sum()
+    # Offset of the start of each range within the output
+    range_starts = np.cumsum(counts) - counts
+    return np.repeat(np.asarray(starts, dtype=np.intp) - range_starts, counts) + np.arange(total, dtype=np.intp)
@@ -0,0 +1,206 @@
+import numpy as np
+
+from cis.collocation.haversinedistancekdtreeindex import _unique_locations, _expand_unique_offsets, expand_ranges
+from cis.collocation.kdtree import haversine_distance, RADIUS_EARTH
+from cis.data_io.hyperpoint import HyperPoint
+
+# Relative amount by which the cells are enlarged, so that rounding in the conversion from distance along the surface
+# to degrees can never exclude a point. Candidates are then checked using the haversine distance.
+CELL_TOLERANCE = 1.0e-9
+
+# Smallest height of a latitude band in degrees, which limits the number of bands for very small distances
+MIN_CELL_DEGREES = 0.01
+
+
+class HorizontalGridIndex(object):
+    """Hash grid index of latitudes and longitudes, which can be used to query for the points within a fixed distance
+    along the Earth's surface.
+
+    The grid is divided into latitude bands at least as high as the distance, and each band into longitude bins at
+    least as wide as the greatest difference in longitude of points within the distance anywhere in the band, so that
+    the points within the distance of a point are always in the cell containing it or one of the neighbouring cells.
+    The bins are wider nearer the poles, and a band touching a pole or closer to it than the distance is a single bin.
+
+    The data points are sorted by cell when the grid is first queried, and the grid is rebuilt if it is queried with a
+    different distance. Gives the same results as HaversineDistanceKDTreeIndex.
+    """
+    def __init__(self):
+        self.data_indices = None
+        self.latitudes = None
+        self.longitudes = None
+        # Distance in kilometres the grid was built for, or None if it has not been built
+        self.distance = None
+        # Height of the latitude bands in degrees
+        self.band_height = None
+        # Number of longitude bins in each latitude band
+        self.band_bins = None
+        # Number of the first cell in each latitude band
+        self.band_offsets = None
+        # Numbers of the cells holding points, in ascending order, and the range of the sorted points in each
+        self.cells = None
+        self.cell_starts = None
+        self.cell_ends = None
+        # Indices in data_indices of the points, sorted by cell
+        self.sort_order = None
+
+    def index_data(self, points, data, coord_map):
+        """
+        Stores the coordinates of the data points to be indexed. The grid is built on the first query, as the size of
+        the cells depends on the distance queried.
+
+        :param points: (not used) sample points
+        :param data: HyperPointView of the data to index
+        :param coord_map: (not used) list of tuples relating index in HyperPoint
+                          to index in sample point coords and in coords to be output
+        """
+        coords = data.coords_flattened
+        self.data_indices = data.non_masked_indices()
+        self.latitudes = np.asarray(coords[HyperPoint.LATITUDE], dtype=np.float64)[self.data_indices]
+        self.longitudes = np.asarray(coords[HyperPoint.LONGITUDE], dtype=np.float64)[self.data_indices]
+
+    def get_metrics(self):
+        """
+        :return: dictionary of the number of points indexed and, once the grid has been built, the number of latitude
+         bands and of cells holding points, for collocation metrics
+        """
+        stats = {'points': len(self.data_indices)}
+        if self.distance is not None:
+            stats['bands'] = len(self.band_bins)
+            stats['occupied_cells'] = len(self.cells)
+        return stats
+
+    def find_points_within_distance(self, point, distance):
+        """Finds the points within a specified distance of a specified point.
+        :param point: reference point
+        :param distance: distance in kilometres
+        :return: list indices in data of points
+        """
+        offsets, indices = self.find_points_within_distance_of_points([point.latitude], [point.longitude], distance)
+        return indices.tolist()
+
+    def find_points_within_distance_of_points(self, latitudes, longitudes, distance):
+        """Finds the indexed points within a specified distance of each of a set of points. Each distinct location is
+        only looked up once, and the cells around all of the locations are gathered together.
+        :param latitudes: array of latitudes of the reference points
+        :param longitudes: array of longitudes of the reference points
+        :param distance: distance in kilometres
+        :return: tuple of (offsets, indices) - the indices in data of the points within the distance of reference
+         point i are indices[offsets[i]:offsets[i + 1]], in ascending order
+        """
+        unique_lats, unique_lons, inverse = _unique_locations(latitudes, longitudes)
+        unique_offsets = np.zeros(len(unique_lats) + 1, dtype=np.intp)
+        if len(self.data_indices) == 0 or len(unique_lats) == 0:
+            return _expand_unique_offsets(unique_offsets, np.zeros(0, dtype=np.intp), inverse)
+        self._build_grid(distance)
+
+        rows, cells = self._get_neighbouring_cells(np.asarray(unique_lats, dtype=np.float64),
+                                                   np.asarray(unique_lons, dtype=np.float64))
+        positions = np.searchsorted(self.cells, cells)
+        positions[positions == len(self.cells)] = 0
+        occupied = self.cells[positions] == cells
+        rows = rows[occupied]
+        positions = positions[occupied]
+        counts = self.cell_ends[positions] - self.cell_starts[positions]
+        rows = np.repeat(rows, counts)
+        candidates = self.sort_order[expand_ranges(self.cell_starts[positions], counts)]
+
+        within = haversine_distance(np.column_stack((self.latitudes[candidates], self.longitudes[candidates])),
+                                    np.column_stack((unique_lats[rows], unique_lons[rows]))) <= distance
+        rows = rows[within]
+        indices = self.data_indices[candidates[within]]
+        order = np.lexsort((indices, rows))
+        np.cumsum(np.bincount(rows, minlength=len(unique_lats)), out=unique_offsets[1:])
+        return _expand_unique_offsets(unique_offsets, indices[order], inverse)
+
+    def find_pairs_within_distance(self, latitudes, longitudes, distance):
+        """Finds the indexed points within a specified distance of each of a set of points.
+        :param latitudes: array of latitudes of the reference points
+        :param longitudes: array of longitudes of the reference points
+        :param distance: distance in kilometres
+        :return: tuple of (offsets, indices) - the indices in data of the points within the distance of reference
+         point i are indices[offsets[i]:offsets[i + 1]], in ascending order
+        """
+        return self.find_points_within_distance_of_points(latitudes, longitudes, distance)
+
+    def _build_grid(self, distance):
+        """
+        Divides the sphere into cells for a distance, and sorts the data points by cell, unless this has already been
+        done for the same distance.
+
+        :param distance: distance in kilometres
+        """
+        if self.distance == distance:
+            return
+        angle = np.degrees(distance / RADIUS_EARTH) * (1.0 + CELL_TOLERANCE)
+        self.band_height = np.maximum(angle, MIN_CELL_DEGREES)
+        band_count = int(np.ceil(180.0 / self.band_height)) if self.band_height < 180.0 else 1
+        band_lower = -90.0 + np.arange(band_count) * self.band_height
+        band_upper = np.minimum(band_lower + self.band_height, 90.0)
+        cos_pole_edge = np.cos(np.radians(np.maximum(np.abs(band_lower), np.abs(band_upper))))
+
+        # Points within the angle of a point at latitude lat differ in longitude by at most asin(sin(angle) / cos(lat)),
+        # unless the angle reaches the pole, in which case they can be at any longitude.
+        cell_angle = np.radians(self.band_height)
+        self.band_bins = np.ones(band_count, dtype=np.int64)
+        if cell_angle < np.pi / 2:
+            split = np.sin(cell_angle) < cos_pole_edge
+            widths = np.degrees(np.arcsin(np.sin(cell_angle) / cos_pole_edge[split])) * (1.0 + CELL_TOLERANCE)
+            self.band_bins[split] = np.maximum(np.floor(360.0 / widths), 1).astype(np.int64)
+        self.band_offsets = np.zeros(band_count, dtype=np.int64)
+        np.cumsum(self.band_bins[:-1], out=self.band_offsets[1:])
+
+        bands = self._get_bands(self.latitudes)
+        point_cells = self.band_offsets[bands] + self._get_bins(self.longitudes, self.band_bins[bands])
+        self.sort_order = np.argsort(point_cells, kind='mergesort')
+        sorted_cells = point_cells[self.sort_order]
+        is_new = np.ones(len(sorted_cells), dtype=bool)
+        is_new[1:] = sorted_cells[1:] != sorted_cells[:-1]
+        self.cell_starts = np.flatnonzero(is_new)
+        self.cell_ends = np.append(self.cell_starts[1:], len(sorted_cells))
+        self.cells = sorted_cells[self.cell_starts]
+        self.distance = distance
+
+    def _get_bands(self, latitudes):
+        """
+        :param latitudes: array of latitudes
+        :return: array of the number of the latitude band containing each latitude
+        """
+        bands = np.floor((latitudes + 90.0) / self.band_height).astype(np.int64)
+        return np.clip(bands, 0, len(self.band_bins) - 1)
+
+    @staticmethod
+    def _get_bins(longitudes, bins):
+        """
+        :param longitudes: array of longitudes
+        :param bins: array of the number of longitude bins in the band containing each point
+        :return: array of the number of the longitude bin within its band containing each longitude
+        """
+        bin_numbers = np.floor(np.mod(longitudes + 180.0, 360.0) * bins / 360.0).astype(np.int64)
+        return np.minimum(bin_numbers, bins - 1)
+
+    def _get_neighbouring_cells(self, latitudes, longitudes):
+        """
+        Gets the cells which can hold points within the distance of a set of points: those in the same, previous and
+        next latitude bands and longitude bins. In bands with fewer than three bins every bin is taken, so that no cell
+        is taken twice.
+
+        :param latitudes: array of latitudes
+        :param longitudes: array of longitudes
+        :return: tuple of (array of the number of the point, array of the number of the cell) for each cell
+        """
+        count = len(latitudes)
+        rows = np.tile(np.arange(count), 9)
+        steps = np.repeat(np.arange(9), count)
+        bands = self._get_bands(latitudes)[rows] + steps // 3 - 1
+        bin_steps = steps % 3 - 1
+        valid = (bands >= 0) & (bands < len(self.band_bins))
+        rows = rows[valid]
+        bands = bands[valid]
+        bin_steps = bin_steps[valid]
+
+        bins = self.band_bins[bands]
+        bin_numbers = np.mod(self._get_bins(longitudes[rows], bins) + bin_steps, bins)
+        few_bins = bins < 3
+        bin_numbers[few_bins] = bin_steps[few_bins] + 1
+        valid = bin_numbers < bins
+        return rows[valid], self.band_offsets[bands[valid]] + bin_numbers[valid]
@@ -0,0 +1,162 @@
+"""
+Cache of the indexes used for collocation kept on disk, so that they can be reused by later runs on the same data.
+"""
+import cPickle
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+# Change this whenever the way in which indexes are built or stored changes, so that existing entries are not used.
+CACHE_FORMAT_VERSION = 5
+
+CACHE_FILE_SUFFIX = '.index'
+
+
+class IndexCache(object):
+    """
+    Directory of pickled indexes. Each index is keyed on the paths, sizes and modification times of the files the data
+    were read from, the variable name, its mask and coordinates and the index parameters. When the total size of the
+    indexes exceeds the size limit the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, size_limit):
+        """
+        :param directory: directory in which to keep the indexes, which is created if it does not exist
+        :param size_limit: limit on the total size of the indexes in bytes
+        """
+        self.directory = directory
+        self.size_limit = size_limit
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_key(self, index_class, coords, data, coord_map, source):
+        """
+        Creates the key identifying an index of some data.
+
+        :param index_class: class of the index
+        :param coords: coordinates of the grid or sample points the index is created for
+        :param data: HyperPointView of the data points to index
+        :param coord_map: list of tuples relating index in HyperPoint to index in coords and in coords to be iterated
+         over
+        :param source: the CommonData object the data points were taken from
+        :return: key as a string
+        """
+        key = hashlib.sha1()
+        files = []
+        for filename in getattr(source, 'filenames', None) or []:
+            if os.path.isfile(filename):
+                stat = os.stat(filename)
+                files.append((os.path.abspath(filename), stat.st_size, stat.st_mtime))
+            else:
+                files.append((filename,))
+        key.update(repr((CACHE_FORMAT_VERSION, index_class.__module__, index_class.__name__, source.name(), files,
+                         coord_map)))
+
+        # The coordinates are included as well as the files because they may have been changed after reading, e.g. to
+        # put the longitudes into the same range as the sample points.
+        for coord in data.coords_flattened:
+            _update_with_array(key, coord)
+        if data.data_flattened is not None:
+            _update_with_array(key, np.packbits(np.ma.getmaskarray(data.data_flattened)))
+        if isinstance(coords, (list, tuple)):
+            for coord in coords:
+                _update_with_array(key, getattr(coord, 'points', None))
+                _update_with_array(key, getattr(coord, 'bounds', None))
+        return key.hexdigest()
+
+    def load(self, key):
+        """
+        Loads an index from the cache.
+
+        :param key: key identifying the index
+        :return: the index or None if it is not in the cache
+        """
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                index = cPickle.load(cache_file)
+        except IOError:
+            return None
+        except Exception as e:
+            logging.warning("Unable to read cached index {} ({}); it will be recreated".format(path, e))
+            self._remove(path)
+            return None
+        # Mark the index as recently used. This is skipped if the cache directory can not be written to.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return index
+
+    def store(self, key, index):
+        """
+        Stores an index in the cache, then removes the least recently used indexes if the cache is too big.
+
+        :param key: key identifying the index
+        :param index: the index to store
+        """
+        temp_path = None
+        try:
+            handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with os.fdopen(handle, 'wb') as cache_file:
+                cPickle.dump(index, cache_file, cPickle.HIGHEST_PROTOCOL)
+            # Rename the complete file into place so that other processes never read a partly written index.
+            os.rename(temp_path, self._get_path(key))
+        except Exception as e:
+            logging.warning("Unable to store index in the cache directory {} ({})".format(self.directory, e))
+            if temp_path is not None:
+                self._remove(temp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used indexes until the total size of the cache is within the size limit.
+        """
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(CACHE_FILE_SUFFIX):
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.size_limit:
+                break
+            logging.info("Removing least recently used index {} from the cache".format(path))
+            self._remove(path)
+            total_size -= size
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + CACHE_FILE_SUFFIX)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _update_with_array(key, array):
+    """
+    Adds the contents of an array to a key being hashed.
+
+    :param key: hashlib object
+    :param array: numpy array or None
+    """
+    if array is None:
+        key.update('None')
+        return
+    array = np.ascontiguousarray(np.ma.getdata(array))
+    if array.dtype == object:
+        array = array.astype(np.float64)
+    key.update(repr((array.dtype.str, array.shape)))
+    key.update(array.data)
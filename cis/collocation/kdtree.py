@@ -5,13 +5,14 @@
 
 from __future__ import division, print_function, absolute_import
 
-import sys
 from heapq import heappush, heappop
 import math
 
 import numpy as np
 import scipy.sparse
 
+from cis.collocation.metrics import get_tree_stats
+
 __all__ = ['minkowski_distance_p', 'minkowski_distance', 'haversine_distance',
            'distance_matrix',
            'Rectangle', 'KDTree']
@@ -21,6 +22,10 @@ HALF_PI = np.pi / 2.0
 PI = np.pi
 TWO_PI = np.pi * 2.0
 
+# Distance in kilometres by which the spherical caps around the nodes are enlarged when searching for the nearest
+# point, so that rounding can never exclude a node holding a point at exactly the distance of the nearest found so far
+CAP_TOLERANCE = 1.0e-6
+
 
 def minkowski_distance_p(x, y, p=2):
     """
@@ -411,15 +416,6 @@ class KDTree(object):
         brute-force.  Has to be positive. In the case of points which have
         the same position this is not the minimum
 
-    :raises:
-     RuntimeError
-        The maximum recursion limit can be exceeded for large data
-        sets.  If this happens, either increase the value for the `leafsize`
-        parameter or increase the recursion limit by::
-
-            >>> import sys
-            >>> sys.setrecursionlimit(10000)
-
     Notes
 
     The algorithm used is described in Maneewongvatana and Mount 1999.
@@ -432,6 +428,11 @@ class KDTree(object):
     "sliding midpoint" rule, which ensures that the cells do not all
     become long and thin.
 
+    The tree is held in flat arrays indexed by node number rather than as
+    a tree of node objects (see _build), and is built a level at a time.
+    It is therefore small, is pickled without any conversion, and is not
+    copied when shared with forked worker processes.
+
     The tree can be queried for the r closest neighbors of any given point
     (optionally returning only those within some maximum distance of the
     point). It can also be queried, with a substantial gain in efficiency,
@@ -457,91 +458,147 @@ class KDTree(object):
         self.maxes = np.amax(self.data, axis=0)
         self.mins = np.amin(self.data, axis=0)
 
-        self.tree = self._build(np.arange(self.n), self.maxes, self.mins)
+        self._build(np.arange(self.n), self.maxes, self.mins)
 
-    class node(object):
-        if sys.version_info[0] >= 3:
-            def __lt__(self, other): id(self) < id(other)
+    def get_tree_stats(self):
+        """
+        Gets the depth and leaf counts of the tree, for collocation metrics.
 
-            def __gt__(self, other): id(self) > id(other)
+        :return: dictionary of the leaf size, depth, number of leaves, and the largest and mean number of points in a
+         leaf
+        """
+        stats = get_tree_stats(0,
+                               lambda node: () if self._is_leaf(node) else (self.node_children[node],
+                                                                            self.node_children[node] + 1),
+                               lambda node: self._get_node_size(node))
+        stats['leafsize'] = self.leafsize
+        return stats
 
-            def __le__(self, other): id(self) <= id(other)
+    def _is_leaf(self, node):
+        return self.node_children[node] < 0
 
-            def __ge__(self, other): id(self) >= id(other)
+    def _get_node_size(self, node):
+        """
+        :return: the number of data points under a node
+        """
+        return self.node_ends[node] - self.node_starts[node]
 
-            def __eq__(self, other): id(self) == id(other)
+    def _get_node_indices(self, node):
+        """
+        :return: array of the indices of the data points under a node
+        """
+        return self.indices[self.node_starts[node]:self.node_ends[node]]
 
-    class leafnode(node):
-        def __init__(self, idx):
-            self.idx = idx
-            self.children = len(idx)
+    def _get_node_rectangle(self, node, rectangle_class=Rectangle):
+        """
+        :return: the hyperrectangle bounding a node
+        """
+        return rectangle_class(self.node_maxes[node], self.node_mins[node])
 
-    class innernode(node):
-        def __init__(self, split_dim, split, less, greater):
-            self.split_dim = split_dim
-            self.split = split
-            self.less = less
-            self.greater = greater
-            self.children = less.children + greater.children
+    def _get_children(self, node):
+        """
+        :return: tuple of the less and greater children of an inner node
+        """
+        less = self.node_children[node]
+        return less, less + 1
 
     def _build(self, idx, maxes, mins):
         """
-        build the tree
-        :param idx: the data indexes which are part of this node
-        :param maxes: the maximum value of each dimension for this node
-        :param mins: the minimum value of each dimension for this node
-        :return: the node
+        Build the tree, splitting all of the nodes of each level at once. The tree is held in arrays indexed by node
+        number, with the root node 0 and the nodes of each level following those of the level above:
+
+        - node_split_dims, node_splits: the dimension and value each inner node is split on (-1 and 0 for a leaf)
+        - node_children: the number of the less child of each inner node, which the greater child follows (-1 for a
+          leaf)
+        - node_starts, node_ends: the range of self.indices holding the indices of the data points under each node.
+          The points are partitioned in place as the nodes are split, so each node's points are contiguous
+        - node_mins, node_maxes: the bounding box of each node, given by the splits above it
+
+        :param idx: the data indexes which are part of the tree
+        :param maxes: the maximum value of each dimension of the data
+        :param mins: the minimum value of each dimension of the data
         """
-        if len(idx) <= self.leafsize:
-            return KDTree.leafnode(idx)
-        else:
-            data = self.data[idx]
-            # I suspect these are commented out because calculating the max takes a long time and for reasonably
-            # distributed data does not speed up the algorithm
-            # maxes = np.amax(data,axis=0)
-            # mins = np.amin(data,axis=0)
-
-            # Fins the dimension with the biggest difference (is it lat or lon)
-            d = np.argmax(maxes - mins)
-            maxval = maxes[d]
-            minval = mins[d]
-
-            # the mins and maxes are not recalculated but the min/max is set to split on build so unless the split
-            # is on a border this is will never triger
-            if maxval == minval:
-                # all points are identical; warn user?
-                return KDTree.leafnode(idx)
-            data = data[:, d]  # data is the data to split on
-
-            # sliding midpoint rule; see Maneewongvatana and Mount 1999
-            # for arguments that this is a good idea. (I am not sure this is implemented correctly
-            # because we are not sliding the min or max)
-            split = (maxval + minval) / 2
-            less_idx = np.nonzero(data <= split)[0]
-            greater_idx = np.nonzero(data > split)[0]
-            if len(less_idx) == 0:
-                split = np.amin(data)
-                less_idx = np.nonzero(data <= split)[0]
-                greater_idx = np.nonzero(data > split)[0]
-            if len(greater_idx) == 0:
-                split = np.amax(data)
-                less_idx = np.nonzero(data < split)[0]
-                greater_idx = np.nonzero(data >= split)[0]
-            if len(less_idx) == 0:
-                # _still_ zero? all must have the same value check and assign them all to the same node
-                if not np.all(data == data[0]):
-                    raise ValueError("Troublesome data array: %s" % data)
-                return KDTree.leafnode(idx)
-
-            lessmaxes = np.copy(maxes)
-            lessmaxes[d] = split
-            greatermins = np.copy(mins)
-            greatermins[d] = split
-            return KDTree.innernode(
-                d,
-                split,
-                self._build(idx[less_idx], lessmaxes, mins),
-                self._build(idx[greater_idx], maxes, greatermins))
+        data = np.ma.getdata(self.data)
+        indices = np.array(idx, dtype=np.intp)
+        level_starts = np.zeros(1, dtype=np.intp)
+        level_ends = np.array([len(indices)], dtype=np.intp)
+        level_maxes = np.array([np.ma.getdata(maxes)], dtype=np.float64)
+        level_mins = np.array([np.ma.getdata(mins)], dtype=np.float64)
+        levels = []
+        node_count = 0
+        while len(level_starts) > 0:
+            level_size = len(level_starts)
+            split_dims = np.full(level_size, -1, dtype=np.intp)
+            splits = np.zeros(level_size, dtype=np.float64)
+            children = np.full(level_size, -1, dtype=np.intp)
+
+            # Find the dimension with the biggest difference (is it lat or lon) for each node
+            dims = np.argmax(level_maxes - level_mins, axis=1)
+            maxvals = level_maxes[np.arange(level_size), dims]
+            minvals = level_mins[np.arange(level_size), dims]
+            # The mins and maxes are not recalculated but set to the split, so unless the split is on a border a node
+            # is never left unsplit for having all points identical here
+            to_split = np.flatnonzero((level_ends - level_starts > self.leafsize) & (maxvals != minvals))
+
+            child_starts = child_ends = np.zeros(0, dtype=np.intp)
+            child_maxes = child_mins = np.zeros((0, self.m), dtype=np.float64)
+            if len(to_split) > 0:
+                # The position in indices of each point in the nodes being split, and which of those nodes it is in
+                sizes = level_ends[to_split] - level_starts[to_split]
+                offsets = np.cumsum(sizes) - sizes
+                point_nodes = np.repeat(np.arange(len(to_split)), sizes)
+                positions = np.arange(len(point_nodes)) - offsets[point_nodes] + level_starts[to_split][point_nodes]
+                values = data[indices[positions], dims[to_split][point_nodes]]
+                node_min = np.minimum.reduceat(values, offsets)
+                node_max = np.maximum.reduceat(values, offsets)
+
+                # sliding midpoint rule; see Maneewongvatana and Mount 1999
+                # for arguments that this is a good idea. (I am not sure this is implemented correctly
+                # because we are not sliding the min or max)
+                split = (maxvals[to_split] + minvals[to_split]) / 2
+                less = values <= split[point_nodes]
+                no_less = np.bincount(point_nodes[less], minlength=len(to_split)) == 0
+                split[no_less] = node_min[no_less]
+                less = values <= split[point_nodes]
+                no_greater = np.bincount(point_nodes[less], minlength=len(to_split)) == sizes
+                split[no_greater] = node_max[no_greater]
+                less = np.where(no_greater[point_nodes], values < split[point_nodes], values <= split[point_nodes])
+                less_counts = np.bincount(point_nodes[less], minlength=len(to_split))
+
+                # _still_ no less points? all must have the same value, so the node is left as a leaf
+                unsplit = less_counts == 0
+                if np.any(node_min[unsplit] != node_max[unsplit]):
+                    raise ValueError("Troublesome data array: %s" % values[unsplit[point_nodes]])
+
+                # Partition the points of each node into its less points followed by its greater points, keeping
+                # their order within each
+                order = np.argsort(2 * point_nodes + ~less, kind='mergesort')
+                indices[positions] = indices[positions[order]]
+
+                split_nodes = to_split[~unsplit]
+                split = split[~unsplit]
+                less_counts = less_counts[~unsplit]
+                split_dims[split_nodes] = dims[split_nodes]
+                splits[split_nodes] = split
+                children[split_nodes] = node_count + level_size + 2 * np.arange(len(split_nodes))
+
+                less_children = 2 * np.arange(len(split_nodes))
+                child_starts = np.repeat(level_starts[split_nodes], 2)
+                child_starts[less_children + 1] += less_counts
+                child_ends = np.repeat(level_ends[split_nodes], 2)
+                child_ends[less_children] = child_starts[less_children + 1]
+                child_maxes = np.repeat(level_maxes[split_nodes], 2, axis=0)
+                child_maxes[less_children, dims[split_nodes]] = split
+                child_mins = np.repeat(level_mins[split_nodes], 2, axis=0)
+                child_mins[less_children + 1, dims[split_nodes]] = split
+
+            levels.append((split_dims, splits, children, level_starts, level_ends, level_mins, level_maxes))
+            node_count += level_size
+            level_starts, level_ends, level_mins, level_maxes = child_starts, child_ends, child_mins, child_maxes
+
+        self.indices = indices
+        (self.node_split_dims, self.node_splits, self.node_children, self.node_starts, self.node_ends,
+         self.node_mins, self.node_maxes) = [np.concatenate(arrays) for arrays in zip(*levels)]
 
     def _query(self, x, k=1, eps=0, p=2, distance_upper_bound=np.inf):
 
@@ -556,10 +613,10 @@ class KDTree(object):
         # entries are:
         #  minimum distance between the cell and the target
         #  distances between the nearest side of the cell and the target
-        #  the head node of the cell
+        #  the number of the head node of the cell
         q = [(min_distance,
               tuple(side_distances),
-              self.tree)]
+              0)]
         # priority queue for the nearest neighbors
         # furthest known neighbor first
         # entries are (-distance**p, i)
@@ -577,15 +634,16 @@ class KDTree(object):
 
         while q:
             min_distance, side_distances, node = heappop(q)
-            if isinstance(node, KDTree.leafnode):
+            if self._is_leaf(node):
                 # brute-force
-                data = self.data[node.idx]
+                idx = self._get_node_indices(node)
+                data = self.data[idx]
                 ds = minkowski_distance_p(data, x[np.newaxis, :], p)
                 for i in range(len(ds)):
                     if ds[i] < distance_upper_bound:
                         if len(neighbors) == k:
                             heappop(neighbors)
-                        heappush(neighbors, (-ds[i], node.idx[i]))
+                        heappush(neighbors, (-ds[i], idx[i]))
                         if len(neighbors) == k:
                             distance_upper_bound = -neighbors[0][0]
             else:
@@ -596,10 +654,12 @@ class KDTree(object):
                     # since this is the nearest cell, we're done, bail out
                     break
                 # compute minimum distances to the children and push them on
-                if x[node.split_dim] < node.split:
-                    near, far = node.less, node.greater
+                split_dim, split = self.node_split_dims[node], self.node_splits[node]
+                less, greater = self._get_children(node)
+                if x[split_dim] < split:
+                    near, far = less, greater
                 else:
-                    near, far = node.greater, node.less
+                    near, far = greater, less
 
                 # near child is at the same distance as the current node
                 heappush(q, (min_distance, side_distances, near))
@@ -608,13 +668,13 @@ class KDTree(object):
                 # on the split value
                 sd = list(side_distances)
                 if p == np.inf:
-                    min_distance = max(min_distance, abs(node.split - x[node.split_dim]))
+                    min_distance = max(min_distance, abs(split - x[split_dim]))
                 elif p == 1:
-                    sd[node.split_dim] = np.abs(node.split - x[node.split_dim])
-                    min_distance = min_distance - side_distances[node.split_dim] + sd[node.split_dim]
+                    sd[split_dim] = np.abs(split - x[split_dim])
+                    min_distance = min_distance - side_distances[split_dim] + sd[split_dim]
                 else:
-                    sd[node.split_dim] = np.abs(node.split - x[node.split_dim]) ** p
-                    min_distance = min_distance - side_distances[node.split_dim] + sd[node.split_dim]
+                    sd[split_dim] = np.abs(split - x[split_dim]) ** p
+                    min_distance = min_distance - side_distances[split_dim] + sd[split_dim]
 
                 # far child might be too far, if so, don't bother pushing it
                 if min_distance <= distance_upper_bound * epsfac:
@@ -763,28 +823,22 @@ class KDTree(object):
                                  "equal to one, or None")
 
     def _query_ball_point(self, x, r, p=2., eps=0):
-        R = Rectangle(self.maxes, self.mins)
 
-        def traverse_checking(node, rect):
+        def traverse_checking(node):
+            rect = self._get_node_rectangle(node)
             if rect.min_distance_point(x, p) > r / (1. + eps):
                 return []
             elif rect.max_distance_point(x, p) < r * (1. + eps):
-                return traverse_no_checking(node)
-            elif isinstance(node, KDTree.leafnode):
-                d = self.data[node.idx]
-                return node.idx[minkowski_distance(d, x, p) <= r].tolist()
-            else:
-                less, greater = rect.split(node.split_dim, node.split)
-                return traverse_checking(node.less, less) + traverse_checking(node.greater, greater)
-
-        def traverse_no_checking(node):
-            if isinstance(node, KDTree.leafnode):
-                return node.idx.tolist()
+                # the points under a node are contiguous in self.indices, so the node need not be traversed
+                return self._get_node_indices(node).tolist()
+            elif self._is_leaf(node):
+                idx = self._get_node_indices(node)
+                return idx[minkowski_distance(self.data[idx], x, p) <= r].tolist()
             else:
-                return traverse_no_checking(node.less) + \
-                       traverse_no_checking(node.greater)
+                less, greater = self._get_children(node)
+                return traverse_checking(less) + traverse_checking(greater)
 
-        return traverse_checking(self.tree, R)
+        return traverse_checking(0)
 
     def query_ball_point(self, x, r, p=2., eps=0):
         """Find all points within distance r of point(s) x.
@@ -858,46 +912,36 @@ class KDTree(object):
         """
         results = [[] for i in range(self.n)]
 
-        def traverse_checking(node1, rect1, node2, rect2):
+        def traverse_checking(node1, node2):
+            rect1 = self._get_node_rectangle(node1)
+            rect2 = other._get_node_rectangle(node2)
             if rect1.min_distance_rectangle(rect2, p) > r / (1. + eps):
                 return
             elif rect1.max_distance_rectangle(rect2, p) < r * (1. + eps):
                 traverse_no_checking(node1, node2)
-            elif isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    d = other.data[node2.idx]
-                    for i in node1.idx:
-                        results[i] += node2.idx[minkowski_distance(d, self.data[i], p) <= r].tolist()
+            elif self._is_leaf(node1):
+                if other._is_leaf(node2):
+                    idx2 = other._get_node_indices(node2)
+                    d = other.data[idx2]
+                    for i in self._get_node_indices(node1):
+                        results[i] += idx2[minkowski_distance(d, self.data[i], p) <= r].tolist()
                 else:
-                    less, greater = rect2.split(node2.split_dim, node2.split)
-                    traverse_checking(node1, rect1, node2.less, less)
-                    traverse_checking(node1, rect1, node2.greater, greater)
-            elif isinstance(node2, KDTree.leafnode):
-                less, greater = rect1.split(node1.split_dim, node1.split)
-                traverse_checking(node1.less, less, node2, rect2)
-                traverse_checking(node1.greater, greater, node2, rect2)
+                    for child2 in other._get_children(node2):
+                        traverse_checking(node1, child2)
+            elif other._is_leaf(node2):
+                for child1 in self._get_children(node1):
+                    traverse_checking(child1, node2)
             else:
-                less1, greater1 = rect1.split(node1.split_dim, node1.split)
-                less2, greater2 = rect2.split(node2.split_dim, node2.split)
-                traverse_checking(node1.less, less1, node2.less, less2)
-                traverse_checking(node1.less, less1, node2.greater, greater2)
-                traverse_checking(node1.greater, greater1, node2.less, less2)
-                traverse_checking(node1.greater, greater1, node2.greater, greater2)
+                for child1 in self._get_children(node1):
+                    for child2 in other._get_children(node2):
+                        traverse_checking(child1, child2)
 
         def traverse_no_checking(node1, node2):
-            if isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    for i in node1.idx:
-                        results[i] += node2.idx.tolist()
-                else:
-                    traverse_no_checking(node1, node2.less)
-                    traverse_no_checking(node1, node2.greater)
-            else:
-                traverse_no_checking(node1.less, node2)
-                traverse_no_checking(node1.greater, node2)
+            idx2 = other._get_node_indices(node2).tolist()
+            for i in self._get_node_indices(node1):
+                results[i] += idx2
 
-        traverse_checking(self.tree, Rectangle(self.maxes, self.mins),
-                          other.tree, Rectangle(other.maxes, other.mins))
+        traverse_checking(0, 0)
         return results
 
     def query_pairs(self, r, p=2., eps=0):
@@ -922,85 +966,49 @@ class KDTree(object):
         """
         results = set()
 
-        def traverse_checking(node1, rect1, node2, rect2):
+        def add_pairs(idx1, idx2):
+            for i in idx1:
+                for j in idx2:
+                    if i < j:
+                        results.add((i, j))
+                    elif j < i:
+                        results.add((j, i))
+
+        def traverse_checking(node1, node2):
+            rect1 = self._get_node_rectangle(node1)
+            rect2 = self._get_node_rectangle(node2)
             if rect1.min_distance_rectangle(rect2, p) > r / (1. + eps):
                 return
             elif rect1.max_distance_rectangle(rect2, p) < r * (1. + eps):
-                traverse_no_checking(node1, node2)
-            elif isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    # Special care to avoid duplicate pairs
-                    if id(node1) == id(node2):
-                        d = self.data[node2.idx]
-                        for i in node1.idx:
-                            for j in node2.idx[minkowski_distance(d, self.data[i], p) <= r]:
-                                if i < j:
-                                    results.add((i, j))
-                    else:
-                        d = self.data[node2.idx]
-                        for i in node1.idx:
-                            for j in node2.idx[minkowski_distance(d, self.data[i], p) <= r]:
-                                if i < j:
-                                    results.add((i, j))
-                                elif j < i:
-                                    results.add((j, i))
+                add_pairs(self._get_node_indices(node1), self._get_node_indices(node2))
+            elif self._is_leaf(node1):
+                if self._is_leaf(node2):
+                    idx2 = self._get_node_indices(node2)
+                    d = self.data[idx2]
+                    for i in self._get_node_indices(node1):
+                        add_pairs([i], idx2[minkowski_distance(d, self.data[i], p) <= r])
                 else:
-                    less, greater = rect2.split(node2.split_dim, node2.split)
-                    traverse_checking(node1, rect1, node2.less, less)
-                    traverse_checking(node1, rect1, node2.greater, greater)
-            elif isinstance(node2, KDTree.leafnode):
-                less, greater = rect1.split(node1.split_dim, node1.split)
-                traverse_checking(node1.less, less, node2, rect2)
-                traverse_checking(node1.greater, greater, node2, rect2)
+                    for child2 in self._get_children(node2):
+                        traverse_checking(node1, child2)
+            elif self._is_leaf(node2):
+                for child1 in self._get_children(node1):
+                    traverse_checking(child1, node2)
             else:
-                less1, greater1 = rect1.split(node1.split_dim, node1.split)
-                less2, greater2 = rect2.split(node2.split_dim, node2.split)
-                traverse_checking(node1.less, less1, node2.less, less2)
-                traverse_checking(node1.less, less1, node2.greater, greater2)
+                less1, greater1 = self._get_children(node1)
+                less2, greater2 = self._get_children(node2)
+                traverse_checking(less1, less2)
+                traverse_checking(less1, greater2)
 
                 # Avoid traversing (node1.less, node2.greater) and
                 # (node1.greater, node2.less) (it's the same node pair twice
                 # over, which is the source of the complication in the
                 # original KDTree.query_pairs)
-                if id(node1) != id(node2):
-                    traverse_checking(node1.greater, greater1, node2.less, less2)
-
-                traverse_checking(node1.greater, greater1, node2.greater, greater2)
+                if node1 != node2:
+                    traverse_checking(greater1, less2)
 
-        def traverse_no_checking(node1, node2):
-            if isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    # Special care to avoid duplicate pairs
-                    if id(node1) == id(node2):
-                        for i in node1.idx:
-                            for j in node2.idx:
-                                if i < j:
-                                    results.add((i, j))
-                    else:
-                        for i in node1.idx:
-                            for j in node2.idx:
-                                if i < j:
-                                    results.add((i, j))
-                                elif j < i:
-                                    results.add((j, i))
-                else:
-                    traverse_no_checking(node1, node2.less)
-                    traverse_no_checking(node1, node2.greater)
-            else:
-                # Avoid traversing (node1.less, node2.greater) and
-                # (node1.greater, node2.less) (it's the same node pair twice
-                # over, which is the source of the complication in the
-                # original KDTree.query_pairs)
-                if id(node1) == id(node2):
-                    traverse_no_checking(node1.less, node2.less)
-                    traverse_no_checking(node1.less, node2.greater)
-                    traverse_no_checking(node1.greater, node2.greater)
-                else:
-                    traverse_no_checking(node1.less, node2)
-                    traverse_no_checking(node1.greater, node2)
+                traverse_checking(greater1, greater2)
 
-        traverse_checking(self.tree, Rectangle(self.maxes, self.mins),
-                          self.tree, Rectangle(self.maxes, self.mins))
+        traverse_checking(0, 0)
         return results
 
     def count_neighbors(self, other, r, p=2.):
@@ -1028,51 +1036,46 @@ class KDTree(object):
 
         """
 
-        def traverse(node1, rect1, node2, rect2, idx):
+        def traverse(node1, node2, idx):
+            rect1 = self._get_node_rectangle(node1)
+            rect2 = other._get_node_rectangle(node2)
             min_r = rect1.min_distance_rectangle(rect2, p)
             max_r = rect1.max_distance_rectangle(rect2, p)
             c_greater = r[idx] > max_r
-            result[idx[c_greater]] += node1.children * node2.children
+            result[idx[c_greater]] += self._get_node_size(node1) * other._get_node_size(node2)
             idx = idx[(min_r <= r[idx]) & (r[idx] <= max_r)]
             if len(idx) == 0:
                 return
 
-            if isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    ds = minkowski_distance(self.data[node1.idx][:, np.newaxis, :],
-                                            other.data[node2.idx][np.newaxis, :, :],
+            if self._is_leaf(node1):
+                if other._is_leaf(node2):
+                    ds = minkowski_distance(self.data[self._get_node_indices(node1)][:, np.newaxis, :],
+                                            other.data[other._get_node_indices(node2)][np.newaxis, :, :],
                                             p).ravel()
                     ds.sort()
                     result[idx] += np.searchsorted(ds, r[idx], side='right')
                 else:
-                    less, greater = rect2.split(node2.split_dim, node2.split)
-                    traverse(node1, rect1, node2.less, less, idx)
-                    traverse(node1, rect1, node2.greater, greater, idx)
+                    for child2 in other._get_children(node2):
+                        traverse(node1, child2, idx)
             else:
-                if isinstance(node2, KDTree.leafnode):
-                    less, greater = rect1.split(node1.split_dim, node1.split)
-                    traverse(node1.less, less, node2, rect2, idx)
-                    traverse(node1.greater, greater, node2, rect2, idx)
+                if other._is_leaf(node2):
+                    for child1 in self._get_children(node1):
+                        traverse(child1, node2, idx)
                 else:
-                    less1, greater1 = rect1.split(node1.split_dim, node1.split)
-                    less2, greater2 = rect2.split(node2.split_dim, node2.split)
-                    traverse(node1.less, less1, node2.less, less2, idx)
-                    traverse(node1.less, less1, node2.greater, greater2, idx)
-                    traverse(node1.greater, greater1, node2.less, less2, idx)
-                    traverse(node1.greater, greater1, node2.greater, greater2, idx)
-
-        R1 = Rectangle(self.maxes, self.mins)
-        R2 = Rectangle(other.maxes, other.mins)
+                    for child1 in self._get_children(node1):
+                        for child2 in other._get_children(node2):
+                            traverse(child1, child2, idx)
+
         if np.shape(r) == ():
             r = np.array([r])
             result = np.zeros(1, dtype=int)
-            traverse(self.tree, R1, other.tree, R2, np.arange(1))
+            traverse(0, 0, np.arange(1))
             return result[0]
         elif len(np.shape(r)) == 1:
             r = np.asarray(r)
             n, = r.shape
             result = np.zeros(n, dtype=int)
-            traverse(self.tree, R1, other.tree, R2, np.arange(n))
+            traverse(0, 0, np.arange(n))
             return result
         else:
             raise ValueError("r must be either a single value or a one-dimensional array of values")
@@ -1096,34 +1099,29 @@ class KDTree(object):
         """
         result = scipy.sparse.dok_matrix((self.n, other.n))
 
-        def traverse(node1, rect1, node2, rect2):
-            if rect1.min_distance_rectangle(rect2, p) > max_distance:
+        def traverse(node1, node2):
+            if self._get_node_rectangle(node1).min_distance_rectangle(other._get_node_rectangle(node2),
+                                                                      p) > max_distance:
                 return
-            elif isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    for i in node1.idx:
-                        for j in node2.idx:
+            elif self._is_leaf(node1):
+                if other._is_leaf(node2):
+                    for i in self._get_node_indices(node1):
+                        for j in other._get_node_indices(node2):
                             d = minkowski_distance(self.data[i], other.data[j], p)
                             if d <= max_distance:
                                 result[i, j] = d
                 else:
-                    less, greater = rect2.split(node2.split_dim, node2.split)
-                    traverse(node1, rect1, node2.less, less)
-                    traverse(node1, rect1, node2.greater, greater)
-            elif isinstance(node2, KDTree.leafnode):
-                less, greater = rect1.split(node1.split_dim, node1.split)
-                traverse(node1.less, less, node2, rect2)
-                traverse(node1.greater, greater, node2, rect2)
+                    for child2 in other._get_children(node2):
+                        traverse(node1, child2)
+            elif other._is_leaf(node2):
+                for child1 in self._get_children(node1):
+                    traverse(child1, node2)
             else:
-                less1, greater1 = rect1.split(node1.split_dim, node1.split)
-                less2, greater2 = rect2.split(node2.split_dim, node2.split)
-                traverse(node1.less, less1, node2.less, less2)
-                traverse(node1.less, less1, node2.greater, greater2)
-                traverse(node1.greater, greater1, node2.less, less2)
-                traverse(node1.greater, greater1, node2.greater, greater2)
+                for child1 in self._get_children(node1):
+                    for child2 in other._get_children(node2):
+                        traverse(child1, child2)
 
-        traverse(self.tree, Rectangle(self.maxes, self.mins),
-                 other.tree, Rectangle(other.maxes, other.mins))
+        traverse(0, 0)
 
         return result
 
@@ -1148,7 +1146,64 @@ class HaversineDistanceKDTree(KDTree):
         if mask is not None:
             indices = np.ma.array(indices, mask=mask)
             indices = indices.compressed()
-        self.tree = self._build(indices, self.maxes, self.mins)
+        self._build(indices, self.maxes, self.mins)
+
+    def _build(self, idx, maxes, mins):
+        """
+        Build the tree as for KDTree, then find a spherical cap containing the points under each node, held in arrays
+        indexed by node number:
+
+        - node_cap_centres: the centre of the cap as latitude, longitude in radians, which is the normalised sum of the
+          points under the node as unit vectors
+        - node_cap_radii: the radius of the cap in kilometres
+
+        The caps of all of the leaves are found from their points at once. Those of the inner nodes are found from
+        their children a level at a time, from the bottom up: the sum of the unit vectors is the sum of the
+        children's, and the radius is the greatest distance from the centre to a child's centre plus that child's
+        radius. The caps are built with the tree so they are kept in the index cache and shared with worker processes.
+
+        :param idx: the data indexes which are part of the tree
+        :param maxes: the maximum value of each dimension of the data
+        :param mins: the minimum value of each dimension of the data
+        """
+        super(HaversineDistanceKDTree, self)._build(idx, maxes, mins)
+        data = np.ma.getdata(self.data)
+        node_count = len(self.node_children)
+        vector_sums = np.zeros((node_count, 3))
+        self.node_cap_centres = np.zeros((node_count, 2))
+        self.node_cap_radii = np.zeros(node_count)
+
+        leaves = np.flatnonzero((self.node_children < 0) & (self.node_ends > self.node_starts))
+        if len(leaves) > 0:
+            sizes = self.node_ends[leaves] - self.node_starts[leaves]
+            offsets = np.cumsum(sizes) - sizes
+            point_leaves = np.repeat(np.arange(len(leaves)), sizes)
+            positions = np.arange(len(point_leaves)) - offsets[point_leaves] + self.node_starts[leaves][point_leaves]
+            points = data[self.indices[positions]]
+            lat = np.radians(points[:, 0])
+            lon = np.radians(points[:, 1])
+            vectors = np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+            vector_sums[leaves] = np.add.reduceat(vectors, offsets)
+            self.node_cap_centres[leaves] = _get_cap_centres(vector_sums[leaves], np.radians(points[offsets]))
+            distances = haversine_distance(points, np.degrees(self.node_cap_centres[leaves][point_leaves]))
+            self.node_cap_radii[leaves] = np.maximum.reduceat(distances, offsets)
+
+        # The nodes of each level follow those of the level above, two for each inner node of that level
+        level_bounds = [0, 1]
+        while level_bounds[-1] < node_count:
+            start, end = level_bounds[-2:]
+            level_bounds.append(end + 2 * np.count_nonzero(self.node_children[start:end] >= 0))
+        for start, end in reversed(list(zip(level_bounds[:-1], level_bounds[1:]))):
+            inner = start + np.flatnonzero(self.node_children[start:end] >= 0)
+            less = self.node_children[inner]
+            vector_sums[inner] = vector_sums[less] + vector_sums[less + 1]
+            centres = _get_cap_centres(vector_sums[inner], self.node_cap_centres[less])
+            self.node_cap_centres[inner] = centres
+            self.node_cap_radii[inner] = np.maximum(
+                haversine_distance_from_radians(centres.T, self.node_cap_centres[less].T) +
+                self.node_cap_radii[less],
+                haversine_distance_from_radians(centres.T, self.node_cap_centres[less + 1].T) +
+                self.node_cap_radii[less + 1])
 
     def _query(self, x, k=1, eps=0, p=2, distance_upper_bound=np.inf):
 
@@ -1165,10 +1220,10 @@ class HaversineDistanceKDTree(KDTree):
         # entries are:
         #  minimum distance between the cell and the target
         #  distances between the nearest side of the cell and the target
-        #  the head node of the cell
+        #  the number of the head node of the cell
         q = [(min_distance,
               tuple(side_distances),
-              self.tree)]
+              0)]
         # priority queue for the nearest neighbors
         # furthest known neighbor first
         # entries are (-distance**p, i)
@@ -1186,15 +1241,16 @@ class HaversineDistanceKDTree(KDTree):
 
         while q:
             min_distance, side_distances, node = heappop(q)
-            if isinstance(node, HaversineDistanceKDTree.leafnode):
+            if self._is_leaf(node):
                 # brute-force
-                data = self.data[node.idx]
+                idx = self._get_node_indices(node)
+                data = self.data[idx]
                 ds = haversine_distance(data, x[np.newaxis, :])
                 for i in range(len(ds)):
                     if ds[i] < distance_upper_bound:
                         if len(neighbors) == k:
                             heappop(neighbors)
-                        heappush(neighbors, (-ds[i], node.idx[i]))
+                        heappush(neighbors, (-ds[i], idx[i]))
                         if len(neighbors) == k:
                             distance_upper_bound = -neighbors[0][0]
             else:
@@ -1205,10 +1261,12 @@ class HaversineDistanceKDTree(KDTree):
                     # since this is the nearest cell, we're done, bail out
                     break
                 # compute minimum distances to the children and push them on
-                if x[node.split_dim] < node.split:
-                    near, far = node.less, node.greater
+                split_dim, split = self.node_split_dims[node], self.node_splits[node]
+                less, greater = self._get_children(node)
+                if x[split_dim] < split:
+                    near, far = less, greater
                 else:
-                    near, far = node.greater, node.less
+                    near, far = greater, less
 
                 # near child is at the same distance as the current node
                 heappush(q, (min_distance, side_distances, near))
@@ -1217,13 +1275,13 @@ class HaversineDistanceKDTree(KDTree):
                 # on the split value
                 sd = list(side_distances)
                 if p == np.inf:
-                    min_distance = max(min_distance, abs(node.split - x[node.split_dim]))
+                    min_distance = max(min_distance, abs(split - x[split_dim]))
                 elif p == 1:
-                    sd[node.split_dim] = np.abs(node.split - x[node.split_dim])
-                    min_distance = min_distance - side_distances[node.split_dim] + sd[node.split_dim]
+                    sd[split_dim] = np.abs(split - x[split_dim])
+                    min_distance = min_distance - side_distances[split_dim] + sd[split_dim]
                 else:
-                    sd[node.split_dim] = np.abs(node.split - x[node.split_dim]) ** p
-                    min_distance = min_distance - side_distances[node.split_dim] + sd[node.split_dim]
+                    sd[split_dim] = np.abs(split - x[split_dim]) ** p
+                    min_distance = min_distance - side_distances[split_dim] + sd[split_dim]
 
                 # far child might be too far, if so, don't bother pushing it
                 if min_distance <= distance_upper_bound * epsfac:
@@ -1235,28 +1293,227 @@ class HaversineDistanceKDTree(KDTree):
             return sorted([((-d) ** (1. / p), i) for (d, i) in neighbors])
 
     def _query_ball_point(self, x, r, p=2., eps=0):
-        R = RectangleHaversine(self.maxes, self.mins)
+        return self._query_ball_point_indices(x, r, eps).tolist()
 
-        def traverse_checking(node, rect):
-            if rect.min_distance_point(x, p) > r / (1. + eps):
-                return []
-            elif rect.max_distance_point(x, p) < r * (1. + eps):
-                return traverse_no_checking(node)
-            elif isinstance(node, KDTree.leafnode):
-                d = self.data[node.idx]
-                return node.idx[haversine_distance(d, x) <= r].tolist()
-            else:
-                less, greater = rect.split(node.split_dim, node.split)
-                return traverse_checking(node.less, less) + traverse_checking(node.greater, greater)
+    def _query_ball_point_indices(self, x, r, eps=0):
+        """Finds the indices of the points within distance r of point x, in the same order as _query_ball_point.
+        The index arrays of the nodes found are concatenated once at the end rather than joined as lists.
+        :param x: point as array of latitude, longitude in degrees
+        :param r: distance in kilometres
+        :param eps: approximate search parameter, as for query_ball_point
+        :return: array of indices into the data
+        """
+        found = []
 
-        def traverse_no_checking(node):
-            if isinstance(node, KDTree.leafnode):
-                return node.idx.tolist()
+        def traverse_checking(node):
+            rect = self._get_node_rectangle(node, RectangleHaversine)
+            if rect.min_distance_point(x) > r / (1. + eps):
+                return
+            elif rect.max_distance_point(x) < r * (1. + eps):
+                found.append(self._get_node_indices(node))
+            elif self._is_leaf(node):
+                idx = self._get_node_indices(node)
+                found.append(idx[haversine_distance(self.data[idx], x) <= r])
             else:
-                return traverse_no_checking(node.less) + \
-                       traverse_no_checking(node.greater)
+                for child in self._get_children(node):
+                    traverse_checking(child)
+
+        traverse_checking(0)
+        if found:
+            return np.concatenate(found)
+        else:
+            return np.zeros(0, dtype=np.intp)
+
+    def query_ball_points(self, x, r, eps=0):
+        """Find all points within distance r of each of the points x.
+
+        Unlike query_ball_point, the result is returned in compressed sparse
+        row form rather than as an object array of lists.
+
+        :param x: array of shape (n, 2) of points as latitude, longitude in degrees
+        :param r: distance in kilometres
+        :param eps: approximate search parameter, as for query_ball_point
+        :returns: tuple of (offsets, indices) - the indices of the neighbours of
+            point i are indices[offsets[i]:offsets[i + 1]]
+        """
+        x = np.asarray(x)
+        offsets = np.zeros(len(x) + 1, dtype=np.intp)
+        found = []
+        for i in range(len(x)):
+            point_indices = self._query_ball_point_indices(x[i], r, eps)
+            offsets[i + 1] = offsets[i] + len(point_indices)
+            found.append(point_indices)
+        if offsets[-1] > 0:
+            indices = np.concatenate(found)
+        else:
+            indices = np.zeros(0, dtype=np.intp)
+        return offsets, indices
+
+    def query_nearest_within_points(self, x, r, check=None):
+        """Find the nearest point within distance r of each of the points x which passes a check.
+
+        All of the points are searched for together. Each point first goes down to the leaf it falls in, giving a
+        bound on the distance to its nearest point, which is at most r. The tree is then traversed a level at a time
+        for all of the points at once: a node is only visited for a point if the spherical cap around the node's data
+        points comes within the point's bound, and the leaves reached are searched together, tightening the bounds.
+        The check is applied at the leaves to the points within the bound, so the points within distance r are never
+        all collected.
+
+        :param x: array of shape (n, 2) of points as latitude, longitude in degrees
+        :param r: distance in kilometres
+        :param check: optional function given an array of the numbers of points in x and an array of indices of data
+            points, returning a boolean array which is True for the pairs which may be returned
+        :returns: tuple of (array of indices of the nearest points, array of distances to them in kilometres) - of
+            the points at the same distance the one with the lowest index is returned. Where there is no such point
+            the index is self.n and the distance is inf
+        """
+        x = np.asarray(x, dtype=np.float64).reshape(-1, 2)
+        data = np.ma.getdata(self.data)
+        nearest = np.full(len(x), self.n, dtype=np.intp)
+        nearest_distances = np.full(len(x), np.inf)
+        bounds = np.full(len(x), float(r))
+
+        def search_leaves(rows, leaves):
+            sizes = self.node_ends[leaves] - self.node_starts[leaves]
+            offsets = np.cumsum(sizes) - sizes
+            pair_leaves = np.repeat(np.arange(len(leaves)), sizes)
+            positions = np.arange(len(pair_leaves)) - offsets[pair_leaves] + self.node_starts[leaves][pair_leaves]
+            pair_rows = rows[pair_leaves]
+            idx = self.indices[positions]
+            ds = haversine_distance(data[idx], x[pair_rows]) if len(idx) > 0 else np.zeros(0)
+            within = ds <= bounds[pair_rows]
+            pair_rows, idx, ds = pair_rows[within], idx[within], ds[within]
+            if check is not None and len(idx) > 0:
+                passed = np.asarray(check(pair_rows, idx), dtype=bool)
+                pair_rows, idx, ds = pair_rows[passed], idx[passed], ds[passed]
+            if len(idx) == 0:
+                return
+            # The nearest candidate for each point, taking the lowest index of those at the same distance
+            order = np.lexsort((idx, ds, pair_rows))
+            pair_rows, idx, ds = pair_rows[order], idx[order], ds[order]
+            first = np.ones(len(pair_rows), dtype=bool)
+            first[1:] = pair_rows[1:] != pair_rows[:-1]
+            pair_rows, idx, ds = pair_rows[first], idx[first], ds[first]
+            better = (ds < nearest_distances[pair_rows]) | ((ds == nearest_distances[pair_rows]) &
+                                                            (idx < nearest[pair_rows]))
+            pair_rows = pair_rows[better]
+            nearest[pair_rows] = idx[better]
+            nearest_distances[pair_rows] = ds[better]
+            bounds[pair_rows] = ds[better]
+
+        if self.n == 0 or len(x) == 0:
+            return nearest, nearest_distances
+
+        # Search the leaf each point falls in
+        rows = np.arange(len(x))
+        nodes = np.zeros(len(x), dtype=np.intp)
+        inner = np.flatnonzero(self.node_children[nodes] >= 0)
+        while len(inner) > 0:
+            node = nodes[inner]
+            greater = x[inner, self.node_split_dims[node]] >= self.node_splits[node]
+            nodes[inner] = self.node_children[node] + greater
+            inner = inner[self.node_children[nodes[inner]] >= 0]
+        search_leaves(rows, nodes)
+
+        # Traverse the tree a level at a time from the root for all of the points, visiting only the nodes whose caps
+        # come within the bound of the point
+        x_radians = np.radians(x)
+        nodes = np.zeros(len(x), dtype=np.intp)
+        while len(rows) > 0:
+            min_distances = haversine_distance_from_radians(x_radians[rows].T, self.node_cap_centres[nodes].T) - \
+                self.node_cap_radii[nodes]
+            near = min_distances <= bounds[rows] + CAP_TOLERANCE
+            rows, nodes = rows[near], nodes[near]
+            leaf = self.node_children[nodes] < 0
+            search_leaves(rows[leaf], nodes[leaf])
+            rows = np.repeat(rows[~leaf], 2)
+            nodes = np.repeat(self.node_children[nodes[~leaf]], 2)
+            nodes[1::2] += 1
+        return nearest, nearest_distances
+
+    def query_ball_tree(self, other, r, p=2., eps=0):
+        """Find all pairs of points whose distance along the Earth's surface is at most r
+
+        :param other: HaversineDistanceKDTree instance
+            The tree containing points to search against.
+        :param r: distance in kilometres
+        :param p: unused
+        :param eps: approximate search parameter, as for query_ball_point
+        :returns: list of lists
+            For each element ``self.data[i]`` of this tree, ``results[i]`` is a
+            sorted list of the indices of its neighbors in ``other.data``.
+        """
+        offsets, indices = self.query_ball_tree_offsets(other, r, eps)
+        return [indices[offsets[i]:offsets[i + 1]].tolist() for i in range(self.n)]
+
+    def query_ball_tree_offsets(self, other, r, eps=0):
+        """Find all pairs of points whose distance along the Earth's surface is at most r.
 
-        return traverse_checking(self.tree, R)
+        Both trees are traversed together. Each node is bounded by a spherical
+        cap around its points, so whole pairs of nodes can be rejected or
+        accepted at once using the distance between the cap centres.
+
+        :param other: HaversineDistanceKDTree instance
+            The tree containing points to search against.
+        :param r: distance in kilometres
+        :param eps: approximate search parameter, as for query_ball_point
+        :returns: tuple of (offsets, indices) - the indices in ``other.data``
+            of the neighbours of ``self.data[i]`` are indices[offsets[i]:offsets[i + 1]], in ascending order
+        """
+        self_data = np.ma.getdata(self.data)
+        other_data = np.ma.getdata(other.data)
+        self_centres, self_radii = self.node_cap_centres, self.node_cap_radii
+        other_centres, other_radii = other.node_cap_centres, other.node_cap_radii
+        found_self = []
+        found_other = []
+
+        def traverse(node1, node2):
+            radius1, radius2 = self_radii[node1], other_radii[node2]
+            centre_distance = haversine_distance_from_radians(self_centres[node1], other_centres[node2])
+            if centre_distance - radius1 - radius2 > r / (1. + eps):
+                return
+            idx1 = self._get_node_indices(node1)
+            idx2 = other._get_node_indices(node2)
+            if centre_distance + radius1 + radius2 < r * (1. + eps):
+                found_self.append(np.repeat(idx1, len(idx2)))
+                found_other.append(np.tile(idx2, len(idx1)))
+            elif self._is_leaf(node1) and other._is_leaf(node2):
+                pairs1 = np.repeat(idx1, len(idx2))
+                pairs2 = np.tile(idx2, len(idx1))
+                within = haversine_distance(self_data[pairs1], other_data[pairs2]) <= r
+                found_self.append(pairs1[within])
+                found_other.append(pairs2[within])
+            elif self._is_leaf(node1) or (not other._is_leaf(node2) and len(idx2) > len(idx1)):
+                for child2 in other._get_children(node2):
+                    traverse(node1, child2)
+            else:
+                for child1 in self._get_children(node1):
+                    traverse(child1, node2)
+
+        traverse(0, 0)
+
+        offsets = np.zeros(self.n + 1, dtype=np.intp)
+        if not found_self:
+            return offsets, np.zeros(0, dtype=np.intp)
+        self_indices = np.concatenate(found_self)
+        other_indices = np.concatenate(found_other)
+        order = np.lexsort((other_indices, self_indices))
+        np.cumsum(np.bincount(self_indices, minlength=self.n), out=offsets[1:])
+        return offsets, other_indices[order].astype(np.intp)
+
+
+def _get_cap_centres(vector_sums, fallback_centres):
+    """Converts sums of unit vectors to the latitudes and longitudes of the centres of spherical caps.
+    :param vector_sums: array of shape (n, 3) of sums of unit vectors
+    :param fallback_centres: array of shape (n, 2) of the latitudes and longitudes in radians to use where the sum is
+     zero
+    :return: array of shape (n, 2) of latitudes and longitudes in radians
+    """
+    x, y, z = vector_sums[:, 0], vector_sums[:, 1], vector_sums[:, 2]
+    centres = np.column_stack((np.arctan2(z, np.hypot(x, y)), np.arctan2(y, x)))
+    zero = (x == 0) & (y == 0) & (z == 0)
+    centres[zero] = fallback_centres[zero]
+    return centres
 
 
 def distance_matrix(x, y, p=2, threshold=1000000):
@@ -0,0 +1,284 @@
+"""
+Metrics of the time spent in each phase of a collocation and of the work done by the constraints, kernels and indexes,
+which can be used to choose parameters such as h_sep and the index leaf size from the data.
+
+Collocators, constraints and indexes report into the metrics set with :func:`set_metrics`. When no metrics are set
+reporting does nothing, so the collocation is not slowed down.
+"""
+import json
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+
+#: The phases of a collocation, in the order they are run
+PHASES = ('read', 'fix_longitudes', 'prefilter', 'index_build', 'query', 'kernel', 'write')
+
+#: Phase in which the query and kernel are timed together, when they are run in worker processes
+QUERY_AND_KERNEL_PHASE = 'query_and_kernel'
+
+
+class CollocationMetrics(object):
+    """
+    Wall times of the phases of one or more collocations, and statistics of the points processed, the candidate data
+    points found for each sample point or cell, the indexes built and the empty cells.
+    """
+
+    def __init__(self):
+        self.phase_times = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.points_processed = 0
+        # Number of sample points or cells for which each number of candidate points was found, binned by powers of two
+        self.candidate_histogram = np.zeros(0, dtype=np.int64)
+        self.candidate_queries = 0
+        self.candidate_total = 0
+        self.candidate_min = None
+        self.candidate_max = None
+        self.indexes = []
+        self.cells = 0
+        self.empty_cells = 0
+
+    def timed(self, phase):
+        """
+        Context manager which adds the wall time spent in the block to a phase.
+
+        :param str phase: name of the phase
+        """
+        return _PhaseTimer(self, phase)
+
+    def add_time(self, phase, seconds):
+        """
+        Adds wall time to a phase.
+
+        :param str phase: name of the phase
+        :param float seconds: time in seconds
+        """
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+    def add_points_processed(self, count):
+        """
+        :param int count: number of sample points or cells collocated
+        """
+        self.points_processed += int(count)
+
+    def add_candidate_counts(self, counts):
+        """
+        Adds the numbers of candidate data points found for a number of sample points or cells.
+
+        :param counts: array of the number of candidates for each sample point or cell
+        """
+        counts = np.asarray(counts, dtype=np.int64).ravel()
+        if len(counts) == 0:
+            return
+        bins = np.bincount(_get_histogram_bins(counts))
+        if len(bins) > len(self.candidate_histogram):
+            self.candidate_histogram = np.concatenate(
+                (self.candidate_histogram, np.zeros(len(bins) - len(self.candidate_histogram), dtype=np.int64)))
+        self.candidate_histogram[:len(bins)] += bins
+        self.candidate_queries += len(counts)
+        self.candidate_total += int(counts.sum())
+        self.candidate_min = _min_or_none(self.candidate_min, int(counts.min()))
+        self.candidate_max = _max_or_none(self.candidate_max, int(counts.max()))
+
+    def add_index(self, name, build_time, stats, cached=False):
+        """
+        Records an index built (or loaded from the index cache) for a constraint or kernel.
+
+        :param str name: name of the index class
+        :param float build_time: time in seconds to build or load the index
+        :param dict stats: statistics of the index, e.g. the depth and number of leaves of a tree
+        :param bool cached: True if the index was loaded from the index cache
+        """
+        index = OrderedDict([('name', name), ('build_time', build_time), ('cached', cached)])
+        index.update(stats)
+        self.indexes.append(index)
+
+    def add_cells(self, cells, empty_cells):
+        """
+        :param int cells: number of cells of a grid collocated onto
+        :param int empty_cells: number of those cells for which no value was found
+        """
+        self.cells += int(cells)
+        self.empty_cells += int(empty_cells)
+
+    @property
+    def points_per_second(self):
+        """
+        The number of sample points or cells collocated per second spent querying the data and applying the kernel.
+        """
+        seconds = sum(self.phase_times.get(phase, 0.0) for phase in ('query', 'kernel', QUERY_AND_KERNEL_PHASE))
+        if seconds <= 0:
+            return None
+        return self.points_processed / seconds
+
+    def to_dict(self):
+        """
+        :return: the metrics as a dictionary of values which can be written as JSON
+        """
+        histogram = OrderedDict((_get_histogram_label(bin_number), int(count))
+                                for bin_number, count in enumerate(self.candidate_histogram))
+        candidates = OrderedDict([('queries', self.candidate_queries),
+                                  ('min', self.candidate_min),
+                                  ('max', self.candidate_max),
+                                  ('mean', float(self.candidate_total) / self.candidate_queries
+                                   if self.candidate_queries else None),
+                                  ('histogram', histogram)])
+        return OrderedDict([('phase_times', OrderedDict(self.phase_times)),
+                            ('points_processed', self.points_processed),
+                            ('points_per_second', self.points_per_second),
+                            ('candidates', candidates),
+                            ('indexes', self.indexes),
+                            ('cells', self.cells),
+                            ('empty_cells', self.empty_cells)])
+
+    def write_json(self, filename):
+        """
+        Writes the metrics to a JSON file.
+
+        :param str filename: name of the file
+        """
+        with open(filename, 'w') as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
+
+
+class _PhaseTimer(object):
+    """
+    Context manager adding the time spent in a block to a phase of some metrics.
+    """
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.add_time(self.phase, time() - self.start)
+        return False
+
+
+class _NoTimer(object):
+    """
+    Context manager which does nothing, used when no metrics are set.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+def _get_histogram_bins(counts):
+    """
+    Bins numbers of candidates by powers of two: bin 0 holds 0, bin 1 holds 1, bin 2 holds 2-3, bin 3 holds 4-7 etc.
+    """
+    bins = np.zeros(len(counts), dtype=np.intp)
+    nonzero = counts > 0
+    bins[nonzero] = np.floor(np.log2(counts[nonzero])).astype(np.intp) + 1
+    return bins
+
+
+def _get_histogram_label(bin_number):
+    if bin_number < 2:
+        return str(bin_number)
+    return '{}-{}'.format(2 ** (bin_number - 1), 2 ** bin_number - 1)
+
+
+def _min_or_none(current, value):
+    return value if current is None else min(current, value)
+
+
+def _max_or_none(current, value):
+    return value if current is None else max(current, value)
+
+
+def get_tree_stats(root, get_children, get_leaf_size):
+    """
+    Gets the depth and leaf counts of a tree of nodes.
+
+    :param root: root node of the tree
+    :param get_children: function returning a sequence of the children of a node, which is empty for a leaf
+    :param get_leaf_size: function returning the number of points in a leaf
+    :return: dictionary of the depth, number of leaves, and the largest and mean number of points in a leaf
+    """
+    depth = 0
+    leaves = 0
+    leaf_points = 0
+    largest_leaf = 0
+    # Walk the tree without recursion, as it can be deeper than the recursion limit.
+    stack = [(root, 1)]
+    while stack:
+        node, level = stack.pop()
+        depth = max(depth, level)
+        children = get_children(node)
+        if children:
+            stack.extend((child, level + 1) for child in children)
+        else:
+            size = get_leaf_size(node)
+            leaves += 1
+            leaf_points += size
+            largest_leaf = max(largest_leaf, size)
+    return OrderedDict([('depth', depth), ('leaves', leaves), ('largest_leaf', largest_leaf),
+                        ('mean_leaf', float(leaf_points) / leaves if leaves else None)])
+
+
+# The metrics which are reported into (a CollocationMetrics), or None if metrics are not being recorded
+_metrics = None
+
+
+def set_metrics(metrics):
+    """
+    Sets the metrics which collocators, constraints, kernels and indexes report into.
+
+    :param metrics: CollocationMetrics instance, or None to stop recording metrics
+    """
+    global _metrics
+    _metrics = metrics
+
+
+def get_metrics():
+    """
+    :return: the CollocationMetrics being reported into, or None if metrics are not being recorded
+    """
+    return _metrics
+
+
+def timed(phase):
+    """
+    Context manager which adds the wall time spent in the block to a phase of the metrics, if any are set.
+
+    :param str phase: name of the phase
+    """
+    if _metrics is None:
+        return _no_timer
+    return _metrics.timed(phase)
+
+
+def add_points_processed(count):
+    if _metrics is not None:
+        _metrics.add_points_processed(count)
+
+
+def add_candidate_counts(counts):
+    if _metrics is not None:
+        _metrics.add_candidate_counts(counts)
+
+
+def add_index(name, build_time, index, cached=False):
+    """
+    Records an index in the metrics, if any are set, with the statistics given by its get_metrics method if it has one.
+    """
+    if _metrics is not None:
+        stats = index.get_metrics() if hasattr(index, 'get_metrics') else {}
+        _metrics.add_index(name, build_time, stats, cached)
+
+
+def add_cells(cells, empty_cells):
+    if _metrics is not None:
+        _metrics.add_cells(cells, empty_cells)
@@ -0,0 +1,153 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from cis.collocation.haversinedistancekdtreeindex import _unique_locations, _expand_unique_offsets
+from cis.collocation.kdtree import haversine_distance, RADIUS_EARTH
+from cis.collocation.metrics import get_tree_stats
+from cis.data_io.hyperpoint import HyperPoint
+
+# Relative amount by which the chord length is increased when searching, so that rounding in the conversion from
+# distance along the surface can never exclude a point. Candidates are then checked using the haversine distance.
+CHORD_TOLERANCE = 1.0e-9
+
+
+def lat_lon_to_unit_vectors(latitudes, longitudes):
+    """Converts latitudes and longitudes to Cartesian unit vectors.
+    :param latitudes: array of latitudes in degrees
+    :param longitudes: array of longitudes in degrees
+    :return: array of shape (n, 3)
+    """
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def distance_to_chord(distance):
+    """Converts a distance along the Earth's surface to the length of the chord between the points on a unit sphere.
+    :param distance: distance in kilometres
+    :return: chord length
+    """
+    return 2.0 * np.sin(np.minimum(distance / (2.0 * RADIUS_EARTH), np.pi / 2.0))
+
+
+class UnitSphereKDTreeIndex(object):
+    """k-D tree index of points converted to 3-D unit vectors, which can be used to query using distance along the
+    Earth's surface. Distance along the surface is a monotonic function of the straight line (chord) distance between
+    unit vectors, so the tree can use ordinary Euclidean distances with no special handling of the poles or dateline.
+
+    Gives the same results as HaversineDistanceKDTreeIndex.
+    """
+    def __init__(self):
+        self.index = None
+        self.data_indices = None
+        self.latitudes = None
+        self.longitudes = None
+
+    def index_data(self, points, data, coord_map, leafsize=10):
+        """
+        Creates the k-D tree index.
+
+        :param points: (not used) sample points
+        :param data: HyperPointView of the data to index
+        :param coord_map: (not used) list of tuples relating index in HyperPoint
+                          to index in sample point coords and in coords to be output
+        """
+        coords = data.coords_flattened
+        self.data_indices = data.non_masked_indices()
+        self.latitudes = np.asarray(coords[HyperPoint.LATITUDE])[self.data_indices]
+        self.longitudes = np.asarray(coords[HyperPoint.LONGITUDE])[self.data_indices]
+        if len(self.data_indices) > 0:
+            self.index = cKDTree(lat_lon_to_unit_vectors(self.latitudes, self.longitudes), leafsize=leafsize)
+
+    def get_metrics(self):
+        """
+        :return: dictionary of the depth and leaf counts of the tree, for collocation metrics, which is empty if the
+         version of scipy does not give access to the nodes of the tree
+        """
+        root = getattr(self.index, 'tree', None)
+        if root is None:
+            return {}
+        stats = get_tree_stats(root, lambda node: (node.lesser, node.greater) if node.split_dim >= 0 else (),
+                               lambda node: node.children)
+        stats['leafsize'] = self.index.leafsize
+        return stats
+
+    def find_nearest_point(self, point):
+        """Finds the indexed point nearest to a specified point.
+        :param point: point for which the nearest point is required
+        :return: index in data of closest point
+        """
+        indices, distances = self.find_nearest_points([point.latitude], [point.longitude])
+        if distances[0] == np.inf:
+            return None
+        else:
+            return indices[0]
+
+    def find_points_within_distance(self, point, distance):
+        """Finds the points within a specified distance of a specified point.
+        :param point: reference point
+        :param distance: distance in kilometres
+        :return: list indices in data of points
+        """
+        offsets, indices = self.find_points_within_distance_of_points([point.latitude], [point.longitude], distance)
+        return indices.tolist()
+
+    def find_nearest_points(self, latitudes, longitudes):
+        """Finds the indexed points nearest to each of a set of points.
+        :param latitudes: array of latitudes of the points for which the nearest points are required
+        :param longitudes: array of longitudes of the points for which the nearest points are required
+        :return: tuple of (indices in data of closest points, distances to them in kilometres) - where no point was
+         found the distance is inf and the index is not valid
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if self.index is None:
+            return np.zeros(len(latitudes), dtype=np.intp), np.repeat(np.inf, len(latitudes))
+        chords, tree_indices = self.index.query(lat_lon_to_unit_vectors(latitudes, longitudes))
+        distances = haversine_distance(np.column_stack((latitudes, longitudes)),
+                                       np.column_stack((self.latitudes[tree_indices],
+                                                        self.longitudes[tree_indices])))
+        return self.data_indices[tree_indices], distances
+
+    def find_points_within_distance_of_points(self, latitudes, longitudes, distance):
+        """Finds the indexed points within a specified distance of each of a set of points. Each distinct location is
+        only looked up once.
+        :param latitudes: array of latitudes of the reference points
+        :param longitudes: array of longitudes of the reference points
+        :param distance: distance in kilometres
+        :return: tuple of (offsets, indices) - the indices in data of the points within the distance of reference
+         point i are indices[offsets[i]:offsets[i + 1]], in ascending order
+        """
+        unique_lats, unique_lons, inverse = _unique_locations(latitudes, longitudes)
+        unique_offsets = np.zeros(len(unique_lats) + 1, dtype=np.intp)
+        if self.index is None or len(unique_lats) == 0:
+            return _expand_unique_offsets(unique_offsets, np.zeros(0, dtype=np.intp), inverse)
+
+        chord = distance_to_chord(distance) * (1.0 + CHORD_TOLERANCE)
+        candidate_lists = self.index.query_ball_point(lat_lon_to_unit_vectors(unique_lats, unique_lons), chord)
+        counts = np.array([len(candidates) for candidates in candidate_lists], dtype=np.intp)
+        rows = np.repeat(np.arange(len(unique_lats)), counts)
+        if counts.sum() > 0:
+            tree_indices = np.concatenate([np.asarray(candidates, dtype=np.intp) for candidates in candidate_lists])
+        else:
+            tree_indices = np.zeros(0, dtype=np.intp)
+
+        # Check the candidates using exactly the same distance test as the haversine k-D tree.
+        within = haversine_distance(np.column_stack((self.latitudes[tree_indices], self.longitudes[tree_indices])),
+                                    np.column_stack((unique_lats[rows], unique_lons[rows]))) <= distance
+        rows = rows[within]
+        indices = self.data_indices[tree_indices[within]]
+        order = np.lexsort((indices, rows))
+        np.cumsum(np.bincount(rows, minlength=len(unique_lats)), out=unique_offsets[1:])
+        return _expand_unique_offsets(unique_offsets, indices[order], inverse)
+
+    def find_pairs_within_distance(self, latitudes, longitudes, distance):
+        """Finds the indexed points within a specified distance of each of a set of points.
+        :param latitudes: array of latitudes of the reference points
+        :param longitudes: array of longitudes of the reference points
+        :param distance: distance in kilometres
+        :return: tuple of (offsets, indices) - the indices in data of the points within the distance of reference
+         point i are indices[offsets[i]:offsets[i + 1]], in ascending order
+        """
+        return self.find_points_within_distance_of_points(latitudes, longitudes, distance)
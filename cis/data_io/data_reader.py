@@ -99,6 +99,26 @@ class DataReader(object):
         assert data_list is not None
         return data_list
 
+    def read_data_list_by_file(self, filenames, variables, product=None, aliases=None):
+        """
+        Read multiple data objects from one file at a time, so that only the data from a single file need be held in
+        memory at once. Any wildcards in the variable names are expanded using all of the files.
+
+        :param filenames: One or more filenames of the files to read
+        :type filenames: string or list
+        :param variables: One or more variables to read from the files
+        :type variables: string or list
+        :param str product: Name of data product to use (optional)
+        :param aliases: List of variable aliases to put on each variables
+         data object as an alternative means of identifying them. (Optional)
+        :return: A generator of the data read out from each file in turn (each either a GriddedDataList or
+         UngriddedDataList as returned by read_data_list)
+        """
+        filenames = listify(filenames)
+        variables = self._expand_wildcards(listify(variables), filenames)
+        for filename in filenames:
+            yield self.read_data_list([filename], variables, product, aliases)
+
     def _expand_wildcards(self, variables, filenames):
         """
         Convert any wildcards into actual variable names by inspecting the file
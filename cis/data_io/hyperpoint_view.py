@@ -1,8 +1,10 @@
-from abc import ABCMeta, abstractmethod
+from abc import ABCMeta, abstractmethod, abstractproperty
+import datetime
 
 import numpy as np
 
 from cis.data_io.hyperpoint import HyperPoint
+from cis.time_util import convert_obj_to_standard_date_array
 import cis.utils
 
 
@@ -55,6 +57,47 @@ class HyperPointView(object):
     def __setitem__(self, key, value):
         pass
 
+    @abstractproperty
+    def coords_flattened(self):
+        """Returns the standard coordinate values of every point as flattened arrays, in the order of the flattened
+        data. Times given as datetimes are converted to standard times, as they are in HyperPoints.
+        :return: list of 1D numpy arrays (or None where the coordinate is not present) in HyperPoint standard order
+        """
+        pass
+
+    @abstractproperty
+    def data_flattened(self):
+        """Returns the data values of every point as a flattened (masked) array.
+        :return: 1D numpy array of the data values or None if there is no data
+        """
+        pass
+
+    def non_masked_indices(self):
+        """Finds the indices of all points that do not have a masked data value.
+        :return: 1D numpy array of indices into the flattened data
+        """
+        data = self.data_flattened
+        if data is None:
+            return np.arange(len(self))
+        return np.flatnonzero(~np.ma.getmaskarray(data))
+
+    def as_batch(self):
+        """Gets all of the points as a HyperPointBatch, in the order of the flattened data.
+        :return: HyperPointBatch
+        """
+        return HyperPointBatch(self.coords_flattened, self.data_flattened,
+                               non_masked_iteration=self.non_masked_iteration)
+
+
+def _as_standard_coord_array(values):
+    """Converts an array of coordinate values to the form held in HyperPoints, i.e. with times as standard times.
+    :param values: 1D numpy array of coordinate values
+    :return: 1D numpy array
+    """
+    if values.size > 0 and isinstance(values[0], datetime.datetime):
+        return convert_obj_to_standard_date_array(values)
+    return values
+
 
 class UngriddedHyperPointView(HyperPointView):
     """
@@ -73,12 +116,22 @@ class UngriddedHyperPointView(HyperPointView):
         # Data and all coordinates should have the same size.
         self.length = coords[0].size
         self.non_masked_iteration = non_masked_iteration
+        # Pairs of (coordinate array, same values with times as standard times) from the last call of coords_flattened
+        self._standard_coords = None
 
     def __getitem__(self, item):
         if isinstance(item, slice):
-            # Cannot handle slicing.
-            # TODO Should return a new UngriddedHyperPointView.
-            raise NotImplementedError
+            # Only contiguous slices are supported; they give a view of the same arrays.
+            if item.step not in (None, 1):
+                raise NotImplementedError
+            return UngriddedHyperPointView([(c[item] if c is not None else None) for c in self.coords],
+                                           self.data[item] if self.data is not None else None,
+                                           non_masked_iteration=self.non_masked_iteration)
+        if isinstance(item, np.ndarray):
+            # An array of indices or a boolean mask gives a batch of copies of the selected points.
+            return HyperPointBatch([(c[item] if c is not None else None) for c in self.coords],
+                                   self.data[item] if self.data is not None else None,
+                                   non_masked_iteration=self.non_masked_iteration)
         if item < 0 or item >= self.length:
             raise IndexError("list index out of range")
         val = [(c[item] if c is not None else None) for c in self.coords]
@@ -136,6 +189,7 @@ class UngriddedHyperPointView(HyperPointView):
                 coord = self.coords[idx]
                 if coord is not None:
                     coord[key] = val
+            self._standard_coords = None
             self.data[key] = value[HyperPoint.number_standard_names][0]
         else:
             self.data[key] = value
@@ -156,6 +210,21 @@ class UngriddedHyperPointView(HyperPointView):
         longitudes = np.where(longitudes < range_start, longitudes + 360, longitudes)
         self.coords[HyperPoint.LONGITUDE] = np.where(longitudes >= range_end, longitudes - 360, longitudes)
 
+    @property
+    def coords_flattened(self):
+        # The times are converted once and kept, and only converted again for a coordinate array which has since been
+        # replaced, e.g. by set_longitude_range.
+        if self._standard_coords is None:
+            self._standard_coords = [(None, None)] * len(self.coords)
+        self._standard_coords = [(c, converted if c is source else
+                                  (_as_standard_coord_array(c) if c is not None else None))
+                                 for c, (source, converted) in zip(self.coords, self._standard_coords)]
+        return [converted for _, converted in self._standard_coords]
+
+    @property
+    def data_flattened(self):
+        return self.data
+
     @property
     def vals(self):
         return self.data
@@ -211,10 +280,12 @@ class GriddedHyperPointView(HyperPointView):
     def __getitem__(self, item):
         """Get HyperPoint specified by index.
         :param item: index of item, either a scalar int over flattened data or
-                     a tuple of coordinate indices
-        :type item: tuple or int
-        :return: HyperPoint corresponding to data point
+                     a tuple of coordinate indices, or an array of indices or boolean mask over the flattened data
+        :type item: tuple or int or numpy array
+        :return: HyperPoint corresponding to data point, or a HyperPointBatch of the points selected by an array
         """
+        if isinstance(item, np.ndarray):
+            return self._get_batch(item)
         val = [None] * HyperPoint.number_standard_names
         if isinstance(item, tuple):
             if any(isinstance(i, slice) for i in item):
@@ -240,6 +311,19 @@ class GriddedHyperPointView(HyperPointView):
             val.append(self.data[indices])
         return HyperPoint(*val)
 
+    def _get_batch(self, item):
+        """Gets some of the points as a HyperPointBatch, taking the coordinate values from the dimension coordinates
+        rather than flattening them all.
+        :param item: array of indices or boolean mask over the flattened data
+        :return: HyperPointBatch
+        """
+        flat_indices = np.flatnonzero(item) if item.dtype == bool else item
+        indices = np.unravel_index(flat_indices, self.data.shape, order='C')
+        coords = [None] * HyperPoint.number_standard_names
+        for dim_idx, sc_idx in self.dims_to_std_coords_map.iteritems():
+            coords[sc_idx] = _as_standard_coord_array(np.asarray(self.coords[dim_idx]))[indices[dim_idx]]
+        return HyperPointBatch(coords, self.data[indices], non_masked_iteration=self.non_masked_iteration)
+
     def __len__(self):
         """Returns the number of points (including masked ones)
         :return: number of points
@@ -348,6 +432,23 @@ class GriddedHyperPointView(HyperPointView):
                 new_coord[i] = new_lon
             self.longitudes = new_coord
 
+    @property
+    def coords_flattened(self):
+        shape = self.data.shape
+        all_coords = [None] * HyperPoint.number_standard_names
+        for dim_idx, sc_idx in self.dims_to_std_coords_map.iteritems():
+            # In C order each value of a dimension's coordinate is repeated for every point of the later
+            # dimensions, and that whole pattern is repeated for every point of the earlier dimensions.
+            inner = int(np.prod(shape[dim_idx + 1:]))
+            outer = int(np.prod(shape[:dim_idx]))
+            coord = _as_standard_coord_array(np.asarray(self.coords[dim_idx]))
+            all_coords[sc_idx] = np.tile(np.repeat(coord, inner), outer)
+        return all_coords
+
+    @property
+    def data_flattened(self):
+        return self.data.ravel() if self.data is not None else None
+
     def _dimension_index_for_hyperpoint_index(self, hp_index):
         """Finds the index of the dimension corresponding to a hyperpoint coordinate index.
         :param hp_index: hyperpoint coordinate index
@@ -423,3 +524,74 @@ class GriddedHyperPointView(HyperPointView):
             raise ValueError("Attempt to set time coordinate for GriddedData without times")
         else:
             self.coords[dim_idx] = coord
+
+
+class HyperPointBatch(UngriddedHyperPointView):
+    """
+    Batch of points held as columns: an array of the values of each standard coordinate, with times as standard times
+    as they are in HyperPoints, and an array of the data values. Slicing, gathering with an array of indices and
+    filtering with a boolean mask give new batches without making a HyperPoint for each point, so constraints and
+    kernels can work on the columns directly. Indexing with a single integer gives a HyperPoint, as for other views.
+    """
+    def __init__(self, coords, data, non_masked_iteration=False):
+        """
+        :param coords: coordinate values at points in HyperPoint standard order
+        :type coords: list of 1D numpy arrays or None
+        :param data: data values at points (optional)
+        :type data: 1D numpy array or None
+        :param non_masked_iteration: if true, the default iterator omits masked points
+        """
+        self.coords = [(_as_standard_coord_array(np.asarray(c)) if c is not None else None) for c in coords]
+        self.data = data
+        self.non_masked_iteration = non_masked_iteration
+        # Any of the coordinates may be missing, e.g. for points taken from a grid.
+        columns = [c for c in self.coords if c is not None]
+        if columns:
+            self.length = columns[0].size
+        else:
+            self.length = data.size if data is not None else 0
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._select(item)
+        if isinstance(item, (np.ndarray, list)):
+            return self._select(np.asarray(item))
+        return super(HyperPointBatch, self).__getitem__(item)
+
+    def _select(self, item):
+        """Selects some of the points with a slice, an array of indices or a boolean mask.
+        :return: HyperPointBatch
+        """
+        return HyperPointBatch([(c[item] if c is not None else None) for c in self.coords],
+                               self.data[item] if self.data is not None else None,
+                               non_masked_iteration=self.non_masked_iteration)
+
+    def take(self, indices):
+        """Gathers the points at an array of indices.
+        :param indices: array of indices of the points
+        :return: HyperPointBatch
+        """
+        return self._select(np.asarray(indices, dtype=np.intp))
+
+    def filter(self, mask):
+        """Keeps the points where a boolean mask is True.
+        :param mask: boolean array with a value for each point
+        :return: HyperPointBatch
+        """
+        return self._select(np.asarray(mask, dtype=bool))
+
+    def non_masked(self):
+        """Gets the points which do not have a masked data value.
+        :return: HyperPointBatch
+        """
+        if self.data is None:
+            return self
+        return self.filter(~np.ma.getmaskarray(self.data))
+
+    def as_batch(self):
+        return self
+
+    @property
+    def coords_flattened(self):
+        # The times are already standard times.
+        return self.coords
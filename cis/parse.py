@@ -11,6 +11,11 @@ from cis.exceptions import InvalidCommandLineOptionError
 from plotting.plot import Plotter
 from utils import add_file_prefix
 
+# Default limit on the total size of the indexes kept in an index cache directory, in MB
+DEFAULT_INDEX_CACHE_SIZE_MB = 1024
+# Kernels which can calculate the final statistics from partial aggregates
+MERGE_AGGREGATES_KERNELS = ['mean', 'stddev', 'min', 'max', 'moments']
+
 
 def initialise_top_parser():
     """
@@ -30,6 +35,8 @@ def initialise_top_parser():
     add_subset_parser_arguments(subset_parser)
     eval_parser = subparsers.add_parser("eval", help="Evaluate a numeric expression")
     add_eval_parser_arguments(eval_parser)
+    merge_aggregates_parser = subparsers.add_parser("merge-aggregates", help="Merge partial aggregates")
+    add_merge_aggregates_parser_arguments(merge_aggregates_parser)
     stats_parser = subparsers.add_parser("stats", help="Perform statistical comparison of two datasets")
     add_stats_parser_arguments(stats_parser)
     subparsers.add_parser("version", help="Display the CIS version number")
@@ -144,6 +151,19 @@ def add_col_parser_arguments(parser):
                         help="The filename of the output file containing the collocated data. The name specified will"
                              " be suffixed with \".nc\". For ungridded output, it will be prefixed with \"cis-\" and "
                              "so that cis can recognise it when using the file for further operations.")
+    parser.add_argument("--processes", metavar="Number of processes", type=int, default=1,
+                        help="The number of processes to share the sample points between when collocating onto "
+                             "ungridded sample points. The output is the same as when using a single process.")
+    parser.add_argument("--memory-limit", metavar="Memory limit", type=float, default=None,
+                        help="An approximate limit in MB on the memory used to interpolate gridded data onto a gridded "
+                             "sample. The data are interpolated in slabs along a dimension which is not in the sample "
+                             "grid, such as time, so that each slab fits within it. By default the data are "
+                             "interpolated all at once.")
+    parser.add_argument("--metrics", metavar="Metrics filename", default=None,
+                        help="A JSON file to write metrics of the collocation to, including the time spent in each "
+                             "phase, the number of candidate data points found for each sample point and the depth "
+                             "and leaf counts of any k-D trees built.")
+    add_index_cache_arguments(parser)
     return parser
 
 
@@ -158,6 +178,38 @@ def add_aggregate_parser_arguments(parser):
                              "degree increments up to 90")
     parser.add_argument("-o", "--output", metavar="Output filename", default="out", nargs="?",
                         help="The filename of the output file")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Read and aggregate ungridded data one file at a time, so that the memory needed is "
+                             "bounded by the size of the output grid rather than of all of the data. Only the mean, "
+                             "stddev, min, max and moments kernels can be used.")
+    parser.add_argument("--partial", action="store_true",
+                        help="Output the running totals for each cell of the grid rather than the final statistics, "
+                             "so that aggregations of different files onto the same grid can be combined using the "
+                             "merge-aggregates command. Only ungridded data can be partially aggregated.")
+    add_index_cache_arguments(parser)
+    return parser
+
+
+def add_merge_aggregates_parser_arguments(parser):
+    parser.add_argument("filenames", metavar="Filenames", nargs='+',
+                        help="The partial aggregate files, output by 'cis aggregate --partial', to merge")
+    parser.add_argument("-k", "--kernel", metavar="Kernel", default=None,
+                        help="The kernel to use to calculate the final statistics: mean, stddev, min, max or moments. "
+                             "The default is moments.")
+    parser.add_argument("-o", "--output", metavar="Output filename", default="out", nargs="?",
+                        help="The filename of the output file")
+    return parser
+
+
+def add_index_cache_arguments(parser):
+    parser.add_argument("--index-cache", metavar="Index cache directory", default=None,
+                        help="A directory in which to keep the indexes created of the data, so that they can be reused "
+                             "when the same data is collocated or aggregated again. By default indexes are not kept.")
+    parser.add_argument("--index-cache-size", metavar="Index cache size", type=float,
+                        default=DEFAULT_INDEX_CACHE_SIZE_MB,
+                        help="The maximum total size in MB of the indexes kept in the index cache directory. The least "
+                             "recently used indexes are removed when it is exceeded. The default is {} MB.".format(
+                            DEFAULT_INDEX_CACHE_SIZE_MB))
     return parser
 
 
@@ -902,7 +954,16 @@ def validate_col_args(arguments, parser):
                                                                         "variable"] is not "" else None
     arguments.sampleproduct = arguments.samplegroup["product"]
     arguments.datagroups = get_basic_datagroups(arguments.datagroups, parser)
+    if arguments.processes < 1:
+        parser.error("The number of processes must be at least 1")
+    if arguments.memory_limit is not None and arguments.memory_limit <= 0:
+        parser.error("The memory limit must be greater than zero")
+    if arguments.metrics is not None:
+        metrics_directory = os.path.dirname(os.path.abspath(arguments.metrics))
+        if not os.path.isdir(metrics_directory):
+            parser.error("The directory for the metrics file '{}' does not exist".format(arguments.metrics))
     _validate_output_file(arguments, parser)
+    _validate_index_cache_args(arguments, parser)
 
     return arguments
 
@@ -911,9 +972,30 @@ def validate_aggregate_args(arguments, parser):
     arguments.datagroups = get_aggregate_datagroups(arguments.datagroups, parser)
     arguments.grid = get_aggregate_grid(arguments.aggregategrid, parser)
     _validate_output_file(arguments, parser)
+    _validate_index_cache_args(arguments, parser)
+    return arguments
+
+
+def validate_merge_aggregates_args(arguments, parser):
+    arguments.filenames = expand_file_list(','.join(arguments.filenames), parser)
+    if arguments.kernel is not None and arguments.kernel not in MERGE_AGGREGATES_KERNELS:
+        parser.error(arguments.kernel + " is not a valid kernel for merging partial aggregates. Please use one of " +
+                     str(MERGE_AGGREGATES_KERNELS))
+    _append_file_extension_to_output_if_missing(arguments, parser, '.nc')
+    for filename in arguments.filenames:
+        if os.path.exists(arguments.output) and os.path.samefile(arguments.output, filename):
+            parser.error("The input file must not be the same as the output file")
     return arguments
 
 
+def _validate_index_cache_args(arguments, parser):
+    if arguments.index_cache_size <= 0:
+        parser.error("The index cache size must be greater than zero")
+    if arguments.index_cache is not None and os.path.exists(arguments.index_cache) and \
+            not os.path.isdir(arguments.index_cache):
+        parser.error("The index cache '{}' is not a directory".format(arguments.index_cache))
+
+
 def validate_subset_args(arguments, parser):
     arguments.datagroups = get_basic_datagroups(arguments.datagroups, parser)
     arguments.limits = get_subset_limits(arguments.subsetranges, parser)
@@ -949,6 +1031,7 @@ validators = {'plot': validate_plot_args,
               'info': validate_info_args,
               'col': validate_col_args,
               'aggregate': validate_aggregate_args,
+              'merge-aggregates': validate_merge_aggregates_args,
               'subset': validate_subset_args,
               'eval': validate_eval_args,
               'stats': validate_stats_args,
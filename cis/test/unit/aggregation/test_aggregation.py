@@ -557,3 +557,46 @@ class TestUngriddedListAggregation(TestCase):
         assert_arrays_almost_equal(mean_2.data, expect_mean + 10)
         assert_arrays_almost_equal(stddev_2.data, expect_stddev)
         assert_arrays_almost_equal(count_2.data, expect_count)
+
+
+class TestUngriddedAggregationInChunks(TestCase):
+
+    def setUp(self):
+        self.kernel = moments()
+
+    def test_GIVEN_single_chunk_WHEN_aggregate_in_chunks_THEN_same_as_aggregate_at_once(self):
+        data = make_regular_2d_ungridded_data_with_missing_values()
+
+        expected = Aggregator(data, {'y': AggregationGrid(-12.5, 12.5, 12.5, False)}).aggregate_ungridded(self.kernel)
+        output = Aggregator(data, {'y': AggregationGrid(-12.5, 12.5, 12.5, False)}).aggregate_ungridded_in_chunks(
+            self.kernel, [])
+
+        assert len(output) == len(expected)
+        for output_cube, expected_cube in zip(output, expected):
+            assert output_cube.var_name == expected_cube.var_name
+            assert numpy.array_equal(numpy.ma.getmaskarray(output_cube.data), numpy.ma.getmaskarray(expected_cube.data))
+            assert numpy.ma.allclose(output_cube.data, expected_cube.data)
+
+    def test_GIVEN_two_chunks_WHEN_aggregate_in_chunks_THEN_values_in_both_chunks_aggregated(self):
+        grid = {'x': AggregationGrid(-7.5, 7.5, 5, False), 'y': AggregationGrid(-12.5, 12.5, 5, False)}
+        data1 = make_regular_2d_ungridded_data()
+        data2 = make_regular_2d_ungridded_data(data_offset=10)
+
+        mean_out, stddev_out, count_out = Aggregator(data1, grid).aggregate_ungridded_in_chunks(self.kernel, [data2])
+
+        expect_mean = numpy.arange(15).reshape(5, 3) + 6.0
+        assert numpy.allclose(mean_out.data, expect_mean)
+        assert numpy.allclose(stddev_out.data, numpy.sqrt(50.0))
+        assert numpy.array_equal(count_out.data, numpy.full((5, 3), 2))
+
+    def test_GIVEN_chunks_with_different_ranges_WHEN_aggregate_in_chunks_THEN_collapsed_coord_covers_all_chunks(self):
+        grid = {'x': AggregationGrid(-7.5, 7.5, 5, False)}
+        data1 = make_regular_2d_ungridded_data()
+        data2 = make_regular_2d_ungridded_data(lat_min=-20, lat_max=0)
+
+        output = Aggregator(data1, grid).aggregate_ungridded_in_chunks(self.kernel, [data2])
+
+        latitude = output[0].coord('latitude')
+        assert numpy.array_equal(latitude.points, [-5.0])
+        assert numpy.array_equal(latitude.bounds, [[-20.0, 10.0]])
+        assert numpy.array_equal(output[2].data, [[10, 10, 10]])
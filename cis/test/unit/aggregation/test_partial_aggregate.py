@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from nose.tools import eq_, raises
+import numpy
+
+from cis.aggregation.aggregation_grid import AggregationGrid
+from cis.aggregation.aggregator import Aggregator
+from cis.aggregation.partial_aggregate import merge_partial_aggregates, PARTIAL_AGGREGATE_ATTRIBUTE
+from cis.collocation.col_implementations import moments, mean
+from cis.data_io.ungridded_data import UngriddedDataList
+from cis.exceptions import CISError
+from cis.test.util.mock import make_regular_2d_ungridded_data
+
+
+class TestPartialAggregate(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_partial(self, data, grid, name):
+        filename = os.path.join(self.directory, name + '.nc')
+        Aggregator(data, grid).aggregate_ungridded_to_partial([]).save_data(filename)
+        return filename
+
+    def test_GIVEN_ungridded_data_WHEN_aggregate_to_partial_THEN_running_totals_output(self):
+        grid = {'x': AggregationGrid(-7.5, 7.5, 5, False), 'y': AggregationGrid(-12.5, 12.5, 5, False)}
+        data = make_regular_2d_ungridded_data()
+
+        output = Aggregator(data, grid).aggregate_ungridded_to_partial([])
+
+        eq_([cube.attributes[PARTIAL_AGGREGATE_ATTRIBUTE] for cube in output],
+            ['count', 'sum', 'sum_of_squared_deviations', 'minimum', 'maximum'])
+        expect_values = numpy.arange(15).reshape(5, 3) + 1.0
+        assert numpy.array_equal(output[0].data, numpy.ones((5, 3)))
+        assert numpy.allclose(output[1].data, expect_values)
+        assert numpy.allclose(output[2].data, 0)
+        assert numpy.allclose(output[3].data, expect_values)
+        assert numpy.allclose(output[4].data, expect_values)
+
+    def test_GIVEN_partials_of_different_data_WHEN_merge_THEN_same_as_aggregating_in_chunks(self):
+        grid = {'x': AggregationGrid(-7.5, 7.5, 5, False), 'y': AggregationGrid(-12.5, 12.5, 5, False)}
+        data1 = make_regular_2d_ungridded_data()
+        data2 = make_regular_2d_ungridded_data(data_offset=10)
+        filenames = [self.write_partial(data1, dict(grid), 'partial1'),
+                     self.write_partial(data2, dict(grid), 'partial2')]
+
+        output = merge_partial_aggregates(filenames, moments())
+        expected = Aggregator(data1, dict(grid)).aggregate_ungridded_in_chunks(moments(), [data2])
+
+        eq_([cube.var_name for cube in output], [cube.var_name for cube in expected])
+        for output_cube, expected_cube in zip(output, expected):
+            assert numpy.allclose(output_cube.data, expected_cube.data)
+
+    def test_GIVEN_partials_of_several_variables_WHEN_merge_THEN_variables_in_input_order(self):
+        grid = {'x': AggregationGrid(-7.5, 7.5, 5, False), 'y': AggregationGrid(-12.5, 12.5, 5, False)}
+        rain = make_regular_2d_ungridded_data()
+        aerosol = make_regular_2d_ungridded_data(data_offset=3)
+        aerosol.metadata._name = 'aerosol'
+        filenames = [self.write_partial(UngriddedDataList([rain, aerosol]), dict(grid), 'partial1'),
+                     self.write_partial(UngriddedDataList([rain, aerosol]), dict(grid), 'partial2')]
+
+        output = merge_partial_aggregates(filenames, mean())
+        expected = Aggregator(UngriddedDataList([rain, aerosol]), dict(grid)).aggregate_ungridded(mean())
+
+        eq_([cube.var_name for cube in output], [cube.var_name for cube in expected])
+        eq_(output[0].var_name, rain.var_name)
+
+    def test_GIVEN_partials_with_different_ranges_WHEN_merge_THEN_collapsed_coord_covers_all_partials(self):
+        grid = {'x': AggregationGrid(-7.5, 7.5, 5, False)}
+        filenames = [self.write_partial(make_regular_2d_ungridded_data(), dict(grid), 'partial1'),
+                     self.write_partial(make_regular_2d_ungridded_data(lat_min=-20, lat_max=0), dict(grid),
+                                        'partial2')]
+
+        output = merge_partial_aggregates(filenames, mean())
+
+        latitude = output[0].coord('latitude')
+        assert numpy.array_equal(latitude.points, [-5.0])
+        assert numpy.array_equal(latitude.bounds, [[-20.0, 10.0]])
+
+    @raises(CISError)
+    def test_GIVEN_partials_on_different_grids_WHEN_merge_THEN_raises_CISError(self):
+        filenames = [self.write_partial(make_regular_2d_ungridded_data(),
+                                        {'x': AggregationGrid(-7.5, 7.5, 5, False)}, 'partial1'),
+                     self.write_partial(make_regular_2d_ungridded_data(),
+                                        {'x': AggregationGrid(-7.5, 7.5, 2.5, False)}, 'partial2')]
+
+        merge_partial_aggregates(filenames, mean())
@@ -1,6 +1,8 @@
 import unittest
 
 from hamcrest import *
+from mock import patch
+import numpy as np
 
 from cis.collocation import data_index
 from cis.data_io.hyperpoint import HyperPoint
@@ -66,3 +68,109 @@ class TestGridCellBinIndex(unittest.TestCase):
 
         final_points_index = [(out_index, hp, points) for out_index, hp, points in iterator]
         assert_that(len(final_points_index), is_(0), "Masked points should not be iterated over")
+
+
+class TestGridCellBinIndexInSlices(unittest.TestCase):
+
+    def make_index(self):
+        sample_cube = make_square_5x3_2d_cube()
+        data = make_regular_2d_ungridded_data(lat_dim_length=9, lat_min=-12, lat_max=12, lon_dim_length=7, lon_min=-7,
+                                              lon_max=7)
+        coord_map = make_coord_map(sample_cube, data)
+        coords = sample_cube.coords()
+        for coord in coords:
+            if not coord.has_bounds():
+                coord.guess_bounds()
+        index = data_index.GridCellBinIndexInSlices()
+        index.index_data(coords, data.get_non_masked_points(), coord_map)
+        return index
+
+    def test_GIVEN_points_in_and_outside_grid_WHEN_index_THEN_counting_sort_gives_same_cells_as_comparison_sort(self):
+        counting_sorted = self.make_index()
+        with patch.object(data_index, 'MAX_CELLS_PER_POINT_FOR_COUNTING_SORT', 0):
+            comparison_sorted = self.make_index()
+
+        assert_that(counting_sorted.cell_numbers.tolist(), is_(comparison_sorted.cell_numbers.tolist()))
+        counting_slices = list(counting_sorted.get_iterator())
+        comparison_slices = list(comparison_sorted.get_iterator())
+        assert_that(len(counting_slices), is_(len(comparison_slices)))
+        for (out_index, (start, end)), (expected_out_index, expected_start_end) in zip(counting_slices,
+                                                                                         comparison_slices):
+            assert_that(out_index, is_(expected_out_index))
+            assert_that([start, end], is_(list(expected_start_end)))
+            # The counting sort is stable, so the points in each cell stay in their original order
+            points = counting_sorted.sort_order[start:end]
+            assert_that(points.tolist(), is_(sorted(comparison_sorted.sort_order[start:end].tolist())))
+
+    def test_GIVEN_points_excluded_WHEN_get_cell_slices_THEN_slices_only_contain_remaining_points(self):
+        index = self.make_index()
+        exclude = np.zeros(len(index.sort_order), dtype=bool)
+        exclude[::2] = True
+
+        excluded = index.excluding_points(exclude)
+        out_indices, slice_starts = excluded.get_cell_slices()
+
+        slice_ends = np.append(slice_starts[1:], len(excluded.sort_order))
+        for cell_index, start, end in zip(zip(*out_indices), slice_starts, slice_ends):
+            expected = [point for point, cell, cell_number in zip(index.sort_order, zip(*index._indices),
+                                                                  index.cell_numbers)
+                        if cell == cell_index and cell_number >= 0 and not exclude[point]]
+            assert_that(sorted(excluded.sort_order[start:end].tolist()), is_(sorted(expected)))
+
+    def test_GIVEN_cells_with_gaps_between_bounds_WHEN_index_THEN_points_in_gaps_outside_grid(self):
+        sample_cube = make_square_5x3_2d_cube()
+        data = make_regular_2d_ungridded_data(lat_dim_length=9, lat_min=-12, lat_max=12, lon_dim_length=7, lon_min=-7,
+                                              lon_max=7)
+        coord_map = make_coord_map(sample_cube, data)
+        coords = sample_cube.coords()
+        for coord in coords:
+            if not coord.has_bounds():
+                coord.guess_bounds()
+        latitude = sample_cube.coord('latitude')
+        latitude.bounds = np.column_stack((latitude.points - 1.5, latitude.points + 1.5))
+        index = data_index.GridCellBinIndexInSlices()
+        index.index_data(coords, data.get_non_masked_points(), coord_map)
+
+        in_grid = index.sort_order[index.cell_numbers >= 0]
+        latitudes = data.coord('latitude').points.ravel()[in_grid]
+        assert_that(len(in_grid), is_(5 * 7))
+        assert_that(sorted(set(latitudes.tolist())), is_([-9, -6, 0, 6, 9]))
+
+
+class TestArrayBackedGridCellBinIndex(unittest.TestCase):
+
+    def setUp(self):
+        sample_cube = make_square_5x3_2d_cube()
+        data = make_regular_2d_ungridded_data(lat_dim_length=9, lat_min=-12, lat_max=12, lon_dim_length=7, lon_min=-7,
+                                              lon_max=7)
+        self.data_points = data.get_non_masked_points()
+        coord_map = make_coord_map(sample_cube, data)
+        self.sample_cube = sample_cube
+        self.coords = sample_cube.coords()
+        for coord in self.coords:
+            if not coord.has_bounds():
+                coord.guess_bounds()
+        self.index = data_index.GridCellBinIndex()
+        self.index.index_data(self.coords, self.data_points, coord_map)
+
+    def points_in_cell(self, cell):
+        lat_bounds = self.sample_cube.coord('latitude').bounds[cell[0]]
+        lon_bounds = self.sample_cube.coord('longitude').bounds[cell[1]]
+        return [idx for idx, point in enumerate(self.data_points)
+                if lat_bounds[0] <= point.latitude < lat_bounds[1] and lon_bounds[0] <= point.longitude < lon_bounds[1]]
+
+    def test_GIVEN_indexed_points_WHEN_get_points_by_indices_THEN_points_in_each_cell_returned(self):
+        for cell in np.ndindex(5, 3):
+            expected = self.points_in_cell(cell)
+            points = self.index.get_points_by_indices(cell)
+            if expected:
+                assert_that(points.tolist(), is_(expected))
+            else:
+                assert_that(points, is_(None))
+
+    def test_GIVEN_indexed_points_WHEN_get_index_THEN_array_of_point_lists_for_each_cell(self):
+        index = self.index.index
+        assert_that(index.shape, is_((5, 3)))
+        for cell in np.ndindex(5, 3):
+            expected = self.points_in_cell(cell)
+            assert_that(index[cell], is_(expected if expected else None))
@@ -0,0 +1,60 @@
+import unittest
+
+from nose.tools import eq_, raises
+import numpy as np
+
+from cis.collocation.cell_accumulators import CellAccumulators
+
+
+class TestCellAccumulators(unittest.TestCase):
+
+    def setUp(self):
+        self.values = np.array([3.0, 1.0, 4.0, 1.0, 5.0, 9.0, 2.0, 6.0, 5.0, 3.0])
+        # Cell of each value in a grid of shape (2, 2)
+        self.cells = (np.array([0, 0, 1, 1, 0, 1, 1, 0, 0, 1]), np.array([0, 0, 1, 1, 0, 1, 1, 1, 1, 1]))
+
+    def add_in_slices(self, accumulators, values, cells):
+        cell_numbers = np.ravel_multi_index(cells, accumulators.shape)
+        order = np.argsort(cell_numbers, kind='mergesort')
+        slice_starts = np.flatnonzero(np.diff(np.append(-1, cell_numbers[order])))
+        out_indices = tuple(indices[order][slice_starts] for indices in cells)
+        accumulators.add_slices(out_indices, values[order], slice_starts)
+
+    def check_totals(self, accumulators):
+        for cell in [(0, 0), (0, 1), (1, 1)]:
+            in_cell = self.values[(self.cells[0] == cell[0]) & (self.cells[1] == cell[1])]
+            eq_(accumulators.count[cell], len(in_cell))
+            self.assertAlmostEqual(accumulators.sum[cell], in_cell.sum())
+            self.assertAlmostEqual(accumulators.sum_of_squared_deviations[cell],
+                                   np.sum((in_cell - in_cell.mean()) ** 2))
+            eq_(accumulators.minimum[cell], in_cell.min())
+            eq_(accumulators.maximum[cell], in_cell.max())
+        eq_(accumulators.count[1, 0], 0)
+
+    def test_GIVEN_values_added_at_once_WHEN_add_slices_THEN_totals_correct(self):
+        accumulators = CellAccumulators((2, 2))
+        self.add_in_slices(accumulators, self.values, self.cells)
+        self.check_totals(accumulators)
+
+    def test_GIVEN_values_added_in_chunks_WHEN_add_slices_THEN_totals_same_as_at_once(self):
+        accumulators = CellAccumulators((2, 2))
+        for chunk in [slice(0, 3), slice(3, 4), slice(4, 10)]:
+            self.add_in_slices(accumulators, self.values[chunk], tuple(indices[chunk] for indices in self.cells))
+        self.check_totals(accumulators)
+
+    def test_GIVEN_accumulators_for_parts_of_values_WHEN_add_THEN_totals_same_as_at_once(self):
+        accumulators = CellAccumulators((2, 2))
+        self.add_in_slices(accumulators, self.values[:5], tuple(indices[:5] for indices in self.cells))
+        other = CellAccumulators((2, 2))
+        self.add_in_slices(other, self.values[5:], tuple(indices[5:] for indices in self.cells))
+        accumulators.add(other)
+        self.check_totals(accumulators)
+
+    def test_GIVEN_no_values_WHEN_add_slices_THEN_totals_unchanged(self):
+        accumulators = CellAccumulators((2, 2))
+        accumulators.add_slices((np.zeros(0, dtype=int), np.zeros(0, dtype=int)), np.zeros(0), np.zeros(0, dtype=int))
+        eq_(accumulators.count.sum(), 0)
+
+    @raises(ValueError)
+    def test_GIVEN_accumulators_of_different_shape_WHEN_add_THEN_raises_ValueError(self):
+        CellAccumulators((2, 2)).add(CellAccumulators((2, 3)))
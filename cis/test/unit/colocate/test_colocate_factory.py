@@ -22,6 +22,13 @@ class TestCollocateFactory(unittest.TestCase):
         assert_that(kernel, instance_of(mean), "Kernel")
         assert_that(constraint.h_sep, is_(10), "h_sep")
 
+    def test_GIVEN_grid_index_type_WHEN_request_box_THEN_grid_constraint_returned(self):
+        collocator, constraint, kernel = self.factory.get_collocator_instances_for_method(
+            "box", "mean", {'missing_data_for_missing_sample': "false", "h_sep": "10", "index_type": "grid"}, {},
+            False, False)
+        assert_that(constraint, instance_of(SepConstraintGrid), "Constraint")
+        assert_that(constraint.h_sep, is_(10), "h_sep")
+
     def test_GIVEN_no_collocator_WHEN_get_col_instances_for_gridded_to_gridded_THEN_defaults_to_lin(self):
         collocator, constraint, kernel = self.factory.get_collocator_instances_for_method(
             None, None, {'missing_data_for_missing_sample': "false"}, {}, True, True)
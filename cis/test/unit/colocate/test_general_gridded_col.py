@@ -493,6 +493,42 @@ def list_moments(constraint, kernel):
     assert numpy.array_equal(output[5].data, expected_num)
 
 
+def list_with_different_masks_gives_same_result_as_separate_collocation(constraint, kernel):
+    col = GeneralGriddedCollocator()
+    sample = make_square_5x3_2d_cube()
+    data1 = make_regular_2d_ungridded_data(10, -10, 10, 6, -5, 5)
+    mask = numpy.zeros((10, 6), dtype=bool)
+    mask[::3, 1::2] = True
+    mask[4:6, :] = True
+    data2 = make_regular_2d_ungridded_data(10, -10, 10, 6, -5, 5, mask=mask)
+    data2.metadata._name = 'snow'
+    separate = col.collocate(sample, data1, BinnedCubeCellOnlyConstraint(), kernel) + \
+        col.collocate(sample, data2, BinnedCubeCellOnlyConstraint(), kernel)
+    output = col.collocate(sample, UngriddedDataList([data1, data2]), constraint, kernel)
+    assert len(output) == len(separate) == 6
+    for output_var, separate_var in zip(output, separate):
+        assert output_var.var_name == separate_var.var_name
+        assert numpy.array_equal(output_var.data.mask, separate_var.data.mask)
+        assert numpy.allclose(output_var.data, separate_var.data)
+
+
+def vectorised_kernel_gives_same_result_as_cell_by_cell_kernel(kernel, cell_by_cell_kernel,
+                                                               missing_data_for_missing_sample):
+    sample = make_square_5x3_2d_cube()
+    sample.data = numpy.ma.array(sample.data, mask=False)
+    sample.data[1, 2] = numpy.ma.masked
+    mask = numpy.zeros((10, 6), dtype=bool)
+    mask[::3, 1::2] = True
+    data = make_regular_2d_ungridded_data(10, -10, 10, 6, -5, 5, mask=mask)
+    col = GeneralGriddedCollocator(missing_data_for_missing_sample=missing_data_for_missing_sample)
+    output = col.collocate(sample, data, BinnedCubeCellOnlyConstraint(), kernel)
+    expected = col.collocate(sample, data, BinnedCubeCellOnlyConstraint(), cell_by_cell_kernel)
+    assert len(output) == len(expected)
+    for output_var, expected_var in zip(output, expected):
+        assert numpy.array_equal(output_var.data.mask, expected_var.data.mask)
+        assert numpy.allclose(output_var.data, expected_var.data)
+
+
 class TestGeneralGriddedCollocator(unittest.TestCase):
     def test_fill_value_for_cube_cell_constraint(self):
         sample_cube = make_mock_cube()
@@ -1032,6 +1068,28 @@ class TestGeneralGriddedCollocator(unittest.TestCase):
 
         list_moments(constraint, kernel)
 
+    def test_list_with_different_masks_binned_only_con(self):
+        constraint = BinnedCubeCellOnlyConstraint()
+        kernel = SlowMoments()
+
+        list_with_different_masks_gives_same_result_as_separate_collocation(constraint, kernel)
+
+    def test_list_with_different_masks_binned_only_con_fast_moment(self):
+        constraint = BinnedCubeCellOnlyConstraint()
+        kernel = FastMoments()
+
+        list_with_different_masks_gives_same_result_as_separate_collocation(constraint, kernel)
+
+    def test_vectorised_moments_gives_same_result_as_cell_by_cell_moments(self):
+        for missing_data_for_missing_sample in [False, True]:
+            vectorised_kernel_gives_same_result_as_cell_by_cell_kernel(moments(), FastMoments(),
+                                                                       missing_data_for_missing_sample)
+
+    def test_vectorised_mean_gives_same_result_as_cell_by_cell_mean(self):
+        for missing_data_for_missing_sample in [False, True]:
+            vectorised_kernel_gives_same_result_as_cell_by_cell_kernel(mean(), FastMean(),
+                                                                       missing_data_for_missing_sample)
+
     def test_gridded_gridded_bin_when_grids_have_different_dims_order(self):
         # JASCIS-204
         from cis.data_io.gridded_data import make_from_cube
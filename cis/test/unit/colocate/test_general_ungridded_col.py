@@ -4,17 +4,36 @@
 import unittest
 import datetime as dt
 
+from mock import patch
 from nose.tools import eq_
 import numpy as np
 
 from cis.data_io.gridded_data import make_from_cube, GriddedDataList
+from cis.collocation.col_framework import Kernel
 from cis.collocation.col_implementations import GeneralUngriddedCollocator, DummyConstraint, moments, li, \
-    SepConstraintKdtree, mean, nn_gridded
+    SepConstraintKdtree, mean, nn_gridded, nn_horizontal_kdtree, _crop_to_sample_envelope
 from cis.data_io.hyperpoint import HyperPoint
 from cis.data_io.ungridded_data import UngriddedData, UngriddedDataList
 from cis.test.util import mock
 
 
+class PointByPointMoments(Kernel):
+    """
+    Kernel which only provides get_value, as a plugin kernel might, so that collocation falls back to iterating over
+    the sample points.
+    """
+    return_size = 3
+
+    def __init__(self):
+        self.moments = moments()
+
+    def get_value(self, point, data):
+        return self.moments.get_value(point, data)
+
+    def get_variable_details(self, var_name, var_long_name, var_standard_name, var_units):
+        return self.moments.get_variable_details(var_name, var_long_name, var_standard_name, var_units)
+
+
 class TestGeneralUngriddedCollocator(unittest.TestCase):
 
     def test_averaging_basic_col_in_4d(self):
@@ -202,6 +221,140 @@ class TestGeneralUngriddedCollocator(unittest.TestCase):
         assert np.allclose(output[4].data, expected_stddev)
         assert np.allclose(output[5].data, expected_n)
 
+    def test_vectorised_collocation_gives_same_result_as_point_by_point_collocation(self):
+        data = mock.make_regular_4d_ungridded_data()
+        sample = UngriddedData.from_points_array(
+            [HyperPoint(lat=1.0, lon=1.0, alt=12.0, t=dt.datetime(1984, 8, 29, 8, 34)),
+             HyperPoint(lat=3.0, lon=3.0, alt=7.0, t=dt.datetime(1984, 8, 29, 8, 34)),
+             HyperPoint(lat=-1.0, lon=-1.0, alt=5.0, t=dt.datetime(1984, 8, 29, 8, 34)),
+             HyperPoint(lat=50.0, lon=50.0, alt=5.0, t=dt.datetime(1984, 8, 29, 8, 34))])
+
+        col = GeneralUngriddedCollocator(fill_value=-999)
+        vectorised = col.collocate(sample, data, SepConstraintKdtree('500km', a_sep='30m'), moments())
+        point_by_point = col.collocate(sample, data, SepConstraintKdtree('500km', a_sep='30m'), PointByPointMoments())
+
+        assert len(vectorised) == len(point_by_point) == 3
+        for vectorised_var, point_by_point_var in zip(vectorised, point_by_point):
+            assert np.allclose(vectorised_var.data, point_by_point_var.data)
+        # The last sample point has no data near it
+        assert np.all([var.data[3] == -999 for var in vectorised])
+
+    def test_collocation_in_multiple_processes_gives_same_result_as_single_process(self):
+        data = mock.make_regular_4d_ungridded_data()
+        rng = np.random.RandomState(3)
+        sample = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, alt=alt, t=dt.datetime(1984, 8, 29, 8, 34)) for lat, lon, alt in
+             zip(rng.uniform(-10, 10, 37), rng.uniform(-5, 5, 37), rng.uniform(0, 100, 37))])
+
+        for kernel in [moments(), PointByPointMoments()]:
+            col = GeneralUngriddedCollocator(fill_value=-999)
+            serial = col.collocate(sample, data, SepConstraintKdtree('500km', a_sep='30m'), kernel)
+            col.processes = 3
+            parallel = col.collocate(sample, data, SepConstraintKdtree('500km', a_sep='30m'), kernel)
+
+            for serial_var, parallel_var in zip(serial, parallel):
+                assert np.array_equal(serial_var.data, parallel_var.data)
+
+    def test_list_collocation_with_shared_coordinates_gives_same_result_as_separate_collocation(self):
+        data_1 = mock.make_regular_2d_ungridded_data()
+        data_2 = mock.make_regular_2d_ungridded_data_with_missing_values()
+        data_2.metadata._name = 'snow'
+        sample = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon) for lat, lon in [(-5.0, 0.0), (0.0, 5.0), (9.0, -4.0), (50.0, 50.0)]])
+
+        for kernel in [moments(), PointByPointMoments()]:
+            col = GeneralUngriddedCollocator(fill_value=-999)
+            separate = col.collocate(sample, data_1, SepConstraintKdtree('600km'), kernel) + \
+                col.collocate(sample, data_2, SepConstraintKdtree('600km'), kernel)
+            constraint = SepConstraintKdtree('600km')
+            with patch.object(constraint, 'get_neighbours', wraps=constraint.get_neighbours) as get_neighbours:
+                shared = col.collocate(sample, UngriddedDataList([data_1, data_2]), constraint, kernel)
+
+            eq_(get_neighbours.call_count, 1)
+            assert len(shared) == len(separate) == 6
+            for shared_var, separate_var in zip(shared, separate):
+                assert np.allclose(shared_var.data, separate_var.data)
+
+
+    def test_list_collocation_with_different_masks_gives_same_result_as_separate_collocation(self):
+        data_1 = mock.make_regular_2d_ungridded_data()
+        data_2 = mock.make_regular_2d_ungridded_data_with_missing_values()
+        data_2.metadata._name = 'snow'
+        sample = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon) for lat, lon in [(-5.0, 0.0), (0.0, 5.0), (9.0, -4.0), (4.0, 4.0)]])
+
+        # The nearest points and the collocation in processes use indexes of the non-masked points of each variable
+        for kernel, processes in [(nn_horizontal_kdtree(), 1), (moments(), 2), (PointByPointMoments(), 2)]:
+            col = GeneralUngriddedCollocator(fill_value=-999)
+            col.processes = processes
+            separate = col.collocate(sample, data_1, SepConstraintKdtree('600km'), kernel) + \
+                col.collocate(sample, data_2, SepConstraintKdtree('600km'), kernel)
+            listed = col.collocate(sample, UngriddedDataList([data_1, data_2]), SepConstraintKdtree('600km'), kernel)
+
+            assert len(listed) == len(separate)
+            for listed_var, separate_var in zip(listed, separate):
+                assert np.allclose(listed_var.data, separate_var.data)
+
+    def test_list_collocation_with_cropped_data_gives_same_result_as_separate_collocation(self):
+        grid = dict(lat_dim_length=9, lat_min=-40, lat_max=40, lon_dim_length=9, lon_min=-40, lon_max=40)
+        mask = np.zeros((9, 9), dtype=bool)
+        mask[::2, ::3] = True
+        mask[5, 5] = True
+        data_1 = mock.make_regular_2d_ungridded_data(**grid)
+        data_2 = mock.make_regular_2d_ungridded_data(data_offset=100, mask=mask, **grid)
+        data_2.metadata._name = 'snow'
+        sample = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon) for lat, lon in [(0.5, 0.5), (9.0, 1.0), (2.0, 9.5), (10.0, 10.0)]])
+        constraint = SepConstraintKdtree('300km')
+
+        # Only the data points near the sample points are kept, and which of them are masked differs by variable
+        cropped = _crop_to_sample_envelope(sample.get_all_points(), data_1.get_non_masked_points(), constraint)
+        assert 0 < len(cropped) < len(data_1.get_non_masked_points())
+
+        for kernel, processes in [(nn_horizontal_kdtree(), 1), (moments(), 1), (moments(), 2),
+                                  (PointByPointMoments(), 1)]:
+            col = GeneralUngriddedCollocator(fill_value=-999)
+            col.processes = processes
+            separate = col.collocate(sample, data_1, SepConstraintKdtree('300km'), kernel) + \
+                col.collocate(sample, data_2, SepConstraintKdtree('300km'), kernel)
+            listed = col.collocate(sample, UngriddedDataList([data_1, data_2]), SepConstraintKdtree('300km'), kernel)
+
+            assert len(listed) == len(separate)
+            for listed_var, separate_var in zip(listed, separate):
+                assert np.array_equal(np.ma.getmaskarray(listed_var.data), np.ma.getmaskarray(separate_var.data))
+                assert np.allclose(listed_var.data, separate_var.data)
+
+
+class TestCropToSampleEnvelope(unittest.TestCase):
+
+    def test_data_points_further_than_separations_from_all_sample_points_are_removed(self):
+        data_points = mock.make_regular_2d_ungridded_data().get_non_masked_points()
+        sample_points = UngriddedData.from_points_array([HyperPoint(lat=0.5, lon=0.5)]).get_all_points()
+
+        cropped = _crop_to_sample_envelope(sample_points, data_points, SepConstraintKdtree('500km'))
+
+        eq_(len(cropped), 1)
+        eq_(cropped.coords_flattened[HyperPoint.LATITUDE][0], 0)
+        eq_(cropped.coords_flattened[HyperPoint.LONGITUDE][0], 0)
+        eq_(cropped.data_flattened[0], 8)
+
+    def test_data_points_across_dateline_are_kept(self):
+        data_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=0.0, lon=lon, val=1.0) for lon in [-179.5, 0.0, 179.0]]).get_non_masked_points()
+        sample_points = UngriddedData.from_points_array([HyperPoint(lat=0.0, lon=179.5)]).get_all_points()
+
+        cropped = _crop_to_sample_envelope(sample_points, data_points, SepConstraintKdtree('200km'))
+
+        eq_(list(cropped.coords_flattened[HyperPoint.LONGITUDE]), [-179.5, 179.0])
+
+    def test_data_points_not_removed_without_separations(self):
+        data_points = mock.make_regular_2d_ungridded_data().get_non_masked_points()
+        sample_points = UngriddedData.from_points_array([HyperPoint(lat=0.5, lon=0.5)]).get_all_points()
+
+        assert _crop_to_sample_envelope(sample_points, data_points, DummyConstraint()) is data_points
+        assert _crop_to_sample_envelope(sample_points, data_points, SepConstraintKdtree('5000km')) is data_points
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
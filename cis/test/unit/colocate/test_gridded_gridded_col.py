@@ -1381,3 +1381,24 @@ class TestGriddedGriddedCollocator(GriddedGriddedCollocatorTests, TestCase):
         col = self.collocator
         out_cube = col.collocate(points=sample, data=data, constraint=None, kernel=gridded_gridded_nn())
         assert out_cube[0].shape == sample.shape
+
+
+class TestGriddedGriddedCollocatorWithMemoryLimit(TestGriddedGriddedCollocator):
+    """
+    Runs the same tests with a memory limit small enough for the data to be interpolated one slab at a time
+    """
+
+    def setUp(self):
+        self.collocator = GriddedCollocator(memory_limit=1)
+
+    def test_interpolating_in_slabs_gives_same_result_as_interpolating_at_once(self):
+        sample = gridded_data.make_from_cube(make_mock_cube(horizontal_offset=1.2))
+        for data in [make_mock_cube(time_dim_length=7, alt_dim_length=4, dim_order=['time', 'lat', 'alt', 'lon']),
+                     make_mock_cube(time_dim_length=5, hybrid_ht_len=6)]:
+            data = gridded_data.make_from_cube(data)
+            for kernel in [gridded_gridded_nn(), gridded_gridded_li()]:
+                at_once = GriddedCollocator().collocate(points=sample, data=data, constraint=None, kernel=kernel)[0]
+                in_slabs = self.collocator.collocate(points=sample, data=data, constraint=None, kernel=kernel)[0]
+
+                assert numpy.array_equal(at_once.data, in_slabs.data)
+                assert at_once.coords() == in_slabs.coords()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+from nose.tools import eq_
+import numpy as np
+
+from cis.collocation import data_index
+from cis.collocation.col_implementations import GeneralUngriddedCollocator, SepConstraintKdtree, mean
+from cis.collocation.haversinedistancekdtreeindex import HaversineDistanceKDTreeIndex
+from cis.collocation.index_cache import IndexCache
+from cis.data_io.hyperpoint import HyperPoint
+from cis.data_io.ungridded_data import UngriddedData
+from cis.test.util import mock
+
+
+class IndexedConstraint(object):
+    def __init__(self):
+        self.haversine_distance_kd_tree_index = None
+
+
+class TestIndexCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = IndexCache(self.directory, 10 * 1024 * 1024)
+        self.data = mock.make_regular_2d_ungridded_data()
+        self.data.filenames = []
+
+    def tearDown(self):
+        data_index.set_index_cache(None)
+        shutil.rmtree(self.directory)
+
+    def get_key(self, data):
+        return self.cache.get_key(HaversineDistanceKDTreeIndex, None, data.get_non_masked_points(), None, data)
+
+    def test_GIVEN_index_stored_WHEN_load_THEN_index_gives_same_results(self):
+        index = HaversineDistanceKDTreeIndex()
+        index.index_data(None, self.data.get_non_masked_points(), None)
+        key = self.get_key(self.data)
+        self.cache.store(key, index)
+
+        loaded = self.cache.load(key)
+        lats, lons = np.array([0.0, 4.0, -8.0]), np.array([0.0, 4.0, 1.0])
+        for expected, actual in zip(index.find_pairs_within_distance(lats, lons, 800),
+                                    loaded.find_pairs_within_distance(lats, lons, 800)):
+            assert np.array_equal(expected, actual)
+
+    def test_GIVEN_nothing_stored_WHEN_load_THEN_returns_none(self):
+        assert self.cache.load(self.get_key(self.data)) is None
+
+    def test_GIVEN_same_data_WHEN_get_key_THEN_keys_equal(self):
+        eq_(self.get_key(self.data), self.get_key(mock.make_regular_2d_ungridded_data()))
+
+    def test_GIVEN_different_mask_WHEN_get_key_THEN_keys_differ(self):
+        masked_data = mock.make_regular_2d_ungridded_data_with_missing_values()
+        assert self.get_key(self.data) != self.get_key(masked_data)
+
+    def test_GIVEN_different_coordinates_WHEN_get_key_THEN_keys_differ(self):
+        shifted_data = mock.make_regular_2d_ungridded_data(lon_min=0, lon_max=10)
+        assert self.get_key(self.data) != self.get_key(shifted_data)
+
+    def test_GIVEN_data_file_modified_WHEN_get_key_THEN_keys_differ(self):
+        filename = os.path.join(self.directory, 'data.nc')
+        with open(filename, 'w') as data_file:
+            data_file.write('data')
+        self.data.filenames = [filename]
+        key = self.get_key(self.data)
+        with open(filename, 'a') as data_file:
+            data_file.write('more data')
+        assert self.get_key(self.data) != key
+
+    def test_GIVEN_cache_over_size_limit_WHEN_store_THEN_least_recently_used_removed(self):
+        for key in ['first', 'second', 'third']:
+            self.cache.store(key, np.zeros(1000))
+        size = os.path.getsize(os.path.join(self.directory, 'first.index'))
+        # Make the first index the most recently used
+        os.utime(os.path.join(self.directory, 'second.index'), (1, 1))
+        os.utime(os.path.join(self.directory, 'third.index'), (2, 2))
+        self.cache.load('first')
+
+        self.cache.size_limit = int(2.5 * size)
+        self.cache.store('fourth', np.zeros(1000))
+
+        eq_(sorted(os.listdir(self.directory)), ['first.index', 'fourth.index'])
+
+    def test_GIVEN_cache_directory_not_writable_WHEN_load_THEN_index_returned(self):
+        self.cache.store('first', np.arange(10))
+
+        with patch('os.utime', side_effect=OSError('Read-only file system')):
+            loaded = self.cache.load('first')
+
+        assert np.array_equal(loaded, np.arange(10))
+
+    def test_GIVEN_index_cache_set_WHEN_collocate_with_different_sample_THEN_cached_index_used(self):
+        data_index.set_index_cache(self.cache)
+        col = GeneralUngriddedCollocator()
+        first_sample = UngriddedData.from_points_array([HyperPoint(lat=-10.0, lon=-5.0)])
+        second_sample = UngriddedData.from_points_array([HyperPoint(lat=10.0, lon=5.0)])
+        col.collocate(first_sample, self.data, SepConstraintKdtree('100km'), mean())
+
+        with patch.object(HaversineDistanceKDTreeIndex, 'index_data') as index_data:
+            output = col.collocate(second_sample, self.data, SepConstraintKdtree('100km'), mean())
+
+        assert not index_data.called
+        eq_(output[0].data[0], 15)
+
+    def test_GIVEN_index_cache_set_WHEN_create_indexes_again_THEN_cached_index_used(self):
+        data_index.set_index_cache(self.cache)
+        constraint = IndexedConstraint()
+        data_index.create_indexes(constraint, None, self.data.get_non_masked_points(), None, self.data)
+
+        constraint.haversine_distance_kd_tree_index = None
+        with patch.object(HaversineDistanceKDTreeIndex, 'index_data') as index_data:
+            data_index.create_indexes(constraint, None, self.data.get_non_masked_points(), None, self.data)
+
+        assert not index_data.called
+        assert isinstance(constraint.haversine_distance_kd_tree_index, HaversineDistanceKDTreeIndex)
+        assert constraint.haversine_distance_kd_tree_index.index is not None
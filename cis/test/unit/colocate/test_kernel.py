@@ -104,6 +104,49 @@ class TestNNGridded(unittest.TestCase):
         eq_(new_data.data[2], 324.0)  # float(cube[8,35].data))
         eq_(new_data.data[3], 321.0)  # float(cube[8,32].data))
 
+    def test_vectorised_lookup_gives_same_result_as_point_by_point(self):
+        from cis.collocation.col_implementations import nn_gridded, _get_values_point_by_point
+        import datetime as dt
+
+        mask = np.zeros((5, 4, 3), dtype=bool)
+        mask[2, 1, 1] = True
+        cube = gridded_data.make_from_cube(mock.make_mock_cube(time_dim_length=4, dim_order=['lat', 'time', 'lon'],
+                                                               mask=mask))
+        rng = np.random.RandomState(5)
+        # Include points exactly half way between grid points
+        lats = np.append(rng.uniform(-12, 12, 40), [-7.5, 2.5])
+        lons = np.append(rng.uniform(-8, 8, 40), [-2.5, 2.5])
+        hours = np.append(rng.uniform(-30, 110, 40), [12, 36])
+        sample_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, t=dt.datetime(1984, 8, 27) + dt.timedelta(hours=hour))
+             for lat, lon, hour in zip(lats, lons, hours)])
+        sample_view = sample_points.get_all_points()
+
+        vectorised = nn_gridded().get_values(sample_view, cube, None)
+        point_by_point = _get_values_point_by_point(nn_gridded(), sample_view, cube)
+        assert_equal(vectorised.mask, point_by_point.mask)
+        assert_equal(vectorised.compressed(), point_by_point.compressed())
+        assert vectorised.mask.any()
+
+    def test_vectorised_lookup_on_hybrid_coordinates_gives_same_result_as_point_by_point(self):
+        from cis.collocation.col_implementations import nn_gridded, _get_values_point_by_point
+        import datetime as dt
+
+        for cube in [mock.make_mock_cube(time_dim_length=3, hybrid_ht_len=10),
+                     mock.make_mock_cube(time_dim_length=3, hybrid_pr_len=10)]:
+            cube = gridded_data.make_from_cube(cube)
+            rng = np.random.RandomState(7)
+            sample_points = UngriddedData.from_points_array(
+                [HyperPoint(lat=lat, lon=lon, alt=alt, t=dt.datetime(1984, 8, 27) + dt.timedelta(hours=hour))
+                 for lat, lon, alt, hour in zip(rng.uniform(-12, 12, 40), rng.uniform(-8, 8, 40),
+                                                rng.uniform(0, 7000, 40), rng.uniform(-30, 80, 40))])
+            sample_view = sample_points.get_all_points()
+
+            vectorised = nn_gridded().get_values(sample_view, cube, None)
+            point_by_point = _get_values_point_by_point(nn_gridded(), sample_view, cube)
+            assert_equal(vectorised.mask, point_by_point.mask)
+            assert_equal(vectorised.compressed(), point_by_point.compressed())
+
     def test_lon_points_over_360_dont_matter_with_0_360_grid_in_2d(self):
         from cis.collocation.col_implementations import GeneralUngriddedCollocator, nn_gridded
         # This cube is defined over a 0-360 longitude grid
@@ -657,6 +700,32 @@ class TestNNPressure(unittest.TestCase):
         eq_(new_data.data[2], 46.0)
 
 
+class TestNearestNeighbourGetValues(unittest.TestCase):
+    def test_get_values_matches_get_value_for_constrained_points(self):
+        from cis.collocation.col_implementations import SepConstraintKdtree, nn_time, nn_altitude, nn_pressure
+        import datetime as dt
+
+        data_points = mock.make_regular_4d_ungridded_data().get_non_masked_points()
+        sample_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=1.0, lon=1.0, alt=12.0, pres=10.0, t=dt.datetime(1984, 8, 29, 8, 34)),
+             HyperPoint(lat=4.0, lon=4.0, alt=34.0, pres=25.0, t=dt.datetime(1984, 9, 2, 1, 23)),
+             HyperPoint(lat=-4.0, lon=-4.0, alt=100.0, pres=80.0, t=dt.datetime(1984, 9, 4, 15, 54)),
+             HyperPoint(lat=0.0, lon=0.0, alt=30.0, pres=20.0, t=dt.datetime(1986, 1, 1))]).get_all_points()
+        constraint = SepConstraintKdtree(a_sep=40, t_sep='P3D')
+        neighbours = constraint.get_neighbours(sample_points, data_points)
+
+        for kernel in [nn_time(), nn_altitude(), nn_pressure()]:
+            values = kernel.get_values(sample_points, data_points, neighbours)
+            for i, point in enumerate(sample_points):
+                con_points = constraint.constrain_points(point, data_points)
+                if len(con_points) == 0:
+                    assert values.mask[0, i]
+                else:
+                    eq_(values[0, i], kernel.get_value(point, con_points))
+            # The last sample point is years away from all of the data
+            assert values.mask[0, -1]
+
+
 class TestMean(unittest.TestCase):
     def test_basic_col_in_4d(self):
         from cis.collocation.col_implementations import GeneralUngriddedCollocator, mean, DummyConstraint
@@ -672,6 +741,32 @@ class TestMean(unittest.TestCase):
         eq_(new_data.data[0], 25.5)
 
 
+class TestDataOnlyKernelsInSlices(unittest.TestCase):
+    def test_values_in_slices_match_value_for_each_slice(self):
+        from cis.collocation.col_implementations import mean, stddev, min, max, moments
+
+        values = np.array([3.0, 1.0, 4.0, 1.0, 5.0, 9.0, 2.0, 6.0, 5.0, 3.0])
+        slice_starts = np.array([0, 3, 4, 8])
+        slice_ends = np.append(slice_starts[1:], len(values))
+        for kernel in [mean(), stddev(), min(), max(), moments()]:
+            kernel_values = kernel.get_values_for_data_only_in_slices(values, slice_starts)
+            eq_(kernel_values.shape, (kernel.return_size, len(slice_starts)))
+            for i, (start, end) in enumerate(zip(slice_starts, slice_ends)):
+                expected = np.atleast_1d(kernel.get_value_for_data_only(values[start:end]))
+                for actual_value, expected_value in zip(kernel_values[:, i], expected):
+                    if np.isnan(expected_value):
+                        assert actual_value is np.ma.masked or np.isnan(actual_value)
+                    else:
+                        assert_almost_equal(actual_value, expected_value)
+
+    def test_no_slices_gives_no_values(self):
+        from cis.collocation.col_implementations import mean, stddev, min, max, moments
+
+        for kernel in [mean(), stddev(), min(), max(), moments()]:
+            eq_(kernel.get_values_for_data_only_in_slices(np.zeros(0), np.zeros(0, dtype=int)).shape,
+                (kernel.return_size, 0))
+
+
 class TestLi(unittest.TestCase):
     def test_basic_col_gridded_to_ungridded_using_li_in_2d(self):
         from cis.collocation.col_implementations import GeneralUngriddedCollocator, li
@@ -685,6 +780,46 @@ class TestLi(unittest.TestCase):
         assert_almost_equal(new_data.data[1], 11.2)
         assert_almost_equal(new_data.data[2], 4.8)
 
+    def test_vectorised_interpolation_gives_same_result_as_point_by_point(self):
+        from cis.collocation.col_implementations import li, _get_values_point_by_point
+        import datetime as dt
+
+        mask = np.zeros((5, 4, 3), dtype=bool)
+        mask[2, 1, 1] = True
+        cube = gridded_data.make_from_cube(mock.make_mock_cube(time_dim_length=4, dim_order=['lat', 'time', 'lon'],
+                                                               mask=mask))
+        rng = np.random.RandomState(5)
+        sample_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, t=dt.datetime(1984, 8, 27) + dt.timedelta(hours=hours))
+             for lat, lon, hours in zip(rng.uniform(-12, 12, 40), rng.uniform(-5, 5, 40), rng.uniform(0, 80, 40))])
+        sample_view = sample_points.get_all_points()
+
+        for kernel in [li(), li(extrapolate=True)]:
+            vectorised = kernel.get_values(sample_view, cube, None)
+            point_by_point = _get_values_point_by_point(kernel, sample_view, cube)
+            assert_equal(vectorised.mask, point_by_point.mask)
+            assert_almost_equal(vectorised.compressed(), point_by_point.compressed())
+            assert vectorised.count() > 0
+
+    def test_vectorised_interpolation_on_hybrid_coordinates_gives_same_result_as_point_by_point(self):
+        from cis.collocation.col_implementations import li, _get_values_point_by_point
+        import datetime as dt
+
+        cube = gridded_data.make_from_cube(mock.make_mock_cube(time_dim_length=3, hybrid_ht_len=10))
+        rng = np.random.RandomState(7)
+        sample_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, alt=alt, t=dt.datetime(1984, 8, 27) + dt.timedelta(hours=hour))
+             for lat, lon, alt, hour in zip(rng.uniform(-12, 12, 40), rng.uniform(-6, 6, 40),
+                                            rng.uniform(0, 7000, 40), rng.uniform(0, 50, 40))])
+        sample_view = sample_points.get_all_points()
+
+        for kernel in [li(), li(extrapolate=True), li(nn_vertical=True)]:
+            vectorised = kernel.get_values(sample_view, cube, None)
+            point_by_point = _get_values_point_by_point(kernel, sample_view, cube)
+            assert_equal(vectorised.mask, point_by_point.mask)
+            assert_almost_equal(vectorised.compressed(), point_by_point.compressed())
+            assert vectorised.count() > 0
+
     def test_negative_lon_points_in_2d_dont_matter(self):
         """
             This is exactly the same test as above, except we ommit the point with negative longitude, this makes the
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import eq_
+import numpy as np
+
+from cis.collocation import metrics
+from cis.collocation.col_implementations import GeneralGriddedCollocator, GeneralUngriddedCollocator, \
+    BinnedCubeCellOnlyConstraint, SepConstraintKdtree, mean
+from cis.collocation.kdtree import KDTree
+from cis.collocation.metrics import CollocationMetrics
+from cis.test.util.mock import make_mock_cube, make_dummy_ungridded_data_single_point, \
+    make_regular_2d_ungridded_data
+
+
+class TestCollocationMetrics(unittest.TestCase):
+
+    def test_GIVEN_candidate_counts_WHEN_to_dict_THEN_counts_binned_by_powers_of_two(self):
+        collocation_metrics = CollocationMetrics()
+        collocation_metrics.add_candidate_counts([0, 1, 2, 3, 4, 7])
+        collocation_metrics.add_candidate_counts([8])
+
+        candidates = collocation_metrics.to_dict()['candidates']
+
+        eq_(candidates['queries'], 7)
+        eq_(candidates['min'], 0)
+        eq_(candidates['max'], 8)
+        eq_(candidates['mean'], 25.0 / 7)
+        eq_(dict(candidates['histogram']), {'0': 1, '1': 1, '2-3': 2, '4-7': 2, '8-15': 1})
+
+    def test_GIVEN_times_of_phases_WHEN_points_per_second_THEN_divided_by_query_and_kernel_times(self):
+        collocation_metrics = CollocationMetrics()
+        collocation_metrics.add_time('read', 100.0)
+        collocation_metrics.add_time('query', 1.5)
+        collocation_metrics.add_time('kernel', 0.5)
+        collocation_metrics.add_points_processed(1000)
+
+        eq_(collocation_metrics.points_per_second, 500.0)
+
+    def test_GIVEN_no_metrics_set_WHEN_reporting_THEN_does_nothing(self):
+        metrics.set_metrics(None)
+        with metrics.timed('query'):
+            metrics.add_candidate_counts([1, 2])
+            metrics.add_cells(10, 5)
+
+    def test_GIVEN_metrics_WHEN_write_json_THEN_can_be_read(self):
+        directory = tempfile.mkdtemp()
+        try:
+            collocation_metrics = CollocationMetrics()
+            with collocation_metrics.timed('index_build'):
+                collocation_metrics.add_cells(10, 4)
+            filename = os.path.join(directory, 'metrics.json')
+            collocation_metrics.write_json(filename)
+            with open(filename) as json_file:
+                written = json.load(json_file)
+        finally:
+            shutil.rmtree(directory)
+
+        eq_(written['cells'], 10)
+        eq_(written['empty_cells'], 4)
+        assert written['phase_times']['index_build'] >= 0
+        eq_(list(written['phase_times'].keys())[:len(metrics.PHASES)], list(metrics.PHASES))
+
+    def test_GIVEN_kd_tree_WHEN_get_tree_stats_THEN_leaves_hold_all_points(self):
+        tree = KDTree(np.random.RandomState(1).uniform(size=(100, 2)), leafsize=10)
+
+        stats = tree.get_tree_stats()
+
+        eq_(stats['leafsize'], 10)
+        assert stats['largest_leaf'] <= 10
+        assert stats['depth'] > 1
+        assert np.isclose(stats['leaves'] * stats['mean_leaf'], 100)
+
+
+class TestCollocatorsReportMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = CollocationMetrics()
+        metrics.set_metrics(self.metrics)
+
+    def tearDown(self):
+        metrics.set_metrics(None)
+
+    def test_GIVEN_single_point_WHEN_binned_onto_grid_THEN_empty_cells_recorded(self):
+        col = GeneralGriddedCollocator()
+        col.collocate(make_mock_cube(), make_dummy_ungridded_data_single_point(0.5, 0.5, 1.2),
+                      BinnedCubeCellOnlyConstraint(), mean())
+
+        eq_(self.metrics.cells, 15)
+        eq_(self.metrics.empty_cells, 14)
+        eq_(self.metrics.points_processed, 15)
+        eq_(self.metrics.candidate_queries, 1)
+        eq_([index['name'] for index in self.metrics.indexes], ['GridCellBinIndexInSlices'])
+        eq_(self.metrics.indexes[0]['occupied_cells'], 1)
+
+    def test_GIVEN_box_collocation_WHEN_collocate_THEN_candidates_for_each_sample_point_and_tree_recorded(self):
+        data = make_regular_2d_ungridded_data()
+        sample = make_regular_2d_ungridded_data()
+
+        GeneralUngriddedCollocator().collocate(sample, data, SepConstraintKdtree('500km'), mean())
+
+        eq_(self.metrics.points_processed, 15)
+        eq_(self.metrics.candidate_queries, 15)
+        assert self.metrics.candidate_min >= 1
+        index_names = [index['name'] for index in self.metrics.indexes]
+        assert 'HaversineDistanceKDTreeIndex' in index_names
+        assert self.metrics.indexes[index_names.index('HaversineDistanceKDTreeIndex')]['depth'] >= 1
@@ -1,9 +1,12 @@
+import datetime
+
 from nose.tools import istest, nottest, raises
 import numpy as np
 
-from cis.data_io.hyperpoint_view import UngriddedHyperPointView, GriddedHyperPointView
+from cis.data_io.hyperpoint_view import UngriddedHyperPointView, GriddedHyperPointView, HyperPointBatch
 import cis.test.util.mock as mock
 import cis.data_io.gridded_data as gridded_data
+from cis.time_util import convert_obj_to_standard_date_array
 
 
 class TestUngriddedHyperPointView(object):
@@ -139,6 +142,36 @@ class TestUngriddedHyperPointView(object):
         assert(hpv[8].longitude == 180.0)
         assert(hpv[44].longitude == 180.0)
 
+    @istest
+    def test_flattened_coords_and_data_match_points(self):
+        ug = mock.make_regular_2d_ungridded_data_with_missing_values()
+        hpv = ug.get_non_masked_points()
+        coords = hpv.coords_flattened
+        data = hpv.data_flattened
+        for idx, point in enumerate(hpv.iter_all_points()):
+            assert(coords[0][idx] == point.latitude)
+            assert(coords[1][idx] == point.longitude)
+            assert(data[idx] is np.ma.masked or data[idx] == point.val[0])
+        assert(coords[2] is None)
+
+    @istest
+    def test_non_masked_indices_omit_masked_points(self):
+        ug = mock.make_regular_2d_ungridded_data_with_missing_values()
+        hpv = ug.get_non_masked_points()
+        assert(np.array_equal(hpv.non_masked_indices(), [idx for idx, p in hpv.enumerate_non_masked_points()]))
+
+    @istest
+    def test_flattened_times_are_converted_once_and_follow_longitude_changes(self):
+        times = np.array([datetime.datetime(1984, 8, 27), datetime.datetime(1984, 8, 28)])
+        hpv = UngriddedHyperPointView([np.array([0.0, 10.0]), np.array([-170.0, 170.0]), None, None, times],
+                                      np.array([1.0, 2.0]))
+        coords = hpv.coords_flattened
+        assert(np.array_equal(coords[4], convert_obj_to_standard_date_array(times)))
+        hpv.set_longitude_range(0.0)
+        new_coords = hpv.coords_flattened
+        assert(new_coords[4] is coords[4])
+        assert(np.array_equal(new_coords[1], [190.0, 170.0]))
+
 
 class TestGriddedHyperPointView(object):
     """
@@ -329,6 +362,85 @@ class TestGriddedHyperPointView(object):
         assert(hpv[0, 8].longitude == 180.0)
         assert(hpv[4, 8].longitude == 180.0)
 
+    @istest
+    def test_flattened_coords_match_points_in_flattened_order(self):
+        gd = gridded_data.make_from_cube(mock.make_mock_cube(lat_dim_length=5, lon_dim_length=3, time_dim_length=2,
+                                                             dim_order=['time', 'lon', 'lat']))
+        hpv = gd.get_all_points()
+        coords = hpv.coords_flattened
+        data = hpv.data_flattened
+        assert(len(data) == len(hpv))
+        for idx in xrange(len(hpv)):
+            point = hpv[idx]
+            assert(coords[0][idx] == point.latitude)
+            assert(coords[1][idx] == point.longitude)
+            assert(coords[4][idx] == point.time)
+            assert(data[idx] == point.val[0])
+        assert(coords[2] is None)
+
+    @istest
+    def test_gathering_points_by_indices_gives_batch_of_same_points(self):
+        gd = gridded_data.make_from_cube(mock.make_mock_cube(lat_dim_length=5, lon_dim_length=3, time_dim_length=2,
+                                                             dim_order=['time', 'lon', 'lat']))
+        hpv = gd.get_all_points()
+        indices = np.array([29, 3, 17, 3])
+        batch = hpv[indices]
+        assert isinstance(batch, HyperPointBatch)
+        assert(len(batch) == 4)
+        for batch_idx, idx in enumerate(indices):
+            assert(batch[batch_idx] == hpv[idx])
+
+
+class TestHyperPointBatch(object):
+    """
+    Unit tests for HyperPointBatch class
+    """
+    def make_batch(self):
+        ug = mock.make_regular_2d_ungridded_data_with_missing_values()
+        return ug.get_all_points()[np.arange(15)]
+
+    @istest
+    def test_gathering_from_ungridded_view_gives_batch(self):
+        batch = self.make_batch()
+        assert isinstance(batch, HyperPointBatch)
+        assert(len(batch) == 15)
+        assert(batch[10].val[0] == 11.0)
+        assert(batch[10].latitude == 5.0)
+
+    @istest
+    def test_can_slice_batch(self):
+        batch = self.make_batch()[9:12]
+        assert isinstance(batch, HyperPointBatch)
+        assert(np.array_equal(batch.vals, [10, 11, 12]))
+        assert(np.array_equal(batch.latitudes, [5, 5, 5]))
+
+    @istest
+    def test_can_take_points_from_batch(self):
+        batch = self.make_batch().take([14, 0])
+        assert(np.array_equal(batch.latitudes, [10, -10]))
+        assert(np.array_equal(batch.longitudes, [5, -5]))
+
+    @istest
+    def test_can_filter_batch_with_mask(self):
+        batch = self.make_batch()
+        filtered = batch.filter(batch.latitudes > 0)
+        assert(len(filtered) == 6)
+        assert(np.all(filtered.latitudes > 0))
+
+    @istest
+    def test_non_masked_points_of_batch_exclude_masked_values(self):
+        batch = self.make_batch().non_masked()
+        assert(len(batch) == 12)
+        assert(not np.ma.getmaskarray(batch.vals).any())
+
+    @istest
+    def test_batch_coords_are_standard_times(self):
+        ug = mock.make_regular_4d_ungridded_data()
+        hpv = ug.get_all_points()
+        batch = hpv.as_batch()
+        assert(np.array_equal(batch.coords_flattened[4], hpv.coords_flattened[4]))
+        assert(batch[7].time == hpv[7].time)
+
 
 # if __name__ == '__main__':
 #     import nose
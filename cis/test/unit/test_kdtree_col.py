@@ -1,17 +1,21 @@
 import datetime as dt
 
 from hamcrest import *
-from nose.tools import istest, eq_
+from nose.tools import istest, eq_, raises
 import numpy as np
 from cis.collocation.kdtree import KDTree
 
 import cis.data_io.gridded_data as gridded_data
 from cis.data_io.hyperpoint import HyperPoint, HyperPointList
 from cis.data_io.ungridded_data import UngriddedData
+from cis.exceptions import CoordinateNotFoundError
 from cis.test.util import mock
 from cis.collocation.col_implementations import (GeneralUngriddedCollocator, nn_horizontal_kdtree, DummyConstraint,
-                                                 SepConstraintKdtree, make_coord_map)
+                                                 SepConstraintKdtree, SepConstraint, make_coord_map, nn_horizontal,
+                                                 SepConstraintGrid)
 from cis.collocation.haversinedistancekdtreeindex import HaversineDistanceKDTreeIndex
+from cis.collocation.horizontalgridindex import HorizontalGridIndex
+from cis.collocation.unitspherekdtreeindex import UnitSphereKDTreeIndex
 
 
 def is_collocated(data1, data2):
@@ -194,10 +198,61 @@ class TestSepConstraint(object):
         eq_(ref_vals.size, new_vals.size)
         assert (np.equal(ref_vals, new_vals).all())
 
-    def get_max_depth(self, node, depth):
-        if isinstance(node, KDTree.leafnode):
+    @istest
+    def test_get_neighbours_matches_constrain_points_in_4d(self):
+        ug_data = mock.make_regular_4d_ungridded_data()
+        ug_data_points = ug_data.get_non_masked_points()
+        sample_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=0.0, lon=0.0, alt=50.0, pres=50.0, t=dt.datetime(1984, 8, 29)),
+             HyperPoint(lat=5.0, lon=0.0, alt=10.0, pres=50.0, t=dt.datetime(1984, 8, 28)),
+             HyperPoint(lat=0.0, lon=0.0, alt=50.0, pres=50.0, t=dt.datetime(1984, 8, 29))]).get_all_points()
+
+        constraint = SepConstraintKdtree(h_sep=1000, a_sep=15, p_sep=1.22, t_sep='P1dT1M')
+        index = HaversineDistanceKDTreeIndex()
+        index.index_data(None, ug_data_points, None)
+        constraint.haversine_distance_kd_tree_index = index
+
+        neighbours = constraint.get_neighbours(sample_points, ug_data_points)
+
+        eq_(neighbours.shape, (len(sample_points), len(ug_data_points)))
+        for i, sample_point in enumerate(sample_points):
+            expected_vals = np.sort(constraint.constrain_points(sample_point, ug_data_points).vals)
+            row = neighbours.indices[neighbours.indptr[i]:neighbours.indptr[i + 1]]
+            assert np.array_equal(np.sort(ug_data_points.data_flattened[row]), expected_vals)
+
+    @istest
+    def test_get_neighbours_without_horizontal_constraint_matches_point_checks(self):
+        ug_data = mock.make_regular_4d_ungridded_data()
+        ug_data_points = ug_data.get_non_masked_points()
+        sample_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=0.0, lon=0.0, alt=50.0, pres=50.0, t=dt.datetime(1984, 8, 29)),
+             HyperPoint(lat=5.0, lon=0.0, alt=10.0, pres=50.0, t=dt.datetime(1984, 8, 28))]).get_all_points()
+
+        constraint = SepConstraintKdtree(a_sep=15, p_sep=1.22, t_sep='P1dT1M')
+        point_constraint = SepConstraint(a_sep=15, p_sep=1.22, t_sep='P1dT1M')
+
+        neighbours = constraint.get_neighbours(sample_points, ug_data_points)
+
+        for i, sample_point in enumerate(sample_points):
+            expected_vals = np.sort(point_constraint.constrain_points(sample_point, ug_data_points).vals)
+            row = neighbours.indices[neighbours.indptr[i]:neighbours.indptr[i + 1]]
+            assert np.array_equal(np.sort(ug_data_points.data_flattened[row]), expected_vals)
+
+    @istest
+    @raises(CoordinateNotFoundError)
+    def test_altitude_constraint_without_data_altitudes_raises_coordinate_not_found_error(self):
+        ug_data = mock.make_regular_2d_ungridded_data()
+        ug_data_points = ug_data.get_non_masked_points()
+        sample_point = HyperPoint(lat=0.0, lon=0.0, alt=50.0)
+
+        constraint = SepConstraintKdtree(a_sep=15)
+        constraint.constrain_points(sample_point, ug_data_points)
+
+    def get_max_depth(self, tree, node, depth):
+        if tree.node_children[node] < 0:
             return depth
-        return max(self.get_max_depth(node.less, depth + 1), self.get_max_depth(node.greater, depth + 1))
+        less = tree.node_children[node]
+        return max(self.get_max_depth(tree, less, depth + 1), self.get_max_depth(tree, less + 1, depth + 1))
 
     @istest
     def test_horizontal_constraint_in_2d_when_lats_are_the_same_produces_a_balanced_tree(self):
@@ -214,11 +269,284 @@ class TestSepConstraint(object):
         index = HaversineDistanceKDTreeIndex()
         index.index_data(sample_points, ug_data_points, coord_map, leafsize=2)
 
-        depth = self.get_max_depth(index.index.tree, 0)
+        depth = self.get_max_depth(index.index, 0, 0)
 
         assert_that(depth, is_(2), "Depth is 2, there are three unique values -10, 0, 10")
 
 
+class TestHaversineDistanceKDTreeIndexBatchQueries(object):
+    def setup(self):
+        self.data_points = mock.make_regular_2d_ungridded_data_with_missing_values().get_non_masked_points()
+        self.index = HaversineDistanceKDTreeIndex()
+        self.index.index_data(None, self.data_points, None, leafsize=2)
+        # Includes a repeated location, which should only be looked up once but returned for both points.
+        self.sample_points = [HyperPoint(lat=7.5, lon=-2.5), HyperPoint(lat=-3.0, lon=4.0),
+                              HyperPoint(lat=7.5, lon=-2.5), HyperPoint(lat=80.0, lon=100.0)]
+        self.lats = np.array([p.latitude for p in self.sample_points])
+        self.lons = np.array([p.longitude for p in self.sample_points])
+
+    @istest
+    def test_find_nearest_points_matches_single_point_queries(self):
+        indices, distances = self.index.find_nearest_points(self.lats, self.lons)
+        for i, point in enumerate(self.sample_points):
+            eq_(indices[i], self.index.find_nearest_point(point))
+        assert np.all(np.isfinite(distances))
+
+    @istest
+    def test_find_points_within_distance_of_points_matches_single_point_queries(self):
+        offsets, indices = self.index.find_points_within_distance_of_points(self.lats, self.lons, 400)
+        eq_(len(offsets), len(self.sample_points) + 1)
+        for i, point in enumerate(self.sample_points):
+            eq_(list(indices[offsets[i]:offsets[i + 1]]), self.index.find_points_within_distance(point, 400))
+        # Nothing is near the last point
+        eq_(offsets[-1], offsets[-2])
+
+    @istest
+    def test_find_points_within_distance_of_no_points(self):
+        offsets, indices = self.index.find_points_within_distance_of_points(np.array([]), np.array([]), 400)
+        eq_(list(offsets), [0])
+        eq_(len(indices), 0)
+
+    @istest
+    def test_find_pairs_within_distance_matches_single_point_queries(self):
+        offsets, indices = self.index.find_pairs_within_distance(self.lats, self.lons, 400)
+        eq_(len(offsets), len(self.sample_points) + 1)
+        for i, point in enumerate(self.sample_points):
+            eq_(list(indices[offsets[i]:offsets[i + 1]]),
+                sorted(self.index.find_points_within_distance(point, 400)))
+
+    @istest
+    def test_find_pairs_within_distance_of_no_points(self):
+        offsets, indices = self.index.find_pairs_within_distance(np.array([]), np.array([]), 400)
+        eq_(list(offsets), [0])
+        eq_(len(indices), 0)
+
+    @istest
+    def test_dual_tree_query_matches_brute_force_for_scattered_points(self):
+        from cis.collocation.kdtree import HaversineDistanceKDTree, haversine_distance
+        rng = np.random.RandomState(0)
+        data = np.column_stack((rng.uniform(-90, 90, 300), rng.uniform(-180, 180, 300)))
+        samples = np.column_stack((rng.uniform(-90, 90, 50), rng.uniform(-180, 180, 50)))
+        data_tree = HaversineDistanceKDTree(data, leafsize=4)
+        sample_tree = HaversineDistanceKDTree(samples, leafsize=4)
+
+        offsets, indices = sample_tree.query_ball_tree_offsets(data_tree, 2000)
+
+        for i in range(len(samples)):
+            expected = np.flatnonzero(haversine_distance(data, samples[i]) <= 2000)
+            assert np.array_equal(indices[offsets[i]:offsets[i + 1]], expected)
+
+
+class _PoleAndDatelinePoints(object):
+    """
+    Random data and sample points, including points near the poles and either side of the dateline, indexed with a
+    haversine k-D tree for comparison with other indexes.
+    """
+    def setup(self):
+        rng = np.random.RandomState(1)
+        lats = np.concatenate((rng.uniform(-90, 90, 400), [89.9, -89.9, 10.0, 10.0, 90.0]))
+        lons = np.concatenate((rng.uniform(-180, 180, 400), [0.0, 120.0, 179.9, -179.9, 0.0]))
+        self.data_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, val=float(i)) for i, (lat, lon) in enumerate(zip(lats, lons))]
+        ).get_all_points()
+        self.lats = np.concatenate((rng.uniform(-90, 90, 50), [90.0, -90.0, 10.0, 10.0]))
+        self.lons = np.concatenate((rng.uniform(-180, 180, 50), [45.0, 0.0, 180.0, 359.95]))
+        self.haversine_index = HaversineDistanceKDTreeIndex()
+        self.haversine_index.index_data(None, self.data_points, None)
+
+    def assert_same_neighbours_as_haversine_constraint(self, constraint):
+        """
+        Checks that a separation constraint, with its index set, finds the same neighbours of the sample points as a
+        SepConstraintKdtree with the same h_sep using the haversine k-D tree.
+        """
+        sample_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon) for lat, lon in zip(self.lats, self.lons)]).get_all_points()
+        haversine_constraint = SepConstraintKdtree(h_sep=constraint.h_sep)
+        haversine_constraint.haversine_distance_kd_tree_index = self.haversine_index
+
+        haversine_neighbours = haversine_constraint.get_neighbours(sample_points, self.data_points)
+        neighbours = constraint.get_neighbours(sample_points, self.data_points)
+
+        assert np.array_equal(neighbours.indptr, haversine_neighbours.indptr)
+        assert np.array_equal(neighbours.indices, haversine_neighbours.indices)
+
+
+class TestUnitSphereKDTreeIndex(_PoleAndDatelinePoints):
+    def setup(self):
+        super(TestUnitSphereKDTreeIndex, self).setup()
+        self.unit_sphere_index = UnitSphereKDTreeIndex()
+        self.unit_sphere_index.index_data(None, self.data_points, None)
+
+    @istest
+    def test_find_points_within_distance_of_points_is_same_as_haversine_index(self):
+        for distance in [50, 1000, 5000]:
+            haversine_offsets, haversine_indices = self.haversine_index.find_pairs_within_distance(
+                self.lats, self.lons, distance)
+            offsets, indices = self.unit_sphere_index.find_points_within_distance_of_points(
+                self.lats, self.lons, distance)
+            assert np.array_equal(offsets, haversine_offsets)
+            assert np.array_equal(indices, haversine_indices)
+
+    @istest
+    def test_find_nearest_points_is_same_as_exhaustive_search(self):
+        from cis.collocation.kdtree import haversine_distance
+        coords = self.data_points.coords_flattened
+        data_lat_lons = np.column_stack((coords[HyperPoint.LATITUDE], coords[HyperPoint.LONGITUDE]))
+
+        indices, distances = self.unit_sphere_index.find_nearest_points(self.lats, self.lons)
+
+        for i in range(len(self.lats)):
+            all_distances = haversine_distance(data_lat_lons, [self.lats[i], self.lons[i]])
+            eq_(indices[i], np.argmin(all_distances))
+            assert np.isclose(distances[i], np.min(all_distances))
+
+    @istest
+    def test_sep_constraint_gives_same_neighbours_with_either_index_type(self):
+        constraint = SepConstraintKdtree(h_sep=2000, index_type='unit_sphere')
+        constraint.unit_sphere_kd_tree_index = self.unit_sphere_index
+        self.assert_same_neighbours_as_haversine_constraint(constraint)
+
+
+class TestHorizontalGridIndex(_PoleAndDatelinePoints):
+    def setup(self):
+        super(TestHorizontalGridIndex, self).setup()
+        self.grid_index = HorizontalGridIndex()
+        self.grid_index.index_data(None, self.data_points, None)
+
+    @istest
+    def test_find_pairs_within_distance_is_same_as_haversine_index(self):
+        for distance in [0.1, 50, 1000, 5000, 15000, 25000]:
+            haversine_offsets, haversine_indices = self.haversine_index.find_pairs_within_distance(
+                self.lats, self.lons, distance)
+            offsets, indices = self.grid_index.find_pairs_within_distance(self.lats, self.lons, distance)
+            assert np.array_equal(offsets, haversine_offsets)
+            assert np.array_equal(indices, haversine_indices)
+
+    @istest
+    def test_grid_is_rebuilt_for_a_different_distance(self):
+        self.grid_index.find_pairs_within_distance(self.lats, self.lons, 50)
+        bands = self.grid_index.get_metrics()['bands']
+
+        self.grid_index.find_pairs_within_distance(self.lats, self.lons, 5000)
+
+        eq_(self.grid_index.distance, 5000)
+        assert self.grid_index.get_metrics()['bands'] < bands
+
+    @istest
+    def test_sep_constraint_gives_same_neighbours_as_kd_tree(self):
+        constraint = SepConstraintGrid(h_sep=2000)
+        constraint.horizontal_grid_index = self.grid_index
+        self.assert_same_neighbours_as_haversine_constraint(constraint)
+
+
+class TestSepConstraintWithTimeIndex(object):
+    def setup(self):
+        rng = np.random.RandomState(2)
+        times = dt.datetime(1984, 8, 27) + np.array([dt.timedelta(hours=h) for h in rng.uniform(0, 24 * 10, 500)])
+        self.data_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, alt=alt, t=t, val=float(i)) for i, (lat, lon, alt, t) in
+             enumerate(zip(rng.uniform(-10, 10, 500), rng.uniform(-10, 10, 500), rng.uniform(0, 100, 500), times))]
+        ).get_all_points()
+        self.sample_points = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, alt=alt, t=t) for lat, lon, alt, t in
+             zip(rng.uniform(-10, 10, 20), rng.uniform(-10, 10, 20), rng.uniform(0, 100, 20),
+                 dt.datetime(1984, 8, 27) + np.array([dt.timedelta(hours=h) for h in rng.uniform(0, 240, 20)]))]
+        ).get_all_points()
+
+    def _make_indexed_constraint(self, **kwargs):
+        from cis.collocation import data_index
+        constraint = SepConstraintKdtree(**kwargs)
+        data_index.create_indexes(constraint, None, self.data_points, None)
+        return constraint
+
+    def _assert_same_neighbours(self, neighbours, expected_neighbours):
+        assert np.array_equal(neighbours.indptr, expected_neighbours.indptr)
+        assert np.array_equal(neighbours.indices, expected_neighbours.indices)
+
+    @istest
+    def test_time_index_finds_same_points_as_exhaustive_search(self):
+        constraint = self._make_indexed_constraint(t_sep='PT6H', a_sep=30)
+        exhaustive_constraint = SepConstraintKdtree(t_sep='PT6H', a_sep=30)
+        assert constraint.sorted_time_index
+
+        self._assert_same_neighbours(constraint.get_neighbours(self.sample_points, self.data_points),
+                                     exhaustive_constraint.get_neighbours(self.sample_points, self.data_points))
+        for sample_point in self.sample_points:
+            assert np.array_equal(constraint._constrain_point_indices(sample_point, self.data_points),
+                                  exhaustive_constraint._constrain_point_indices(sample_point, self.data_points))
+
+    @istest
+    def test_time_index_is_used_first_when_more_selective_than_spatial_index(self):
+        constraint = self._make_indexed_constraint(h_sep=5000, t_sep='PT1H')
+        data_coords = self.data_points.coords_flattened
+        assert constraint._is_time_window_more_selective(self.sample_points.coords_flattened[HyperPoint.TIME],
+                                                         data_coords)
+        spatial_constraint = self._make_indexed_constraint(h_sep=5000, t_sep='PT1H')
+        spatial_constraint.sorted_time_index = False
+
+        self._assert_same_neighbours(constraint.get_neighbours(self.sample_points, self.data_points),
+                                     spatial_constraint.get_neighbours(self.sample_points, self.data_points))
+        for sample_point in self.sample_points:
+            assert np.array_equal(np.sort(constraint._constrain_point_indices(sample_point, self.data_points)),
+                                  np.sort(spatial_constraint._constrain_point_indices(sample_point, self.data_points)))
+
+    @istest
+    def test_spatial_index_is_used_first_when_more_selective_than_time_index(self):
+        constraint = self._make_indexed_constraint(h_sep=50, t_sep='P10D')
+        assert not constraint._is_time_window_more_selective(
+            self.sample_points.coords_flattened[HyperPoint.TIME], self.data_points.coords_flattened)
+
+
+class TestSepConstraintNearestNeighbours(object):
+    def setup(self):
+        rng = np.random.RandomState(5)
+        self.data = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, alt=alt, val=float(i)) for i, (lat, lon, alt) in
+             enumerate(zip(rng.uniform(-10, 10, 500), rng.uniform(-10, 10, 500), rng.uniform(0, 100, 500)))])
+        self.sample = UngriddedData.from_points_array(
+            [HyperPoint(lat=lat, lon=lon, alt=alt, val=0.0) for lat, lon, alt in
+             zip(rng.uniform(-12, 12, 40), rng.uniform(-12, 12, 40), rng.uniform(0, 100, 40))])
+        self.data_points = self.data.get_all_points()
+        self.sample_points = self.sample.get_all_points()
+
+    @istest
+    def test_nearest_neighbours_are_nearest_of_all_neighbours(self):
+        from cis.collocation import data_index
+        from cis.collocation.kdtree import haversine_distance
+        constraint = SepConstraintKdtree(h_sep=150, a_sep=20)
+        data_index.create_indexes(constraint, None, self.data_points, None)
+        data_coords = self.data_points.coords_flattened
+        sample_coords = self.sample_points.coords_flattened
+
+        nearest = constraint.get_nearest_neighbours(self.sample_points, self.data_points)
+        neighbours = constraint.get_neighbours(self.sample_points, self.data_points)
+
+        assert np.any(nearest == -1) and np.any(nearest >= 0)
+        for i in range(len(self.sample_points)):
+            row = neighbours.indices[neighbours.indptr[i]:neighbours.indptr[i + 1]]
+            if len(row) == 0:
+                eq_(nearest[i], -1)
+            else:
+                distances = haversine_distance(
+                    np.column_stack((data_coords[HyperPoint.LATITUDE][row], data_coords[HyperPoint.LONGITUDE][row])),
+                    [sample_coords[HyperPoint.LATITUDE][i], sample_coords[HyperPoint.LONGITUDE][i]])
+                eq_(nearest[i], row[np.argmin(distances)])
+
+    @istest
+    def test_nearest_neighbours_not_found_without_horizontal_separation(self):
+        constraint = SepConstraintKdtree(a_sep=20)
+        assert constraint.get_nearest_neighbours(self.sample_points, self.data_points) is None
+
+    @istest
+    def test_nn_horizontal_with_kdtree_constraint_same_as_point_by_point(self):
+        expected = GeneralUngriddedCollocator().collocate(self.sample, self.data, SepConstraint(h_sep=150, a_sep=20),
+                                                          nn_horizontal())[0]
+        for kernel in (nn_horizontal(), nn_horizontal_kdtree()):
+            output = GeneralUngriddedCollocator().collocate(self.sample, self.data,
+                                                            SepConstraintKdtree(h_sep=150, a_sep=20), kernel)[0]
+            np.testing.assert_array_equal(output.data, expected.data)
+
+
 class TestSepConstraintWithoutHorizontalSeparation(object):
     """Tests that SepConstraintKdtree behaves as an unoptimized constraint for non-spatial separations
     if the spatial separation parameter is not specified.
@@ -375,6 +703,81 @@ class TestSepConstraintWithGriddedData(object):
                 assert (out_points[0].val[0] == data_points[idx].val[0])
 
 
+class TestKDTreeArrays(object):
+    def setup(self):
+        rng = np.random.RandomState(3)
+        self.data = rng.uniform(-50, 50, (500, 2))
+        # Includes repeated points, which can not be split
+        self.data[:30] = [10.0, 10.0]
+        self.tree = KDTree(self.data, leafsize=5)
+
+    @istest
+    def test_children_partition_points_of_node_within_its_bounding_box(self):
+        tree = self.tree
+        eq_(sorted(tree.indices), list(range(len(self.data))))
+        for node in range(len(tree.node_children)):
+            points = self.data[tree.indices[tree.node_starts[node]:tree.node_ends[node]]]
+            assert np.all(points >= tree.node_mins[node]) and np.all(points <= tree.node_maxes[node])
+            less = tree.node_children[node]
+            if less < 0:
+                assert len(points) <= 5 or np.all(points == points[0])
+            else:
+                eq_(tree.node_starts[less], tree.node_starts[node])
+                eq_(tree.node_ends[less], tree.node_starts[less + 1])
+                eq_(tree.node_ends[less + 1], tree.node_ends[node])
+                split_dim, split = tree.node_split_dims[node], tree.node_splits[node]
+                eq_(tree.node_maxes[less][split_dim], split)
+                eq_(tree.node_mins[less + 1][split_dim], split)
+
+    @istest
+    def test_query_matches_exhaustive_search(self):
+        queries = np.random.RandomState(4).uniform(-60, 60, (20, 2))
+        distances, indices = self.tree.query(queries, k=3)
+        for i, query in enumerate(queries):
+            all_distances = np.sqrt(((self.data - query) ** 2).sum(axis=1))
+            assert np.allclose(distances[i], np.sort(all_distances)[:3])
+            eq_(sorted(self.tree.query_ball_point(query, 10)), list(np.flatnonzero(all_distances <= 10)))
+
+    @istest
+    def test_pickled_tree_gives_same_results(self):
+        import cPickle
+        queries = np.random.RandomState(4).uniform(-60, 60, (20, 2))
+        tree = cPickle.loads(cPickle.dumps(self.tree, cPickle.HIGHEST_PROTOCOL))
+
+        assert np.array_equal(tree.query(queries, k=3)[1], self.tree.query(queries, k=3)[1])
+        eq_(tree.query_pairs(2), self.tree.query_pairs(2))
+
+    @istest
+    def test_haversine_tree_bounding_caps_contain_points_of_node(self):
+        from cis.collocation.kdtree import HaversineDistanceKDTree, haversine_distance
+        tree = HaversineDistanceKDTree(self.data, leafsize=5)
+        for node in range(len(tree.node_children)):
+            points = self.data[tree.indices[tree.node_starts[node]:tree.node_ends[node]]]
+            distances = haversine_distance(points, np.degrees(tree.node_cap_centres[node]))
+            assert np.all(distances <= tree.node_cap_radii[node] + 1.0e-6)
+
+    @istest
+    def test_haversine_tree_nearest_within_points_matches_exhaustive_search(self):
+        from cis.collocation.kdtree import HaversineDistanceKDTree, haversine_distance
+        tree = HaversineDistanceKDTree(self.data, leafsize=5)
+        queries = np.vstack((np.random.RandomState(4).uniform(-60, 60, (20, 2)), [[10.0, 10.0]]))
+        allowed = np.random.RandomState(6).uniform(size=(len(queries), len(self.data))) < 0.5
+
+        indices, distances = tree.query_nearest_within_points(queries, 500, lambda rows, idx: allowed[rows, idx])
+
+        assert np.any(np.isinf(distances)) and np.any(np.isfinite(distances))
+        for i, query in enumerate(queries):
+            all_distances = haversine_distance(self.data, query)
+            candidates = np.flatnonzero((all_distances <= 500) & allowed[i])
+            if len(candidates) == 0:
+                eq_(indices[i], len(self.data))
+                assert np.isinf(distances[i])
+            else:
+                # Of the points at the same distance the one with the lowest index is found
+                eq_(indices[i], candidates[np.lexsort((candidates, all_distances[candidates]))[0]])
+                eq_(distances[i], all_distances[indices[i]])
+
+
 if __name__ == '__main__':
     import nose
 
@@ -505,6 +505,28 @@ class TestParseAggregate(ParseTestFiles):
         assert_that(dg[0]['product'], is_('cis'))
         assert_that(dg[0]['variables'], contains_inanyorder('rain', 'snow'))
 
+    def test_GIVEN_index_cache_WHEN_aggregate_THEN_index_cache_parsed(self):
+        args = ["aggregate", 'rain:' + self.escaped_test_directory_files[0], 'x=[-10,10,2]', '--index-cache',
+                'cache_dir']
+        main_args = parse_args(args)
+        eq_(main_args.index_cache, 'cache_dir')
+        eq_(main_args.index_cache_size, 1024)
+
+    def test_GIVEN_streaming_WHEN_aggregate_THEN_streaming_parsed(self):
+        args = ["aggregate", 'rain:' + self.escaped_test_directory_files[0], 'x=[-10,10,2]', '--streaming']
+        main_args = parse_args(args)
+        assert_that(main_args.streaming, is_(True))
+
+    def test_GIVEN_no_streaming_WHEN_aggregate_THEN_not_streaming(self):
+        args = ["aggregate", 'rain:' + self.escaped_test_directory_files[0], 'x=[-10,10,2]']
+        main_args = parse_args(args)
+        assert_that(main_args.streaming, is_(False))
+
+    def test_GIVEN_partial_WHEN_aggregate_THEN_partial_parsed(self):
+        args = ["aggregate", 'rain:' + self.escaped_test_directory_files[0], 'x=[-10,10,2]', '--partial']
+        main_args = parse_args(args)
+        assert_that(main_args.partial, is_(True))
+
     def test_GIVEN_longitude_limits_not_monotonically_increasing_WHEN_aggregate_THEN_raises_error(self):
         limits = ['x=[270,90,10]', 'x=[-30,-60,1]']
         for lim in limits:
@@ -534,6 +556,33 @@ class TestParseAggregate(ParseTestFiles):
             parse_args(args)
 
 
+class TestParseMergeAggregates(ParseTestFiles):
+    """
+    Tests specific to the merge-aggregates command
+    """
+
+    def test_GIVEN_partial_files_WHEN_merge_aggregates_THEN_files_expanded_and_output_given_extension(self):
+        args = ["merge-aggregates", self.data_file_wildcard, '-o', 'merged']
+        main_args = parse_args(args)
+        assert_that(main_args.filenames, contains_inanyorder(*self.multiple_valid_files))
+        eq_(main_args.output, 'merged.nc')
+        eq_(main_args.kernel, None)
+
+    def test_GIVEN_kernel_WHEN_merge_aggregates_THEN_kernel_parsed(self):
+        args = ["merge-aggregates", self.escaped_single_valid_file, '-k', 'mean']
+        main_args = parse_args(args)
+        eq_(main_args.kernel, 'mean')
+
+    def test_GIVEN_kernel_which_can_not_be_merged_WHEN_merge_aggregates_THEN_raises_error(self):
+        args = ["merge-aggregates", self.escaped_single_valid_file, '-k', 'nn_horizontal']
+        try:
+            parse_args(args)
+            assert False
+        except SystemExit as e:
+            if e.code != 2:
+                raise
+
+
 class TestParseCollocate(ParseTestFiles):
     """
     Tests specific to the collocate command
@@ -553,6 +602,85 @@ class TestParseCollocate(ParseTestFiles):
         assert_that(dg[0]['product'], is_('cis'))
         assert_that(dg[0]['variables'], contains_inanyorder('rain', 'snow'))
 
+    def test_can_specify_number_of_processes(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=box', '--processes', '4']
+        main_args = parse_args(args)
+        eq_(main_args.processes, 4)
+
+    def test_number_of_processes_defaults_to_one(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=box']
+        main_args = parse_args(args)
+        eq_(main_args.processes, 1)
+
+    def test_GIVEN_zero_processes_THEN_parser_error(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=box', '--processes', '0']
+        try:
+            parse_args(args)
+            assert False
+        except SystemExit as e:
+            if e.code != 2:
+                raise e
+
+    def test_can_specify_memory_limit(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=lin', '--memory-limit', '2048']
+        main_args = parse_args(args)
+        eq_(main_args.memory_limit, 2048)
+
+    def test_GIVEN_zero_memory_limit_THEN_parser_error(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=lin', '--memory-limit', '0']
+        try:
+            parse_args(args)
+            assert False
+        except SystemExit as e:
+            if e.code != 2:
+                raise e
+
+    def test_can_specify_metrics_file(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=box', '--metrics', 'metrics.json']
+        main_args = parse_args(args)
+        eq_(main_args.metrics, 'metrics.json')
+
+    def test_GIVEN_metrics_file_in_missing_directory_THEN_parser_error(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=box', '--metrics', 'not_a_dir/metrics.json']
+        try:
+            parse_args(args)
+            assert False
+        except SystemExit as e:
+            if e.code != 2:
+                raise e
+
+    def test_can_specify_index_cache(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=box', '--index-cache', 'cache_dir',
+                '--index-cache-size', '200']
+        main_args = parse_args(args)
+        eq_(main_args.index_cache, 'cache_dir')
+        eq_(main_args.index_cache_size, 200)
+
+    def test_index_cache_not_used_by_default(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=box']
+        main_args = parse_args(args)
+        eq_(main_args.index_cache, None)
+
+    def test_GIVEN_zero_index_cache_size_THEN_parser_error(self):
+        args = ["col", "rain:" + self.escaped_test_directory_files[0],
+                self.escaped_test_directory_files[0] + ':collocator=box', '--index-cache', 'cache_dir',
+                '--index-cache-size', '0']
+        try:
+            parse_args(args)
+            assert False
+        except SystemExit as e:
+            if e.code != 2:
+                raise e
+
     def test_can_leave_collocator_missing(self):
         var = 'rain'
         samplegroup = self.escaped_test_directory_files[0] + ':variable=rain'